@@ -4,6 +4,7 @@
 import os
 import socketio
 import time
+from v2x_spat import PHASES, SpatState, phase_bit
 
 # mvillage environment
 server = "wss://octane.mvillage.um.city"
@@ -17,6 +18,9 @@ namespace = "/octane"
 
 sio = socketio.Client()
 
+# Last SpatState seen for each intersection
+last_spat = {}
+
 def send_auth():
     """
     Emit an authentication event.
@@ -62,8 +66,10 @@ def on_disconnect():
 def on_v2x_spat(data):
     if(data['id'] == 'beef'): # example Mcity id: 0a0c
         #print(data)
+        spat = SpatState.from_message(data)
         print("\n")
-        print_spat(data)
+        print_spat(spat, last_spat.get(spat.id))
+        last_spat[spat.id] = spat
 
 
 def on_message(client, userdata, msg):
@@ -74,16 +80,14 @@ def on_message(client, userdata, msg):
 
 
 # prints spat in viewable format
-def print_spat(data):
-    red = data['red'][8:16]
-    yellow = data['yellow'][8:16]
-    green = data['green'][8:16]
-    space = " "
-    print(data['updated'])
+def print_spat(spat, previous=None):
+    print(spat.updated)
     print("Ph:  1 2 3 4 5 6 7 8")
-    print("RED  " + space.join(red))
-    print("YEL  " + space.join(yellow))
-    print("GRE  " + space.join(green))
+    for label, mask in (("RED", spat.red), ("YEL", spat.yellow), ("GRE", spat.green)):
+        print(label + "  " + " ".join('1' if mask & phase_bit(phase) else '0' for phase in PHASES))
+    changed = spat.changed_phases(previous)
+    if changed:
+        print("Changed: phases " + ", ".join(str(phase) for phase in changed))
 
 
 if not api_key:
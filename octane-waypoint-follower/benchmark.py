@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+benchmark.py
+
+Benchmarks the path following pipeline, stage by stage: parsing GeoJSON, interpolating trajectories (geodesic and
+planar), building messages, emitting them to a local socket standing in for OCTANE, and how closely the send
+schedule is kept. It runs against the bundled highway.json and roundabout.json and against synthetic paths with
+thousands of vertices, across a range of speeds and message frequencies.
+
+Results are written as JSON. Pass a previous run's results with --baseline to flag anything that got slower.
+
+    $ ./benchmark.py -o results.json
+    $ ./benchmark.py --baseline results.json
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from socketio import packet
+
+from message_template import template_json
+from scheduler import DeadlineScheduler
+from trajectory import Trajectory
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# follow-path.py isn't importable by name, so load it from its file
+_spec = importlib.util.spec_from_file_location("follow_path", os.path.join(HERE, "follow-path.py"))
+follow_path = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(follow_path)
+
+# Lower is better for all of these; throughput is reported as time per message so that holds
+TIMED_METRICS = ("parse_s", "interpolate_s", "interpolate_planar_s", "build_us_per_msg", "build_legacy_us_per_msg",
+                 "emit_us_per_msg")
+
+
+def synthetic_path(filename, vertices, seed=0):
+    """
+    Write a random walk around Mcity with the given number of vertices as a GeoJSON LineString
+    """
+    rng = random.Random(seed)
+    lon, lat, heading = -83.6985, 42.3000, 0.0
+    coordinates = []
+    for _ in range(vertices):
+        coordinates.append([lon, lat])
+        heading += rng.uniform(-30, 30)
+        step_m = rng.uniform(2, 20)
+        lat += step_m * math.cos(math.radians(heading)) / 111320
+        lon += step_m * math.sin(math.radians(heading)) / (111320 * math.cos(math.radians(lat)))
+
+    with open(filename, "w") as path_file:
+        json.dump({"type": "Feature", "properties": {},
+                   "geometry": {"type": "LineString", "coordinates": coordinates}}, path_file)
+
+
+class LocalSocketOctane:
+    """
+    Stands in for OctaneInstance: each emit is encoded as the Socket.IO packet that would go to OCTANE and written
+    to a local socket pair, which a thread drains. Packets are encoded with template_json, as OctaneInstance's
+    socketio.Client(json=template_json) does (socketio sets it on the Packet class), until close().
+    """
+    def __init__(self):
+        self._json = packet.Packet.json
+        packet.Packet.json = template_json
+        self.sender, self.receiver = socket.socketpair()
+        self.received = 0
+        self._reader = threading.Thread(target=self._drain, daemon=True)
+        self._reader.start()
+
+    def _drain(self):
+        while True:
+            data = self.receiver.recv(1 << 16)
+            if not data:
+                return
+            self.received += len(data)
+
+    @staticmethod
+    def encode(channel, payload):
+        return packet.Packet(packet.EVENT, namespace="/octane", data=[channel, payload]).encode()
+
+    def emit(self, channel, payload, sender=None):
+        self.sender.sendall(self.encode(channel, payload).encode())
+
+    def close(self):
+        self.sender.close()
+        self._reader.join()
+        self.receiver.close()
+        packet.Packet.json = self._json
+
+
+def octane_packet(channel, payload):
+    """
+    :return: The packet OctaneInstance would send for an emit, captured on its way to the transport
+    """
+    default_json = packet.Packet.json
+    try:
+        # Not connected: pretend the namespace is, and catch the packet where it would go to engineio
+        octane = follow_path.OctaneInstance("benchmark")
+        octane.socket.namespaces = {follow_path.OctaneInstance.OctaneNamespace.namespace: "sid"}
+        sent = []
+        octane.socket._send_packet = lambda pkt: sent.append(pkt.encode())
+        octane._emit(channel, payload)
+        return sent[0]
+    finally:
+        # socketio.Client(json=...) sets it for every client in the process
+        packet.Packet.json = default_json
+
+
+def check_emit_encoding(payload):
+    """
+    Make sure the emit stage times exactly the encoding OctaneInstance does
+    """
+    octane = LocalSocketOctane()
+    try:
+        local = octane.encode("v2x_BSM", {"id": 1, "payload": payload})
+    finally:
+        octane.close()
+    expected = octane_packet("v2x_BSM", {"id": 1, "payload": payload})
+    if local != expected:
+        raise AssertionError(f"Benchmark packet {local!r} differs from OctaneInstance's {expected!r}")
+
+
+def best_of(repeat, function):
+    """
+    :return: (fastest time in seconds, result of the last call)
+    """
+    best, result = math.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def follower_class(base, frequency_hz):
+    return type(f"{base.__name__}{frequency_hz:g}Hz", (base,), {"frequency_hz": frequency_hz})
+
+
+def bench_pipeline(path_filename, speed, frequency_hz, repeat):
+    cls = follower_class(follow_path.VehiclePathFollower, frequency_hz)
+    parse_s, follower = best_of(repeat, lambda: cls(path_filename, speed))
+    waypoints = follower.geojson_path
+
+    interpolate_s, trajectory = best_of(repeat, lambda: Trajectory.from_waypoints(waypoints, speed, frequency_hz))
+    interpolate_planar_s, planar = best_of(repeat, lambda: Trajectory.from_waypoints(waypoints, speed, frequency_hz,
+                                                                                     planar_tolerance_m=1.0))
+    follower._trajectory = trajectory
+    count = len(trajectory)
+    result = {
+        "path": os.path.basename(path_filename),
+        "vertices": len(waypoints),
+        "speed": speed,
+        "frequency_hz": frequency_hz,
+        "points": count,
+        "parse_s": parse_s,
+        "interpolate_s": interpolate_s,
+        "interpolate_planar_s": interpolate_planar_s,
+        "planar_error": planar.planar_error,
+    }
+    if not count:
+        return result
+
+    build_s, payloads = best_of(repeat, lambda: follower.encode_batch(0, count))
+    build_legacy_s, _ = best_of(repeat, lambda: [json.dumps(follower.as_message(point)) for point in follower.path()])
+
+    check_emit_encoding(payloads[0])
+    octane = LocalSocketOctane()
+    try:
+        emit_s, _ = best_of(repeat, lambda: [octane.emit("v2x_BSM", {"id": 1, "payload": payload})
+                                             for payload in payloads])
+    finally:
+        octane.close()
+
+    result.update({
+        "build_us_per_msg": 1e6 * build_s / count,
+        "build_legacy_us_per_msg": 1e6 * build_legacy_s / count,
+        "emit_us_per_msg": 1e6 * emit_s / count,
+        "emit_msgs_per_s": count / emit_s if emit_s else None,
+    })
+    return result
+
+
+def bench_jitter(path_filename, frequency_hz, seconds, policy="burst"):
+    """
+    Send for a few seconds through the DeadlineScheduler to the local socket and report how well it kept time
+    """
+    follower = follower_class(follow_path.VehiclePathFollower, frequency_hz)(path_filename, 5.0)
+    count = min(len(follower.trajectory), int(seconds * frequency_hz))
+    payloads = follower.encode_batch(0, count)
+    octane = LocalSocketOctane()
+    scheduler = DeadlineScheduler(follower.time_per_msg_s, policy)
+    try:
+        for index in scheduler.ticks(count):
+            octane.emit("v2x_BSM", {"id": 1, "payload": payloads[index]})
+    finally:
+        octane.close()
+    return dict(scheduler.stats.summary(), path=os.path.basename(path_filename))
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: Descriptions of every timed metric that's more than threshold times slower than in baseline
+    """
+    def key(result):
+        return result["path"], result["speed"], result["frequency_hz"]
+
+    previous = {key(result): result for result in baseline.get("pipeline", [])}
+    regressions = []
+    for result in results["pipeline"]:
+        before = previous.get(key(result))
+        if not before:
+            continue
+        for metric in TIMED_METRICS:
+            if result.get(metric) and before.get(metric) and result[metric] > before[metric] * threshold:
+                regressions.append(f"{key(result)} {metric}: {before[metric]:.6g} -> {result[metric]:.6g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the path following pipeline",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-o", "--output", help="Write results to this file as JSON (default: stdout)")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[2.0, 5.0, 15.0],
+                        help="Speeds to follow paths at, in meters/second")
+    parser.add_argument("--frequencies", type=float, nargs="+", default=[5.0, 10.0, 50.0],
+                        help="Message frequencies to benchmark, in Hz")
+    parser.add_argument("--synthetic-vertices", type=int, nargs="*", default=[1000, 5000],
+                        help="Sizes of the synthetic random walk paths to include")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each measurement; the fastest is kept")
+    parser.add_argument("--jitter-seconds", type=float, default=2.0,
+                        help="How long to run each schedule jitter measurement for (0 to skip)")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="How many times slower than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        paths = [os.path.join(HERE, "highway.json"), os.path.join(HERE, "roundabout.json")]
+        for vertices in args.synthetic_vertices:
+            paths.append(os.path.join(scratch, f"synthetic-{vertices}.json"))
+            synthetic_path(paths[-1], vertices)
+
+        results = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "repeat": args.repeat,
+            },
+            "pipeline": [],
+            "jitter": [],
+        }
+        for path_filename in paths:
+            for speed in args.speeds:
+                for frequency_hz in args.frequencies:
+                    results["pipeline"].append(bench_pipeline(path_filename, speed, frequency_hz, args.repeat))
+                    print(f"{os.path.basename(path_filename)} {speed}m/s {frequency_hz}Hz done", file=sys.stderr)
+
+        if args.jitter_seconds > 0:
+            for frequency_hz in args.frequencies:
+                results["jitter"].append(bench_jitter(paths[0], frequency_hz, args.jitter_seconds))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
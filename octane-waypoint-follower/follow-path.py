@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
 import argparse
-import math
+import copy
+import hashlib
+import json
+import os
+import threading
 import time
 from abc import ABC
 from decimal import Decimal
@@ -11,6 +15,15 @@ import requests
 import socketio
 from pyproj import Geod
 
+import render
+from message_template import MessageTemplate, template_json
+from octane_outbox import Outbox, backoff_delays
+from rsu_catalog import RSUCatalog, expand_handoffs
+from scheduler import DeadlineScheduler
+from swarm import Swarm, SwarmAgent
+from trajectory import Trajectory
+from trajectory_cache import TrajectoryCache, default_cache_dir
+
 """
 Given a path in GeoJSON, this set of classes will work out a linear traversal of them based on a model (vehicle, 
 person, etc.) It will produce a set of V2X messages and insert them into OCTANE, attempting to produce them 
@@ -29,30 +42,145 @@ class OctaneInstance:
     """
     Represents an OCTANE connection
 
+    If the connection drops, messages emitted in the meantime are kept in an Outbox while it reconnects (with
+    exponential backoff), and sent once it's authenticated again. On exit, held messages get up to drain_timeout_s
+    to go out.
+
     TODO: this should go away in lieu of a more full-featured API implementation
     """
-    def __init__(self, auth_token, api_server="https://octane.mvillage.um.city"):
+    # Only go back to the shortest reconnect backoff once a connection has stayed up this long
+    reconnect_reset_s = 60.0
+    # On exit, wait up to this long for messages held during an outage to be sent
+    drain_timeout_s = 10.0
+
+    def __init__(self, auth_token, api_server="https://octane.mvillage.um.city", outbox=None):
         self.auth_token = auth_token
         self.api_server = api_server
+        self.outbox = outbox or Outbox()
 
         self.api_base_url = f"{api_server}/api"
         self.session = requests.Session()
         self.session.headers = {'X-API-KEY': auth_token}
-        self.socket = socketio.Client()
+        # template_json lets already encoded messages (see MessageTemplate) through without encoding them again.
+        # Reconnecting is done by _keep_connected rather than socketio, which only reconnects inside wait().
+        self.socket = socketio.Client(json=template_json, reconnection=False)
         self.socket.register_namespace(self.OctaneNamespace(self))
 
+        # Set once authenticated with nothing left in the outbox; until then emit() adds to the outbox
+        self._live = False
+        self._live_lock = threading.Lock()
+        self._disconnected = threading.Event()
+        self._closing = False
+
     def __enter__(self):
         # Connect to websocket
-        self.socket.connect(self.api_server, transports=None, namespaces=[self.OctaneNamespace.namespace])
+        self.connect()
+        threading.Thread(target=self._keep_connected, daemon=True).start()
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self._drain()
+        self._closing = True
+        self._disconnected.set()
         self.socket.disconnect()
+        if self.outbox.held:
+            print(self.outbox.report())
 
-    def emit(self, channel, payload):
+    def _drain(self):
+        """
+        Give messages still in the outbox up to drain_timeout_s to go out, reconnecting meanwhile if need be
+        """
+        deadline = time.monotonic() + self.drain_timeout_s
+        if len(self.outbox):
+            print(f"\nWaiting up to {self.drain_timeout_s:.0f}s to send {len(self.outbox)} held messages")
+        while time.monotonic() < deadline:
+            with self._live_lock:
+                if self._live and not len(self.outbox):
+                    return
+            time.sleep(0.1)
+
+    def connect(self):
+        self.socket.connect(self.api_server, transports=None, namespaces=[self.OctaneNamespace.namespace])
+
+    def emit(self, channel, payload, sender=None):
+        """
+        :param sender: Who the message is from (e.g. a vehicle's ID), so the outbox keeps each sender's latest
+                       message however long the connection is down
+        """
+        with self._live_lock:
+            if not self._live:
+                self.outbox.put(channel, payload, sender)
+                return
+        try:
+            self._emit(channel, payload)
+        except socketio.exceptions.SocketIOError:
+            # Disconnected since we last looked
+            with self._live_lock:
+                self._live = False
+            self.outbox.put(channel, payload, sender)
+
+    def _emit(self, channel, payload):
         self.socket.emit(channel, payload, namespace=self.OctaneNamespace.namespace)
 
+    def _flush(self):
+        """
+        Send everything the outbox holds, then go back to emitting directly
+        """
+        try:
+            while True:
+                sent = self.outbox.flush(self._emit)
+                if sent:
+                    print(f"\nSent {sent} messages held while disconnected")
+                with self._live_lock:
+                    if not len(self.outbox):
+                        self._live = True
+                        return
+        except socketio.exceptions.SocketIOError:
+            # Dropped again; the rest waits for the next connection
+            pass
+
+    def _keep_connected(self):
+        """
+        Reconnect whenever the connection drops, backing off exponentially while the server can't be reached.
+        A loop in its own thread rather than reconnecting from the disconnect handler, so no outage, however long,
+        piles up calls. A connection that drops within reconnect_reset_s counts as a failed attempt, so a server
+        that accepts connections and then closes them isn't hammered.
+        """
+        delays = backoff_delays()
+        connected_at = time.monotonic()
+        while True:
+            self._disconnected.wait()
+            if self._closing:
+                return
+            if time.monotonic() - connected_at >= self.reconnect_reset_s:
+                delays = backoff_delays()
+            else:
+                delay_s = next(delays)
+                print(f"\nConnection dropped after {time.monotonic() - connected_at:.1f}s, reconnecting in "
+                      f"{delay_s:.1f}s")
+                time.sleep(delay_s)
+            while not self._closing:
+                self._disconnected.clear()
+                try:
+                    self.connect()
+                    connected_at = time.monotonic()
+                    break
+                except socketio.exceptions.ConnectionError as err:
+                    delay_s = next(delays)
+                    print(f"\nCouldn't reconnect to OCTANE ({err}), trying again in {delay_s:.1f}s")
+                    time.sleep(delay_s)
+
+    def _on_authenticated(self):
+        self.socket.start_background_task(self._flush)
+
+    def _on_disconnected(self):
+        with self._live_lock:
+            self._live = False
+        if not self._closing:
+            print("\nDisconnected from OCTANE, holding messages until reconnected")
+            self._disconnected.set()
+
     def post_json_message(self, endpoint, json_message):
         return self.session.post("%s%s" % (self.api_base_url, endpoint), json=json_message)
 
@@ -70,8 +198,11 @@ class OctaneInstance:
             self.octane_instance.socket.emit('auth', {'x-api-key': self.octane_instance.auth_token}, 
                                              namespace=self.namespace)
 
+        def on_auth_ok(self, data):
+            self.octane_instance._on_authenticated()
+
         def on_disconnect(self):
-            self.octane_instance.socket.disconnect()
+            self.octane_instance._on_disconnected()
 
 
 class MovingPoint(geojson.Point):
@@ -98,6 +229,17 @@ class V2XMessageType(ABC):
         "messageSet": protocol,
     }
 
+    # Message fields that carry the (temporary) ID of the sender
+    _id_params = ()
+
+    _message_template = None
+
+    def set_temporary_id(self, temporary_id):
+        """
+        Send messages under a different ID than the class default, e.g. to tell several senders apart
+        """
+        self._base_params = dict(self._base_params, **{param: temporary_id for param in self._id_params})
+
     @property
     def time_per_msg_s(self):
         """
@@ -130,10 +272,28 @@ class V2XMessageType(ABC):
         }
         message.update(self._base_params)
         if extra_args:
-            message.update(self.extra_args)
+            message.update(extra_args)
 
         return message
 
+    @property
+    def message_template(self):
+        """
+        A MessageTemplate for this message type's params, rebuilt whenever they change
+        """
+        if self._message_template is None or self._message_template.params is not self._base_params:
+            self._message_template = MessageTemplate(self._base_params)
+        return self._message_template
+
+    def encode_message(self, moving_point):
+        """
+        Given a MovingPoint, return the same message as as_message, already encoded as JSON
+        """
+        coordinates = moving_point.coordinates
+        return self.message_template.encode(coordinates[0], coordinates[1],
+                                            coordinates[2] if len(coordinates) > 2 else 0,
+                                            moving_point.speed, moving_point.heading)
+
 
 class BSM(V2XMessageType):
     """
@@ -151,6 +311,7 @@ class BSM(V2XMessageType):
             "vehicleWidth": 1.83,
             "angle": 0.0, # TODO: compute!
         })
+    _id_params = ("id", "idTemporary")
 
     def endpoint(self, rsu_id):
         # Assumes OCTANE of course!
@@ -174,6 +335,7 @@ class PSM(V2XMessageType):
             "type": "pedestrian",
             "size": "small",
         })
+    _id_params = ("id",)
 
     def endpoint(self, rsu_id):
         # Assumes OCTANE of course!
@@ -195,91 +357,191 @@ class PathFollower(ABC):
     """
     geod = Geod(ellps="WGS84")
 
-    def __init__(self, geojson_filename, velocity_meters_per_s):
+    # Set to a TrajectoryCache to reuse compiled trajectories between runs
+    trajectory_cache = None
+
+    # Interpolate on a local tangent plane when that's within this many meters (and degrees of heading) of the
+    # geodesic path (see Trajectory.from_waypoints), or None to always work geodesically
+    planar_tolerance_m = None
+    planar_tolerance_deg = 0.1
+
+    # How many messages follow() encodes at a time
+    batch_size = 50
+
+    # Where RSUs are looked up; give it a directory to keep the RSU list between runs
+    rsu_catalog = RSUCatalog()
+
+    def __init__(self, geojson_filename, velocity_meters_per_s, temporary_id=None):
         """
 
         :param geojson_file: A geojson file that contains a Feature with a LineString
         :param velocity_meters_per_s: Object velocity in meters/sec
+        :param temporary_id: ID to send messages under, instead of the message type's default
         """
-        with open(geojson_filename) as geojson_file:
-            geo_feature = geojson.load(geojson_file)
-
-        self.geojson_path = geojson.utils.coords(geo_feature)
+        with open(geojson_filename, "rb") as geojson_file:
+            self._geojson_content = geojson_file.read()
+        # Hashed as read; only parsed (see geojson_path) if the trajectory isn't already cached
+        self.geojson_digest = hashlib.sha256(self._geojson_content).hexdigest()
+        self._geojson_path = None
         self.velocity_meters_per_s = float(velocity_meters_per_s)
+        self._trajectory = None
+        self._scheduler = None
+        self.next_index = 0
+        if temporary_id:
+            self.set_temporary_id(temporary_id)
 
-    def find_rsu(self, octane_instance):
+    def encode_batch(self, start, stop):
         """
-        Given the type of messages we want to send, find a compatible RSU. Currently just
-        returns the first match. Could be extended to find nearest, etc.
+        Encode the messages for trajectory points [start, stop) in one go
+        :return: A list of messages as PreEncoded JSON, as encode_message would give for each point
         """
-        response = octane_instance.get("/v2x/rsus")
-        response.raise_for_status()
+        trajectory = self.trajectory
+        count = len(range(*slice(start, stop).indices(len(trajectory))))
+        # Coordinates are rounded as MovingPoint (a geojson Point) rounds them
+        return self.message_template.encode_batch([round(lon, 6) for lon in trajectory.lon[start:stop].tolist()],
+                                                  [round(lat, 6) for lat in trajectory.lat[start:stop].tolist()],
+                                                  [0] * count, [trajectory.speed] * count,
+                                                  trajectory.heading[start:stop].tolist())
 
-        for rsu in response.json().get("rsus", []):
-            for radio in rsu.get("radiosSupported"):
-                if radio["messageSet"] == self.protocol and radio["messageType"] == self.name \
-                      and radio["txEnabled"]:
-                    return rsu["id"]
+    def find_rsu(self, octane_instance):
+        """
+        Given the type of messages we want to send, find a compatible RSU. Returns the first match,
+        for when nothing is known about where RSUs are - see plan_rsus.
+        """
+        for rsu in self.rsu_catalog.capable(octane_instance, self.protocol, self.name):
+            return rsu["id"]
 
-        raise RuntimeError(f"Unable to find a suitable RSU to send {self.name()}s via {self.protocol}")
+        raise RuntimeError(f"Unable to find a suitable RSU to send {self.name}s via {self.protocol}")
 
-    def path(self):
+    def plan_rsus(self, octane_instance, rsu_id=None):
         """
-        Generates a path, which yields a point per frequency interval
-        :return: Yields a point stream as a (latitude, longitude) tuple of floats
+        Work out which RSU to send each message of the trajectory through: the nearest compatible RSU to
+        each stretch of the path, handing off from one to the next as the path moves.
+
+        :param rsu_id: Send everything through this RSU instead
+        :return: A list of RSU ids, one per trajectory point
         """
-        prev_path_lat = prev_path_lng = prev_point_lat = prev_point_lng = None
-        for (path_lng, path_lat) in self.geojson_path:
-            if prev_path_lat and prev_path_lng:
-                # Compute the number of broadcasted points we'll need to satisfy
-                # the frequency requirements, given the object's velocity between
-                # the two waypoints. We'll always round up the number of broadcast
-                # points, which for now will underreport velocity slightly.
-                #
-                distance_m = self.geod.line_length((prev_path_lng, path_lng), (prev_path_lat, path_lat))
-                point_count = math.ceil((distance_m / self.velocity_meters_per_s) * self.frequency_hz)
+        if rsu_id:
+            handoffs = [(0, rsu_id)]
+        else:
+            handoffs = self.rsu_catalog.index(octane_instance, self.protocol, self.name).plan(self.trajectory)
+            if not handoffs:
+                handoffs = [(0, self.find_rsu(octane_instance))]
+        return expand_handoffs(handoffs, len(self.trajectory))
 
-                for (point_lng, point_lat) in self.geod.npts(prev_path_lng, prev_path_lat, path_lng, path_lat,
-                                                             point_count):
-                    if prev_point_lat and prev_point_lng:
-                        heading, _, _ = self.geod.inv(prev_point_lng, prev_point_lat, point_lng, point_lat)
-                        if (heading < 0):
-                            heading += 360
+    @property
+    def geojson_path(self):
+        """
+        The path's coordinates, parsed from the GeoJSON file on first use
+        """
+        if self._geojson_path is None:
+            self._geojson_path = list(geojson.utils.coords(geojson.loads(self._geojson_content.decode())))
+            self._geojson_content = None
+        return self._geojson_path
 
-                        yield MovingPoint(speed=self.velocity_meters_per_s, heading=heading, coordinates=(point_lng, point_lat))
+    @property
+    def trajectory(self):
+        """
+        The whole traversal of this path, computed once on first use
+        :return: A Trajectory with a point per frequency interval
+        """
+        if self._trajectory is None:
+            def compute():
+                return Trajectory.from_waypoints(self.geojson_path, self.velocity_meters_per_s, self.frequency_hz,
+                                                 planar_tolerance_m=self.planar_tolerance_m,
+                                                 planar_tolerance_deg=self.planar_tolerance_deg)
+
+            if self.trajectory_cache:
+                key = self.trajectory_cache.key(self.geojson_digest, self.velocity_meters_per_s,
+                                                self.frequency_hz, type(self).__name__,
+                                                self.planar_tolerance_m, self.planar_tolerance_deg)
+                self._trajectory = self.trajectory_cache.load(key, self.velocity_meters_per_s, compute)
+            else:
+                self._trajectory = compute()
+        return self._trajectory
 
-                    prev_point_lat = point_lat
-                    prev_point_lng = point_lng
+    def path(self):
+        """
+        Generates a path, which yields a point per frequency interval
+        :return: Yields a point stream as MovingPoints
+        """
+        trajectory = self.trajectory
+        for i in range(len(trajectory)):
+            yield self.moving_point(i)
 
-            prev_path_lat = path_lat
-            prev_path_lng = path_lng
+    def moving_point(self, index):
+        """
+        The MovingPoint for a given index into the trajectory
+        """
+        trajectory = self.trajectory
+        return MovingPoint(speed=trajectory.speed, heading=float(trajectory.heading[index]),
+                           coordinates=(float(trajectory.lon[index]), float(trajectory.lat[index])))
 
-    def follow(self, octane_instance, rsu_id=None):
+    def follow(self, octane_instance, rsu_id=None, catch_up="burst", stats_filename=None, start_s=0.0):
         """
         Given the path this object represents, follow it, posting v2x messages to an OCTANE instance
-        at the proper frequency
+        at the proper frequency. While following, pause() and resume() may be called from another thread
+        (e.g. a socketio event handler.)
+
+        :param catch_up: What to do when sending falls behind schedule - see DeadlineScheduler.policies
+        :param stats_filename: If given, write the run's schedule statistics to this file as JSON
+        :param start_s: Start this far into the traversal, e.g. resume_s after a reconnect
+        :return: The ScheduleStats for the run
         """
-        if not rsu_id:
-            rsu_id = self.find_rsu(octane_instance)
+        rsu_ids = self.plan_rsus(octane_instance, rsu_id)
+        start = self.trajectory.index_at(start_s)
+        if start < len(rsu_ids):
+            print(f"Traversing a path from {start_s:.1f}s, sending {self.name}s via {self.protocol} "
+                  f"to RSU {rsu_ids[start]}")
+
+        if self.trajectory.planar_error:
+            print("Interpolated on a local tangent plane, max error {:.3g}m, {:.3g} degrees heading".format(
+                *self.trajectory.planar_error))
+
+        self._scheduler = scheduler = DeadlineScheduler(self.time_per_msg_s, catch_up)
+        batch_start, batch = 0, []
+        for index in scheduler.ticks(len(self.trajectory), start):
+            self.next_index = index + 1
+            # post the v2x message; the scheduler sleeps until it's time to post another
+            if not batch_start <= index < batch_start + len(batch):
+                batch_start, batch = index, self.encode_batch(index, index + self.batch_size)
+            data = batch[index - batch_start]
+            moving_point = self.moving_point(index)
+            if index > start and rsu_ids[index] != rsu_ids[index - 1]:
+                print(f"\nHanding off to RSU {rsu_ids[index]}")
+            print(moving_point, end="\r")
 
-        print(f"Traversing a path, sending {self.name}s via {self.protocol} to RSU {rsu_id}")
+            octane_instance.emit(f"v2x_{self.name}", {'id': rsu_ids[index], 'payload': data},
+                                 sender=self._base_params["id"])
 
-        start = time.time()
-        for moving_point in self.path():
-            # post the v2x message, then sleep until it's time to post another
-            data = self.as_message(moving_point)
-            print(moving_point, end="\r")
+        self._scheduler = None
+        print("\n")
+        print(scheduler.stats)
+        if stats_filename:
+            scheduler.stats.export(stats_filename)
+
+        return scheduler.stats
 
-            octane_instance.emit(f"v2x_{self.name}", {'id': rsu_id, 'payload': data})
+    def pause(self):
+        """
+        Hold the current follow() where it is until resume() is called
+        """
+        if self._scheduler:
+            self._scheduler.pause()
 
-            # Sleep for the remaining time. Right now if that's negative just continue
-            elapsed = time.time() - start
-            remaining = self.time_per_msg_s - elapsed
-            if remaining > 0:
-                time.sleep(remaining)
-            start = time.time()
+    def resume(self):
+        if self._scheduler:
+            self._scheduler.resume()
 
-        print("\n")
+    @property
+    def resume_s(self):
+        """
+        Time offset of the next point follow() hasn't sent yet, to pick up from with follow(start_s=...)
+        """
+        trajectory = self.trajectory
+        if self.next_index >= len(trajectory):
+            return float(trajectory.time_offset_s[-1]) + self.time_per_msg_s if len(trajectory) else 0.0
+        return float(trajectory.time_offset_s[self.next_index])
 
 
 class VehiclePathFollower(PathFollower, BSM):
@@ -306,6 +568,45 @@ class ChoosePathFollower(argparse.Action):
         setattr(namespace, self.dest, self.path_followers[values])
 
 
+def load_swarm(swarm_filename, default_speed):
+    """
+    Build a Swarm from a JSON description of its agents. Paths are relative to the swarm file, e.g.
+
+        {"agents": [
+            {"path": "highway.json", "type": "vehicle", "speed": 12, "id": "000003B7"},
+            {"path": "roundabout.json", "type": "human", "start_offset_s": 5, "count": 20, "interval_s": 1.5}
+        ]}
+
+    An agent with a count is repeated, each copy starting interval_s after the last, with IDs counting up
+    from its (hex) id. Followers on the same path, speed and type share one trajectory.
+    """
+    with open(swarm_filename) as swarm_file:
+        description = json.load(swarm_file)
+
+    base_dir = os.path.dirname(os.path.abspath(swarm_filename))
+    prototypes = {}
+    agents = []
+    for entry in description["agents"]:
+        follower_class = ChoosePathFollower.path_followers[entry.get("type", "vehicle")]
+        path_filename = os.path.join(base_dir, entry["path"])
+        speed = float(entry.get("speed", default_speed))
+
+        key = (path_filename, speed, follower_class)
+        if key not in prototypes:
+            prototypes[key] = follower_class(path_filename, speed)
+            prototypes[key].trajectory
+        prototype = prototypes[key]
+
+        first_id = int(entry.get("id", follower_class._base_params["id"]), 16)
+        for n in range(int(entry.get("count", 1))):
+            follower = copy.copy(prototype)
+            follower.set_temporary_id(f"{first_id + n:08X}")
+            start_offset_s = float(entry.get("start_offset_s", 0)) + n * float(entry.get("interval_s", 0))
+            agents.append(SwarmAgent(follower, start_offset_s, entry.get("rsu_id")))
+
+    return Swarm(agents)
+
+
 parser = argparse.ArgumentParser(description="Given a path in GeoJSON, this script will work out a linear "
                                              "traversal of them based on a model (vehicle, human, etc.) It will "
                                              "produce a set of V2X messages and insert them into OCTANE, attempting to "
@@ -313,7 +614,11 @@ parser = argparse.ArgumentParser(description="Given a path in GeoJSON, this scri
                                              "type (BSM, PSM, etc.)",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("geojson_file", metavar="geojson-file",
-                    help="Filename containing a valid GeoJSON LineString or MultiPoint to follow.")
+                    help="Filename containing a valid GeoJSON LineString or MultiPoint to follow, or with --swarm, "
+                         "a JSON swarm description.")
+parser.add_argument("--swarm", action="store_true",
+                    help="Follow many paths at once over one connection, as described by the given swarm file "
+                         "(see load_swarm)")
 parser.add_argument("-t", "--v2x-type", action=ChoosePathFollower, default=VehiclePathFollower,
                     choices=ChoosePathFollower.path_followers.keys(),
                     help="What type of path follower (and thus V2X message) should we use?")
@@ -321,13 +626,85 @@ parser.add_argument("-s", "--speed", type=Decimal, default=Decimal(5.0),
                     help="Speed to traverse path, in meters/second")
 parser.add_argument("-o", "--octane-server", default="https://octane.mvillage.um.city",
                     help="OCTANE server to use")
+parser.add_argument("-c", "--catch-up", default="burst", choices=DeadlineScheduler.policies,
+                    help="When sending falls behind schedule: burst the backlog out, drop missed messages, or "
+                         "stretch the remaining schedule")
+parser.add_argument("--schedule-stats", metavar="FILE",
+                    help="Write send rate, jitter and overrun statistics for the run to this file as JSON")
+parser.add_argument("--start-offset", type=float, default=0.0, metavar="SECONDS",
+                    help="Start this many seconds into the traversal")
+parser.add_argument("--start-distance", type=float, metavar="METERS",
+                    help="Start this far along the path (overrides --start-offset)")
+parser.add_argument("--planar-tolerance", type=float, metavar="METERS",
+                    help="Interpolate the path on a local tangent plane instead of the WGS84 ellipsoid, as long as "
+                         "the result is within this many meters (and 0.1 degrees of heading) of the exact one")
+parser.add_argument("-r", "--rsu-id",
+                    help="RSU to send messages through. By default, the first suitable RSU is found and used")
+parser.add_argument("--render", metavar="FILE",
+                    help="Don't connect to OCTANE; write every message, with when it would have been sent, to this "
+                         "file as fast as possible")
+parser.add_argument("--render-format", default="jsonl", choices=render.formats,
+                    help="File format for --render: JSON lines, or a NumPy .npy array of compact records")
+parser.add_argument("--rsu-cache-ttl", type=float, default=3600,
+                    help="How long, in seconds, to reuse the list of RSUs kept in the cache directory")
+parser.add_argument("--cache-dir", default=default_cache_dir(),
+                    help="Directory to keep compiled trajectories in between runs")
+parser.add_argument("--cache-size-mb", type=float, default=256,
+                    help="Largest the trajectory cache may grow before old entries are removed")
+parser.add_argument("--no-cache", action="store_true",
+                    help="Always compute trajectories from scratch, without reading or writing the cache")
+parser.add_argument("--outbox-size", type=int, default=10000, metavar="MESSAGES",
+                    help="Most messages to hold while the OCTANE connection is down, to send once it's back")
+parser.add_argument("--outbox-max-age", type=float, default=30.0, metavar="SECONDS",
+                    help="Don't send held messages older than this on reconnect, apart from each sender's latest")
 parser.add_argument("-a", "--auth", default="reticulatingsplines",
                     help="OCTANE authorization key to use")
-args = parser.parse_args()
-
-print(f"Running with {args.geojson_file} against octane instance at {args.octane_server}")
 
-with OctaneInstance(args.auth, args.octane_server) as octane:
-    vpf = args.v2x_type(args.geojson_file, args.speed)
-    vpf.follow(octane)
 
+def start_time(follower, start_offset_s, start_distance_m=None):
+    """
+    :return: How far into follower's traversal to start, in seconds, from --start-offset or --start-distance
+    """
+    if start_distance_m is None:
+        return start_offset_s
+    trajectory = follower.trajectory
+    return float(trajectory.time_offset_s[min(trajectory.index_at_distance(start_distance_m), len(trajectory) - 1)])
+
+
+def main():
+    args = parser.parse_args()
+
+    PathFollower.planar_tolerance_m = args.planar_tolerance
+    if not args.no_cache:
+        PathFollower.trajectory_cache = TrajectoryCache(args.cache_dir, int(args.cache_size_mb * 1024 * 1024))
+        PathFollower.rsu_catalog = RSUCatalog(args.cache_dir, args.rsu_cache_ttl)
+
+    if args.render:
+        start_s = 0.0
+        if args.swarm:
+            agents = load_swarm(args.geojson_file, args.speed).agents
+        else:
+            vpf = args.v2x_type(args.geojson_file, args.speed)
+            start_s = start_time(vpf, args.start_offset, args.start_distance)
+            agents = [SwarmAgent(vpf, rsu_id=args.rsu_id)]
+
+        start = time.perf_counter()
+        count = render.render(agents, args.render, args.render_format, start_s)
+        elapsed = time.perf_counter() - start
+        print(f"Rendered {count} messages to {args.render} in {elapsed:.3f}s")
+        return
+
+    print(f"Running with {args.geojson_file} against octane instance at {args.octane_server}")
+
+    with OctaneInstance(args.auth, args.octane_server, Outbox(args.outbox_size, args.outbox_max_age)) as octane:
+        if args.swarm:
+            load_swarm(args.geojson_file, args.speed).follow(octane)
+        else:
+            vpf = args.v2x_type(args.geojson_file, args.speed)
+            start_s = start_time(vpf, args.start_offset, args.start_distance)
+            vpf.follow(octane, rsu_id=args.rsu_id, catch_up=args.catch_up, stats_filename=args.schedule_stats,
+                       start_s=start_s)
+
+
+if __name__ == "__main__":
+    main()
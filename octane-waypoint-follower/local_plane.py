@@ -0,0 +1,148 @@
+"""
+local_plane.py
+
+A local east/north/up (ENU) tangent plane on the WGS84 ellipsoid. Across a site the size of Mcity (about a
+kilometer) straight lines on the plane are practically indistinguishable from geodesics, so paths can be
+interpolated with plain vector math instead of geodesic solutions. Use error() to check how far the points
+interpolated on the plane are from the geodesic ones before relying on them; checking an error_sample() of them
+keeps that check far cheaper than geodesic interpolation.
+"""
+import numpy as np
+from pyproj import Geod
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+WGS84_EP2 = WGS84_E2 / (1 - WGS84_E2)
+
+
+class LocalTangentPlane:
+    """
+    ENU coordinates, in meters, relative to an anchor point on the ellipsoid
+    """
+    geod = Geod(ellps="WGS84")
+
+    def __init__(self, lon, lat):
+        self.lon = float(lon)
+        self.lat = float(lat)
+        phi, lam = np.radians(self.lat), np.radians(self.lon)
+        self.origin = self._ecef(np.array([lam]), np.array([phi]))[:, 0]
+        # Rows are the east, north and up unit vectors, in ECEF
+        self.rotation = np.array([
+            [-np.sin(lam), np.cos(lam), 0.0],
+            [-np.sin(phi) * np.cos(lam), -np.sin(phi) * np.sin(lam), np.cos(phi)],
+            [np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)],
+        ])
+        self.sin_lat = float(np.sin(phi))
+
+    @classmethod
+    def for_points(cls, lon, lat):
+        """
+        A plane anchored at the centroid of some points
+        """
+        return cls(np.mean(lon), np.mean(lat))
+
+    @staticmethod
+    def _ecef(lam, phi):
+        n = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(phi) ** 2)
+        return np.vstack((n * np.cos(phi) * np.cos(lam),
+                          n * np.cos(phi) * np.sin(lam),
+                          n * (1 - WGS84_E2) * np.sin(phi)))
+
+    def to_enu(self, lon, lat):
+        """
+        :return: (east, north) in meters, for arrays of longitude and latitude on the ellipsoid
+        """
+        ecef = self._ecef(np.radians(np.asarray(lon, dtype=np.float64)), np.radians(np.asarray(lat, dtype=np.float64)))
+        east, north, _ = self.rotation @ (ecef - self.origin[:, None])
+        return east, north
+
+    def to_geodetic(self, east, north):
+        """
+        :return: (longitude, latitude) of points on the plane, dropped onto the ellipsoid
+        """
+        east = np.asarray(east, dtype=np.float64)
+        enu = np.vstack((east, np.asarray(north, dtype=np.float64), np.zeros_like(east)))
+        x, y, z = self.origin[:, None] + self.rotation.T @ enu
+        # Bowring's method, accurate to well under a millimeter near the surface
+        p = np.hypot(x, y)
+        theta = np.arctan2(z * WGS84_A, p * WGS84_B)
+        lat = np.arctan2(z + WGS84_EP2 * WGS84_B * np.sin(theta) ** 3, p - WGS84_E2 * WGS84_A * np.cos(theta) ** 3)
+        return np.degrees(np.arctan2(y, x)), np.degrees(lat)
+
+    def heading(self, lon, d_east, d_north):
+        """
+        Headings (degrees clockwise from true north) for steps of (d_east, d_north) at the given longitudes.
+        North on the plane is true north only at the anchor; elsewhere meridians converge by about
+        delta-longitude * sin(latitude), which is corrected for.
+        """
+        convergence = (np.asarray(lon) - self.lon) * self.sin_lat
+        return np.mod(np.degrees(np.arctan2(d_east, d_north)) + convergence, 360.0)
+
+    @staticmethod
+    def error_sample(east, north, span_m, size=8):
+        """
+        Pick a fixed number of interpolated points to check with error(), from where the plane strays most: distortion
+        grows with distance from the anchor, and a straight line parts most from a geodesic mid-way along a long
+        segment. A few evenly spaced points are added for coverage. The check is then the same small cost however
+        many points a path has.
+
+        :param east: Interpolated points on the plane, the first being the unsent point headings start from
+        :param north: Likewise
+        :param span_m: For each interpolated point, its distance to the nearer end of its segment
+        :param size: How many points to pick by each measure
+        :return: Sorted indices into the interpolated points, 1 onwards
+        """
+        sent = len(east) - 1
+        if sent <= 3 * size:
+            return np.arange(1, sent + 1)
+        farthest = np.argpartition(np.square(east[1:]) + np.square(north[1:]), -size)[-size:]
+        longest = np.argpartition(span_m[1:], -size)[-size:]
+        spaced = np.arange(0, sent, sent // size)
+        return np.unique(np.concatenate((farthest, longest, spaced))) + 1
+
+    def error(self, lon, lat, segment, fraction, point_lon, point_lat, heading, points=None):
+        """
+        How far points interpolated on the plane stray from geodesic interpolation of the same path. Each point
+        checked is compared with the point the same fraction of the way along the geodesic between its segment's
+        waypoints (Geod.fwd), and its heading with the azimuth to that point from the one before it (Geod.inv),
+        which is what geodesic interpolation would send.
+
+        :param lon: Waypoint longitudes
+        :param lat: Waypoint latitudes
+        :param segment: For each interpolated point, the index of the waypoint its segment starts at
+        :param fraction: For each interpolated point, how far along its segment it is (0 to 1)
+        :param point_lon: Interpolated longitudes, the first being the unsent point headings start from
+        :param point_lat: Interpolated latitudes, likewise
+        :param heading: Headings sent with the second interpolated point onwards
+        :param points: Indices of the interpolated points to check (1 onwards), e.g. from error_sample(); every
+                       point sent if None
+        :return: (max position error in meters, max heading error in degrees)
+        """
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        if len(point_lon) < 2:
+            return 0.0, 0.0
+        if points is None:
+            points = np.arange(1, len(point_lon))
+        points = np.asarray(points, dtype=np.int64)
+
+        # Each checked point and the one before it, which its heading is measured from
+        both = np.concatenate((points - 1, points))
+        starts, start = np.unique(segment[both], return_inverse=True)
+        azimuth, _, length_m = self.geod.inv(lon[starts], lat[starts], lon[starts + 1], lat[starts + 1])
+        geodesic_lon, geodesic_lat, _ = self.geod.fwd(lon[starts][start], lat[starts][start], np.asarray(azimuth)[start],
+                                                      fraction[both] * np.asarray(length_m)[start])
+        geodesic_lon, geodesic_lat = np.asarray(geodesic_lon), np.asarray(geodesic_lat)
+        at = slice(len(points), None)
+
+        # One call for both: the step to each geodesic point from the one before, and from it to the planar point
+        azimuth, _, distance_m = self.geod.inv(geodesic_lon, geodesic_lat,
+                                               np.concatenate((geodesic_lon[at], point_lon[points])),
+                                               np.concatenate((geodesic_lat[at], point_lat[points])))
+        geodesic_heading, step_m = np.asarray(azimuth)[:len(points)], np.asarray(distance_m)[:len(points)]
+        position_m = np.asarray(distance_m)[len(points):]
+        moving = step_m > 0
+        heading_error = np.abs((np.asarray(heading)[points - 1] - geodesic_heading + 180.0) % 360.0 - 180.0)
+        return (float(np.max(position_m)),
+                float(np.max(heading_error[moving])) if moving.any() else 0.0)
@@ -0,0 +1,96 @@
+"""
+message_template.py
+
+Precompiled V2X message serialization. A follower's static message fields (IDs, sizes, message set) never change
+between points, so they're JSON encoded once into a template, and only the position, speed and heading are
+spliced in per message. The result is emitted as-is: OctaneInstance gives socketio template_json, which writes
+PreEncoded values straight into the outgoing packet instead of encoding them again.
+
+Python would write a NaN or infinite field as nan or inf, which isn't JSON, so messages with one are encoded by
+json.dumps instead, which writes NaN and Infinity as JavaScript does.
+"""
+import json
+import math
+
+# Fields that change with every point, in the order they appear in a message
+DYNAMIC_FIELDS = ("longitude", "latitude", "elevation", "speed", "heading")
+
+
+class PreEncoded(str):
+    """
+    A string of JSON that should be written into an outgoing message verbatim
+    """
+    __slots__ = ()
+
+
+class MessageTemplate:
+    """
+    Encodes messages made up of DYNAMIC_FIELDS followed by a fixed set of params
+    """
+    def __init__(self, params):
+        self.params = params
+        self.static = static = {key: value for key, value in params.items() if key not in DYNAMIC_FIELDS}
+        static_json = json.dumps(static, separators=(",", ":"))[1:-1].replace("%", "%%")
+        dynamic_json = ",".join(f'"{field}":%r' for field in DYNAMIC_FIELDS)
+        self.template = "{" + dynamic_json + ("," + static_json if static_json else "") + "}"
+
+    def encode(self, longitude, latitude, elevation, speed, heading):
+        """
+        :return: The message as PreEncoded JSON
+        """
+        fields = (longitude, latitude, elevation, speed, heading)
+        if not all(map(math.isfinite, fields)):
+            return self._encode_slowly(fields)
+        return PreEncoded(self.template % fields)
+
+    def encode_batch(self, longitudes, latitudes, elevations, speeds, headings):
+        """
+        Encode a batch of messages at once, from equal length sequences of each field
+        :return: A list of PreEncoded JSON messages
+        """
+        template, isfinite = self.template, math.isfinite
+        columns = (longitudes, latitudes, elevations, speeds, headings)
+        # A column's sum is only finite if every value in it is, so usually there's no need to check each message
+        if all(isfinite(sum(column)) for column in columns):
+            return [PreEncoded(template % fields) for fields in zip(*columns)]
+        return [PreEncoded(template % fields) if all(map(isfinite, fields)) else self._encode_slowly(fields)
+                for fields in zip(*columns)]
+
+    def _encode_slowly(self, fields):
+        # Same fields in the same order as the template
+        return PreEncoded(json.dumps(dict(zip(DYNAMIC_FIELDS, fields), **self.static), separators=(",", ":")))
+
+
+def _encode(obj, separators):
+    if isinstance(obj, PreEncoded):
+        return obj
+    if isinstance(obj, dict):
+        item, key = separators
+        return "{" + item.join(json.dumps(str(k)) + key + _encode(v, separators) for k, v in obj.items()) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + separators[0].join(_encode(v, separators) for v in obj) + "]"
+    return json.dumps(obj, separators=separators)
+
+
+def _contains_pre_encoded(obj):
+    if isinstance(obj, PreEncoded):
+        return True
+    if isinstance(obj, dict):
+        return any(_contains_pre_encoded(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_contains_pre_encoded(v) for v in obj)
+    return False
+
+
+class template_json:
+    """
+    Stands in for the json module in socketio (which only needs dumps and loads), passing PreEncoded values
+    through untouched
+    """
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def dumps(obj, separators=(", ", ": "), **kwargs):
+        if not _contains_pre_encoded(obj):
+            return json.dumps(obj, separators=separators, **kwargs)
+        return _encode(obj, separators)
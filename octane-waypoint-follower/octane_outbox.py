@@ -0,0 +1,123 @@
+"""
+octane_outbox.py
+
+Store-and-forward for messages sent while the OCTANE connection is down. Messages are held in a bounded buffer
+(the oldest are dropped once it's full) and sent in batches once the connection is back, so a short Wi-Fi dropout
+doesn't leave a gap in what OCTANE records. Also the backoff used to reconnect.
+
+Used by every client in the repo that reconnects: python-v2x-multi-sockets.py, the waypoint follower
+(octane-waypoint-follower/follow-path.py) and the beacon publishers (proxy-integration/system-proxy/utils.py). The
+last two are installed and run on their own, so each of those directories carries its own copy of this file; keep
+the three identical. Outbox is synchronous and thread-safe; asyncio clients send what it holds with their own loop
+over take() and requeue().
+
+When the buffer is flushed, messages older than max_age_s are dropped as no longer worth sending, except the latest
+one from each sender, which is always kept so every sender's last known state gets through.
+"""
+import random
+import threading
+import time
+from collections import deque
+
+
+def backoff_delays(min_s=1.0, max_s=30.0):
+    """
+    Exponential backoff for reconnecting: min_s, doubling each time up to max_s, each randomized by up to half
+    so a fleet of clients dropped at once doesn't reconnect in lockstep
+    """
+    delay_s = min_s
+    while True:
+        yield delay_s * random.uniform(0.5, 1.0)
+        delay_s = min(delay_s * 2, max_s)
+
+
+class Outbox:
+    """
+    A bounded buffer of (event, payload) messages waiting to be sent. Safe to use from several threads.
+
+    :param max_messages: Most messages held; past that the oldest are dropped
+    :param max_age_s: On flush, drop messages held longer than this, apart from each sender's latest
+    """
+    def __init__(self, max_messages=10000, max_age_s=30.0, clock=time.monotonic):
+        self.max_age_s = max_age_s
+        self.clock = clock
+        # (held since, event, payload, sender)
+        self._messages = deque(maxlen=max_messages)
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.held = 0
+        self.overflowed = 0
+        self.expired = 0
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, event, payload, sender=None):
+        """
+        :param sender: Who the message is from, e.g. a vehicle's ID; the latest message from each sender is never
+                       expired. None groups the message with all others from no particular sender.
+        """
+        with self._lock:
+            if len(self._messages) == self._messages.maxlen:
+                self.overflowed += 1
+            self._messages.append((self.clock(), event, payload, sender))
+            self.held += 1
+
+    def expire(self):
+        """
+        Drop messages older than max_age_s, keeping the latest for each (event, sender)
+        :return: How many were dropped
+        """
+        with self._lock:
+            oldest_s = self.clock() - self.max_age_s
+            latest = {(event, sender): index for index, (_, event, _, sender) in enumerate(self._messages)}
+            kept = [message for index, message in enumerate(self._messages)
+                    if message[0] >= oldest_s or latest[message[1], message[3]] == index]
+            expired = len(self._messages) - len(kept)
+            self._messages.clear()
+            self._messages.extend(kept)
+            self.expired += expired
+        return expired
+
+    def take(self, limit):
+        """
+        Remove and return up to limit messages, oldest first
+        """
+        with self._lock:
+            return [self._messages.popleft() for _ in range(min(limit, len(self._messages)))]
+
+    def requeue(self, messages):
+        """
+        Put messages from take() that couldn't be sent back at the front, in order
+        """
+        with self._lock:
+            # If the outbox filled up in the meantime, this pushes the newest messages out
+            self.overflowed += max(0, len(self._messages) + len(messages) - self._messages.maxlen)
+            self._messages.extendleft(reversed(messages))
+
+    def flush(self, send, batch_size=100):
+        """
+        Expire stale messages, then send the rest in batches with send(event, payload). If send fails, what's left
+        goes back into the outbox and the error is raised.
+        :return: How many messages were sent
+        """
+        self.expire()
+        sent = 0
+        while True:
+            batch = self.take(batch_size)
+            if not batch:
+                return sent
+            for index, (_, event, payload, _) in enumerate(batch):
+                try:
+                    send(event, payload)
+                except Exception:
+                    self.requeue(batch[index:])
+                    raise
+                sent += 1
+                self.sent += 1
+
+    def report(self):
+        return (f"Outbox: {self.held} held while disconnected, {self.sent} sent on reconnect, {self.expired} too old "
+                f"to send, {self.overflowed} dropped when full, {len(self)} waiting")
@@ -0,0 +1,106 @@
+"""
+render.py
+
+Offline rendering of path follower message streams. Instead of emitting to OCTANE in real time, every message
+that would have been sent is written out along with when it would have been sent (seconds from the start of
+the run), as fast as it can be produced. Useful for pre-rendering scenarios for regression suites, and for
+timing message generation without any network I/O.
+
+Two formats are supported:
+    jsonl  - one {"t", "channel", "id", "payload"} object per line, payload exactly as it would be emitted; "id" is
+             the RSU sent through, and left out when there isn't one
+    binary - a NumPy .npy file of RECORD_DTYPE records, loadable with numpy.load
+
+Like a live run, rendering can start partway into each traversal (start_s): earlier points are skipped, and the
+first message rendered goes out at the agent's start offset.
+"""
+import heapq
+
+import numpy as np
+
+from message_template import template_json
+
+RECORD_DTYPE = np.dtype([
+    ("t", "<f8"),
+    ("id", "S8"),
+    ("longitude", "<f8"),
+    ("latitude", "<f8"),
+    ("speed", "<f4"),
+    ("heading", "<f4"),
+])
+
+formats = ("jsonl", "binary")
+
+
+def _send_times(agent, start):
+    """
+    When each point from start on would be sent, relative to the start of the run
+    """
+    time_offset_s = agent.follower.trajectory.time_offset_s[start:]
+    return agent.start_offset_s + (time_offset_s - time_offset_s[0] if len(time_offset_s) else time_offset_s)
+
+
+def _agent_messages(agent, start_s):
+    follower = agent.follower
+    channel = f"v2x_{follower.name}"
+    start = follower.trajectory.index_at(start_s)
+    times = _send_times(agent, start).tolist()
+    payloads = follower.encode_batch(start, start + len(times))
+    rsu_ids = agent.rsu_ids[start:] if agent.rsu_ids else [agent.rsu_id] * len(times)
+    return zip(times, (channel,) * len(times), rsu_ids, payloads)
+
+
+def render_jsonl(agents, output_file, start_s=0.0):
+    """
+    Write every agent's messages, merged in send order, as JSON lines
+    :return: Number of messages written
+    """
+    count = 0
+    for t, channel, rsu_id, payload in heapq.merge(*(_agent_messages(agent, start_s) for agent in agents),
+                                                   key=lambda message: message[0]):
+        message = {"t": t, "channel": channel, "payload": payload}
+        if rsu_id is not None:
+            message["id"] = rsu_id
+        output_file.write(template_json.dumps(message))
+        output_file.write("\n")
+        count += 1
+    return count
+
+
+def render_binary(agents, output_file, start_s=0.0):
+    """
+    Write every agent's messages, sorted by send time, as an array of RECORD_DTYPE
+    :return: Number of messages written
+    """
+    parts = []
+    for agent in agents:
+        follower = agent.follower
+        trajectory = follower.trajectory
+        start = trajectory.index_at(start_s)
+        records = np.empty(len(trajectory) - start, dtype=RECORD_DTYPE)
+        records["t"] = _send_times(agent, start)
+        records["id"] = follower._base_params["id"]
+        # Same precision as the coordinates of the MovingPoints that as_message() is given
+        records["longitude"] = np.round(trajectory.lon[start:], 6)
+        records["latitude"] = np.round(trajectory.lat[start:], 6)
+        records["speed"] = trajectory.speed
+        records["heading"] = trajectory.heading[start:]
+        parts.append(records)
+
+    records = np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_DTYPE)
+    records = records[np.argsort(records["t"], kind="stable")]
+    np.save(output_file, records)
+    return len(records)
+
+
+def render(agents, filename, output_format="jsonl", start_s=0.0):
+    """
+    Render the messages for a list of SwarmAgents to a file
+
+    :param start_s: Start this far into each agent's traversal, as PathFollower.follow does
+    """
+    if output_format == "binary":
+        with open(filename, "wb") as output_file:
+            return render_binary(agents, output_file, start_s)
+    with open(filename, "w") as output_file:
+        return render_jsonl(agents, output_file, start_s)
@@ -0,0 +1,211 @@
+"""
+rsu_catalog.py
+
+RSU lookup for the waypoint follower. The RSU list from OCTANE's /v2x/rsus is cached on local disk for a while
+so that every run doesn't start with a blocking request, and RSU locations are put in a grid index so the
+follower can send each stretch of its path through the nearest RSU that supports its message type, handing off
+between RSUs as the path moves.
+"""
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def rsu_position(rsu):
+    """
+    :return: (longitude, latitude) of an RSU, or None if it doesn't say where it is
+    """
+    location = rsu.get("location") or rsu
+    if isinstance(location, dict):
+        if "coordinates" in location:
+            return tuple(location["coordinates"][:2])
+        longitude = location.get("longitude", location.get("lng", location.get("lon")))
+        latitude = location.get("latitude", location.get("lat"))
+        if longitude is not None and latitude is not None:
+            return float(longitude), float(latitude)
+    return None
+
+
+def rsu_supports(rsu, protocol, message_type):
+    """
+    Whether an RSU can transmit a given message type
+    """
+    for radio in rsu.get("radiosSupported") or []:
+        if radio["messageSet"] == protocol and radio["messageType"] == message_type and radio["txEnabled"]:
+            return True
+    return False
+
+
+class RSUCatalog:
+    """
+    The RSUs known to an OCTANE instance. With a directory, the list is kept on disk and only fetched again
+    once it's older than ttl_s; without one it's kept in memory for the life of the catalog.
+    """
+    def __init__(self, directory=None, ttl_s=3600):
+        self.directory = directory
+        self.ttl_s = ttl_s
+        self._rsus = {}
+
+    def _filename(self, octane_instance):
+        server = hashlib.sha256(octane_instance.api_server.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"rsus-{server}.json")
+
+    def rsus(self, octane_instance):
+        """
+        :return: The list of RSUs known to this OCTANE instance
+        """
+        server = octane_instance.api_server
+        if server in self._rsus:
+            return self._rsus[server]
+
+        filename = self._filename(octane_instance) if self.directory else None
+        if filename and os.path.exists(filename) and time.time() - os.path.getmtime(filename) < self.ttl_s:
+            with open(filename) as rsu_file:
+                self._rsus[server] = json.load(rsu_file)
+            return self._rsus[server]
+
+        response = octane_instance.get("/v2x/rsus")
+        response.raise_for_status()
+        self._rsus[server] = response.json().get("rsus", [])
+
+        if filename:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename + ".tmp", "w") as rsu_file:
+                json.dump(self._rsus[server], rsu_file)
+            os.replace(filename + ".tmp", filename)
+        return self._rsus[server]
+
+    def capable(self, octane_instance, protocol, message_type):
+        return [rsu for rsu in self.rsus(octane_instance) if rsu_supports(rsu, protocol, message_type)]
+
+    def index(self, octane_instance, protocol, message_type):
+        """
+        :return: An RSUIndex of the located RSUs that can transmit this message type
+        """
+        return RSUIndex(self.capable(octane_instance, protocol, message_type))
+
+
+class RSUIndex:
+    """
+    A uniform grid over RSU locations, on a local equirectangular projection (plenty accurate at facility scale)
+    """
+    def __init__(self, rsus, cell_m=250.0):
+        self.cell_m = cell_m
+        self.rsus = []
+        positions = []
+        for rsu in rsus:
+            position = rsu_position(rsu)
+            if position is not None:
+                self.rsus.append(rsu)
+                positions.append(position)
+
+        self.cells = {}
+        self._numbers = {id(rsu): number for number, rsu in enumerate(self.rsus)}
+        if not positions:
+            self.origin = (0.0, 0.0)
+            self.xy = np.empty((0, 2))
+            return
+
+        positions = np.asarray(positions, dtype=np.float64)
+        self.origin = tuple(positions.mean(axis=0))
+        self.xy = self.project(positions[:, 0], positions[:, 1])
+        for number, (x, y) in enumerate(self.xy):
+            self.cells.setdefault(self._cell(x, y), []).append(number)
+
+    def __len__(self):
+        return len(self.rsus)
+
+    def project(self, lon, lat):
+        lon0, lat0 = self.origin
+        x = np.radians(np.asarray(lon) - lon0) * EARTH_RADIUS_M * math.cos(math.radians(lat0))
+        y = np.radians(np.asarray(lat) - lat0) * EARTH_RADIUS_M
+        return np.column_stack((x, y))
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_m)), int(math.floor(y / self.cell_m))
+
+    def nearest(self, lon, lat, max_range_m=math.inf):
+        """
+        :return: (rsu, distance in meters) of the nearest RSU within range, or (None, inf)
+        """
+        if not self.rsus:
+            return None, math.inf
+
+        (x, y), = self.project([lon], [lat])
+        cx, cy = self._cell(x, y)
+        best, best_m = None, math.inf
+        # Search outwards ring by ring; once a ring's inner edge is further than the best match, stop
+        ring = 0
+        rings = max(max(abs(i - cx), abs(j - cy)) for i, j in self.cells)
+        while ring <= rings:
+            if (ring - 1) * self.cell_m > min(best_m, max_range_m):
+                break
+            for i in range(cx - ring, cx + ring + 1):
+                for j in range(cy - ring, cy + ring + 1):
+                    if max(abs(i - cx), abs(j - cy)) != ring:
+                        continue
+                    for number in self.cells.get((i, j), ()):
+                        distance_m = math.hypot(self.xy[number][0] - x, self.xy[number][1] - y)
+                        if distance_m < best_m:
+                            best, best_m = self.rsus[number], distance_m
+            ring += 1
+
+        if best_m > max_range_m:
+            return None, math.inf
+        return best, best_m
+
+    def plan(self, trajectory, handoff_interval_m=50.0, max_range_m=math.inf, hysteresis_m=25.0):
+        """
+        Choose an RSU for every point of a trajectory. The path is taken in stretches of handoff_interval_m, and
+        each stretch goes through the nearest RSU to its midpoint. To avoid flapping between two RSUs at a
+        similar distance, the current RSU is kept unless another is closer by more than hysteresis_m (or the
+        current one is out of range.)
+
+        :return: A list of (first trajectory index, RSU id) handoffs, in order
+        """
+        if not len(trajectory) or not self.rsus:
+            return []
+
+        distance_m = np.asarray(trajectory.distance_m)
+        boundaries = np.arange(distance_m[0], distance_m[-1], handoff_interval_m) if len(distance_m) > 1 \
+            else distance_m[:1]
+        starts = np.searchsorted(distance_m, boundaries)
+        stops = np.append(starts[1:], len(distance_m))
+
+        handoffs = []
+        current = None
+        for start, stop in zip(starts, stops):
+            if start >= stop:
+                continue
+            middle = (start + stop - 1) // 2
+            lon, lat = float(trajectory.lon[middle]), float(trajectory.lat[middle])
+            rsu, rsu_m = self.nearest(lon, lat, max_range_m)
+            if rsu is None:
+                continue
+            if current is not None and rsu is not current:
+                (x, y), = self.project([lon], [lat])
+                current_x, current_y = self.xy[self._numbers[id(current)]]
+                current_m = math.hypot(current_x - x, current_y - y)
+                if current_m <= max_range_m and current_m - rsu_m <= hysteresis_m:
+                    continue
+            if rsu is not current:
+                handoffs.append((int(start) if handoffs else 0, rsu["id"]))
+                current = rsu
+        return handoffs
+
+
+def expand_handoffs(handoffs, count):
+    """
+    Turn a list of (first index, RSU id) handoffs into the RSU id for each of count points
+    """
+    rsu_ids = [None] * count
+    for number, (start, rsu_id) in enumerate(handoffs):
+        stop = handoffs[number + 1][0] if number + 1 < len(handoffs) else count
+        rsu_ids[start:stop] = [rsu_id] * (stop - start)
+    return rsu_ids
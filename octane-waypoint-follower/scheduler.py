@@ -0,0 +1,146 @@
+"""
+scheduler.py
+
+Drift-free send scheduling for the waypoint follower. Messages are sent against absolute deadlines on a
+monotonic clock (first message + n * period), so time spent building and emitting a message doesn't
+accumulate and slow the stream below its nominal rate.
+"""
+import json
+import math
+import threading
+import time
+
+
+class ScheduleStats:
+    """
+    Keeps track of how closely a run kept to its schedule. Lateness is how long after its deadline
+    each message actually went out.
+    """
+    def __init__(self, period_s, policy):
+        self.period_s = period_s
+        self.policy = policy
+        self.lateness_s = []
+        self.overruns = 0
+        self.dropped = 0
+        self.stretched_s = 0.0
+        self.paused_s = 0.0
+        self.started = None
+        self.finished = None
+
+    def record(self, lateness_s):
+        self.lateness_s.append(lateness_s)
+
+    def summary(self):
+        sent = len(self.lateness_s)
+        elapsed = (self.finished - self.started - self.paused_s) if sent and self.finished else 0.0
+        ordered = sorted(self.lateness_s)
+
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+        return {
+            "policy": self.policy,
+            "target_hz": 1.0 / self.period_s,
+            # n messages span n - 1 periods
+            "achieved_hz": (sent - 1) / elapsed if elapsed > 0 else 0.0,
+            "sent": sent,
+            "dropped": self.dropped,
+            "overruns": self.overruns,
+            "stretched_s": self.stretched_s,
+            "paused_s": self.paused_s,
+            "elapsed_s": elapsed,
+            "lateness_mean_ms": 1000 * sum(ordered) / sent if sent else 0.0,
+            "lateness_p50_ms": 1000 * percentile(50),
+            "lateness_p99_ms": 1000 * percentile(99),
+            "lateness_max_ms": 1000 * (ordered[-1] if ordered else 0.0),
+        }
+
+    def __str__(self):
+        s = self.summary()
+        return (f"Sent {s['sent']} at {s['achieved_hz']:.3f}Hz (target {s['target_hz']:.3f}Hz, {s['policy']}): "
+                f"lateness p50 {s['lateness_p50_ms']:.2f}ms, p99 {s['lateness_p99_ms']:.2f}ms, "
+                f"max {s['lateness_max_ms']:.2f}ms, {s['overruns']} overruns, {s['dropped']} dropped, "
+                f"stretched {s['stretched_s']:.3f}s")
+
+    def export(self, filename):
+        with open(filename, "w") as stats_file:
+            json.dump(self.summary(), stats_file, indent=2)
+
+
+class DeadlineScheduler:
+    """
+    Paces a run of messages at a fixed period against absolute deadlines. When a message goes out a
+    full period or more late, the policy decides how to recover:
+
+        burst   - keep the original deadlines and send the backlog back to back until caught up
+        drop    - skip the messages whose slots have already passed, and carry on from the current one
+        stretch - shift every remaining deadline back by the overrun; nothing is lost, the run takes longer
+
+    A run can be paused and resumed from another thread; time spent paused shifts the remaining deadlines back.
+    """
+    policies = ("burst", "drop", "stretch")
+
+    def __init__(self, period_s, policy="burst", clock=time.monotonic, sleep=time.sleep):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown catch-up policy {policy}, expected one of {', '.join(self.policies)}")
+        self.period_s = period_s
+        self.policy = policy
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = ScheduleStats(period_s, policy)
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        """
+        Stop yielding ticks until resume() is called. Takes effect at the next tick.
+        """
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def ticks(self, count, start=0):
+        """
+        Yields indices in [start, count) as each one falls due, sleeping in between.
+        """
+        stats = self.stats
+        origin = self.clock()
+        stats.started = origin
+        index = start
+        while index < count:
+            if not self._running.is_set():
+                paused_at = self.clock()
+                self._running.wait()
+                paused_s = self.clock() - paused_at
+                origin += paused_s
+                stats.paused_s += paused_s
+
+            deadline = origin + (index - start) * self.period_s
+            now = self.clock()
+            if now < deadline:
+                self.sleep(deadline - now)
+                now = self.clock()
+
+            lateness = now - deadline
+            if lateness >= self.period_s:
+                stats.overruns += 1
+                if self.policy == "drop":
+                    skipped = min(int(lateness // self.period_s), count - 1 - index)
+                    stats.dropped += skipped
+                    index += skipped
+                    lateness -= skipped * self.period_s
+                elif self.policy == "stretch":
+                    origin += lateness
+                    stats.stretched_s += lateness
+
+            stats.record(lateness)
+            stats.finished = now
+            yield index
+            index += 1
@@ -0,0 +1,119 @@
+"""
+swarm.py
+
+Drives many path followers at once over a single OCTANE connection. Every follower's next send time sits in
+one priority queue of deadlines; a single loop pops whichever is due next, emits its message, and queues
+that follower's following message. Deadlines are absolute (start offset + n * period), as in
+DeadlineScheduler, so a slow emit delays but never drifts the swarm.
+"""
+import heapq
+import time
+
+from scheduler import ScheduleStats
+
+
+class SwarmAgent:
+    """
+    One member of a swarm: a path follower, when it should start relative to the swarm, and which RSU it
+    should send through (planned along its path if not given.)
+    """
+    def __init__(self, follower, start_offset_s=0.0, rsu_id=None):
+        self.follower = follower
+        self.start_offset_s = float(start_offset_s)
+        self.rsu_id = rsu_id
+        self.rsu_ids = None
+        self.stats = ScheduleStats(follower.time_per_msg_s, "burst")
+        # The follower's messages encoded ahead, batch_size at a time, from trajectory index _batch_start
+        self._batch_start = 0
+        self._batch = []
+
+    def payload(self, index):
+        """
+        :return: The encoded message for trajectory point index, as follower.encode_batch gives it
+        """
+        if not self._batch_start <= index < self._batch_start + len(self._batch):
+            self._batch_start = index
+            self._batch = self.follower.encode_batch(index, index + self.follower.batch_size)
+        return self._batch[index - self._batch_start]
+
+    def __str__(self):
+        return f"{type(self.follower).__name__} {self.follower._base_params.get('id')} +{self.start_offset_s:.1f}s"
+
+
+class Swarm:
+    """
+    A set of SwarmAgents that are followed together.
+    """
+    def __init__(self, agents, clock=time.monotonic, sleep=time.sleep):
+        self.agents = list(agents)
+        self.clock = clock
+        self.sleep = sleep
+
+    def assign_rsus(self, octane_instance):
+        """
+        Plan which RSUs every agent sends through. Agents sharing a trajectory and message type share a plan.
+        """
+        plans = {}
+        for agent in self.agents:
+            follower = agent.follower
+            key = (id(follower.trajectory), follower.protocol, follower.name, agent.rsu_id)
+            if key not in plans:
+                plans[key] = follower.plan_rsus(octane_instance, agent.rsu_id)
+            agent.rsu_ids = plans[key]
+
+    def follow(self, octane_instance):
+        """
+        Follow every agent's path, posting their v2x messages to an OCTANE instance as each falls due
+        """
+        self.assign_rsus(octane_instance)
+        print(f"Traversing {len(self.agents)} paths as a swarm")
+
+        # Entries are (seconds from swarm start, agent number, trajectory index)
+        queue = [(agent.start_offset_s, number, 0)
+                 for number, agent in enumerate(self.agents) if len(agent.follower.trajectory)]
+        heapq.heapify(queue)
+
+        origin = self.clock()
+        sent = 0
+        while queue:
+            offset_s, number, index = queue[0]
+            deadline = origin + offset_s
+            now = self.clock()
+            if now < deadline:
+                self.sleep(deadline - now)
+                now = self.clock()
+
+            agent = self.agents[number]
+            follower = agent.follower
+            stats = agent.stats
+            if stats.started is None:
+                stats.started = now
+            lateness = now - deadline
+            if lateness >= stats.period_s:
+                stats.overruns += 1
+            stats.record(lateness)
+            stats.finished = now
+
+            octane_instance.emit(f"v2x_{follower.name}", {'id': agent.rsu_ids[index], 'payload': agent.payload(index)},
+                                 sender=follower._base_params["id"])
+            sent += 1
+
+            index += 1
+            if index < len(follower.trajectory):
+                heapq.heapreplace(queue, (agent.start_offset_s + index * follower.time_per_msg_s, number, index))
+            else:
+                heapq.heappop(queue)
+
+            if sent % 100 == 0:
+                print(f"Sent {sent} messages, {len(queue)} agents active", end="\r")
+
+        print("\n")
+        self.print_summary()
+
+    def print_summary(self):
+        worst = max(self.agents, key=lambda agent: max(agent.stats.lateness_s, default=0.0), default=None)
+        total = sum(len(agent.stats.lateness_s) for agent in self.agents)
+        overruns = sum(agent.stats.overruns for agent in self.agents)
+        print(f"Swarm of {len(self.agents)} sent {total} messages with {overruns} overruns")
+        if worst is not None:
+            print(f"Worst schedule kept by {worst}: {worst.stats}")
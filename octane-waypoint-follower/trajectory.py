@@ -0,0 +1,189 @@
+"""
+trajectory.py
+
+Batch trajectory computation for the waypoint follower. Rather than walking a path point by point
+while messages are being sent, the whole traversal is worked out up front as a set of NumPy arrays
+(longitude, latitude, heading, distance along the path, and time offset from the start.) Senders then
+only need to index into those arrays.
+"""
+import numpy as np
+from pyproj import Geod
+
+from local_plane import LocalTangentPlane
+
+
+class Trajectory:
+    """
+    A precomputed traversal of a path at a constant speed and message frequency.
+
+    Every array has one entry per message to be sent, in send order:
+        lon, lat        - position, in degrees
+        heading         - degrees clockwise from north, [0, 360)
+        distance_m      - distance along the path from its first waypoint, in meters
+        time_offset_s   - when the message should go out, relative to the first message
+
+    planar_error is the (position meters, heading degrees) error of the local tangent plane the trajectory was
+    interpolated on, or None if it was worked out geodesically.
+    """
+    geod = Geod(ellps="WGS84")
+    # Below this many points, geodesic interpolation costs no more than planar interpolation and its error check
+    planar_min_points = 500
+
+    def __init__(self, lon, lat, heading, distance_m, time_offset_s, speed, planar_error=None):
+        self.lon = lon
+        self.lat = lat
+        self.heading = heading
+        self.distance_m = distance_m
+        self.time_offset_s = time_offset_s
+        self.speed = speed
+        self.planar_error = planar_error
+
+    def __len__(self):
+        return len(self.lon)
+
+    def __str__(self):
+        duration = self.time_offset_s[-1] if len(self) else 0
+        return f"Trajectory: {len(self)} points, {self.length_m:.1f}m, {duration:.1f}s"
+
+    @property
+    def length_m(self):
+        return float(self.distance_m[-1]) if len(self) else 0.0
+
+    def index_at(self, time_offset_s):
+        """
+        :return: Index of the first point sent at or after time_offset_s
+        """
+        return min(int(np.searchsorted(self.time_offset_s, time_offset_s, side="left")), len(self))
+
+    def index_at_distance(self, distance_m):
+        """
+        :return: Index of the first point at or beyond distance_m along the path
+        """
+        return min(int(np.searchsorted(self.distance_m, distance_m, side="left")), len(self))
+
+    def position_at(self, time_offset_s):
+        """
+        Where the traversal is at a given time, interpolating between points
+        :return: (longitude, latitude, heading)
+        """
+        return self._interpolate(self.time_offset_s, time_offset_s)
+
+    def position_at_distance(self, distance_m):
+        """
+        Where the traversal is at a given distance along the path, interpolating between points
+        :return: (longitude, latitude, heading)
+        """
+        return self._interpolate(self.distance_m, distance_m)
+
+    def _interpolate(self, along, value):
+        if not len(self):
+            raise ValueError("Can't find a position on an empty trajectory")
+        if len(self) == 1:
+            return float(self.lon[0]), float(self.lat[0]), float(self.heading[0])
+
+        # Points are at most a frequency interval apart, so a straight line between them is plenty accurate
+        i = min(max(int(np.searchsorted(along, value, side="right")), 1), len(self) - 1)
+        fraction = min(max((value - along[i - 1]) / ((along[i] - along[i - 1]) or 1.0), 0.0), 1.0)
+        return (float(self.lon[i - 1] + fraction * (self.lon[i] - self.lon[i - 1])),
+                float(self.lat[i - 1] + fraction * (self.lat[i] - self.lat[i - 1])),
+                float(self.heading[i]))
+
+    @classmethod
+    def from_waypoints(cls, waypoints, speed, frequency_hz, planar_tolerance_m=None, planar_tolerance_deg=0.1):
+        """
+        Interpolate a list of waypoints into a trajectory.
+
+        Each segment between two waypoints is split into enough equally spaced points to satisfy the
+        message frequency at the given speed, rounding the count up (which underreports velocity
+        slightly.) Waypoints themselves aren't emitted, and the first interpolated point is only used
+        to work out the heading of the second, matching what PathFollower has always sent.
+
+        :param waypoints: A sequence of (longitude, latitude[, elevation]) coordinates
+        :param speed: Traversal speed in meters/sec
+        :param frequency_hz: Messages per second
+        :param planar_tolerance_m: If given, interpolate on a local tangent plane instead of geodesically,
+                                   as long as the points sent are within this many meters (and
+                                   planar_tolerance_deg degrees of heading) of the geodesic result. Paths
+                                   too short to gain from it (see planar_min_points) stay geodesic.
+        :return: A Trajectory
+        """
+        coords = np.asarray([waypoint[:2] for waypoint in waypoints], dtype=np.float64).reshape(-1, 2)
+        if len(coords) < 2:
+            return cls.empty(speed)
+
+        lons, lats = coords[:, 0], coords[:, 1]
+        if planar_tolerance_m is not None and cls._rough_count(lons, lats, speed, frequency_hz) >= cls.planar_min_points:
+            planar = cls._from_waypoints_planar(LocalTangentPlane.for_points(lons, lats), lons, lats, speed,
+                                                frequency_hz)
+            if planar.planar_error is not None:
+                position_error_m, heading_error_deg = planar.planar_error
+                if position_error_m <= planar_tolerance_m and heading_error_deg <= planar_tolerance_deg:
+                    return planar
+
+        azimuth, _, segment_m = cls.geod.inv(lons[:-1], lats[:-1], lons[1:], lats[1:])
+        segment_m = np.asarray(segment_m, dtype=np.float64)
+        counts = np.ceil(segment_m / speed * frequency_hz).astype(np.int64)
+        total = int(counts.sum())
+        if total < 2:
+            return cls.empty(speed)
+
+        # Every interpolated point is the k-th of n equally spaced points between the two waypoints
+        # of its segment, so they can all be solved in a single forward geodesic call.
+        segment = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        offset_m = k * (segment_m[segment] / (counts[segment] + 1))
+        point_lon, point_lat, _ = cls.geod.fwd(lons[segment], lats[segment],
+                                               np.asarray(azimuth)[segment], offset_m)
+        point_lon = np.asarray(point_lon, dtype=np.float64)
+        point_lat = np.asarray(point_lat, dtype=np.float64)
+
+        heading, _, _ = cls.geod.inv(point_lon[:-1], point_lat[:-1], point_lon[1:], point_lat[1:])
+        heading = np.mod(np.asarray(heading, dtype=np.float64), 360.0)
+
+        distance_m = (np.concatenate(([0.0], np.cumsum(segment_m)[:-1]))[segment] + offset_m)[1:]
+        time_offset_s = np.arange(total - 1, dtype=np.float64) / frequency_hz
+
+        return cls(point_lon[1:], point_lat[1:], heading, distance_m, time_offset_s, float(speed))
+
+    @staticmethod
+    def _rough_count(lons, lats, speed, frequency_hz):
+        """
+        About how many points a path will be interpolated into, measuring it on a flat earth
+        """
+        length_m = np.hypot(np.diff(lats), np.diff(lons) * np.cos(np.radians(lats[0]))).sum() * 111320
+        return length_m / speed * frequency_hz
+
+    @classmethod
+    def _from_waypoints_planar(cls, plane, lons, lats, speed, frequency_hz):
+        """
+        The same interpolation as from_waypoints, with straight lines on a LocalTangentPlane standing in
+        for geodesics. The trajectory's planar_error is measured at a fixed size sample of the points it sends,
+        picked from where the plane strays most (see LocalTangentPlane.error_sample.)
+        """
+        east, north = plane.to_enu(lons, lats)
+        segment_m = np.hypot(np.diff(east), np.diff(north))
+        counts = np.ceil(segment_m / speed * frequency_hz).astype(np.int64)
+        total = int(counts.sum())
+        if total < 2:
+            return cls.empty(speed)
+
+        segment = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        fraction = k / (counts[segment] + 1)
+        point_east = east[segment] + fraction * (east[segment + 1] - east[segment])
+        point_north = north[segment] + fraction * (north[segment + 1] - north[segment])
+        point_lon, point_lat = plane.to_geodetic(point_east, point_north)
+
+        heading = plane.heading(point_lon[1:], np.diff(point_east), np.diff(point_north))
+        span_m = np.minimum(fraction, 1 - fraction) * segment_m[segment]
+        planar_error = plane.error(lons, lats, segment, fraction, point_lon, point_lat, heading,
+                                   plane.error_sample(point_east, point_north, span_m))
+        distance_m = (np.concatenate(([0.0], np.cumsum(segment_m)[:-1]))[segment] + fraction * segment_m[segment])[1:]
+        time_offset_s = np.arange(total - 1, dtype=np.float64) / frequency_hz
+
+        return cls(point_lon[1:], point_lat[1:], heading, distance_m, time_offset_s, float(speed), planar_error)
+
+    @classmethod
+    def empty(cls, speed=0.0):
+        nothing = np.empty(0, dtype=np.float64)
+        return cls(nothing, nothing, nothing, nothing, nothing, float(speed))
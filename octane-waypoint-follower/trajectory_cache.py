@@ -0,0 +1,120 @@
+"""
+trajectory_cache.py
+
+Keeps compiled trajectories on disk so repeated runs of the same path don't redo any geodesic work. Each
+trajectory is stored as a single .npy array and memory-mapped back in, keyed by a hash of the GeoJSON content,
+speed, message frequency, follower class and planar interpolation tolerances. The array's first column holds the
+trajectory's planar_error (NaN if it was worked out geodesically), the rest its points. Once the cache grows past
+its size cap, the least recently used entries are removed.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from trajectory import Trajectory
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "octane-waypoint-follower")
+
+
+class TrajectoryCache:
+    """
+    A directory of compiled trajectories, capped at max_bytes
+    """
+    # Bump when the layout of stored trajectories (or how they're computed) changes
+    version = 2
+    suffix = ".npy"
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, geojson_digest, speed, frequency_hz, follower_name, planar_tolerance_m=None,
+            planar_tolerance_deg=None):
+        """
+        :param geojson_digest: sha256 hex digest of the GeoJSON file's content
+        :param planar_tolerance_m: As passed to Trajectory.from_waypoints; None for geodesic only
+        :param planar_tolerance_deg: As passed to Trajectory.from_waypoints
+        :return: The name under which the matching trajectory is cached
+        """
+        if planar_tolerance_m is None:
+            planar = "geodesic"
+        else:
+            planar = f"planar {float(planar_tolerance_m)!r} {float(planar_tolerance_deg)!r}"
+        parts = (f"v{self.version}:{geojson_digest}:{float(speed)!r}:{float(frequency_hz)!r}:{follower_name}:"
+                 f"{planar}")
+        return hashlib.sha256(parts.encode()).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key, speed):
+        """
+        :return: The cached Trajectory for this key, backed by a memory map, or None
+        """
+        filename = self._filename(key)
+        try:
+            columns = np.load(filename, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+        # Mark as recently used, for eviction. A read-only or shared cache can still serve hits.
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        planar_error = None
+        if not np.isnan(columns[0, 0]):
+            planar_error = (float(columns[0, 0]), float(columns[1, 0]))
+        return Trajectory(*columns[:, 1:], speed=speed, planar_error=planar_error)
+
+    def put(self, key, trajectory):
+        if not len(trajectory):
+            return
+
+        planar_error = np.full(5, np.nan)
+        if trajectory.planar_error is not None:
+            planar_error[:2] = trajectory.planar_error
+        columns = np.column_stack((planar_error, np.vstack((trajectory.lon, trajectory.lat, trajectory.heading,
+                                                            trajectory.distance_m, trajectory.time_offset_s))))
+        # Write to the side and rename, so a concurrent run never maps a half-written file
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as cache_file:
+            np.save(cache_file, columns)
+        os.replace(temporary, self._filename(key))
+        self.evict()
+
+    def load(self, key, speed, compute):
+        """
+        Fetch a trajectory from the cache, calling compute() and storing the result on a miss
+        """
+        trajectory = self.get(key, speed)
+        if trajectory is None:
+            trajectory = compute()
+            self.put(key, trajectory)
+        return trajectory
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits within max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,293 @@
+"""
+octane_async.py
+
+An asyncio ingestion pipeline for OCTANE Socket.IO events, built on socketio.AsyncClient.
+
+Events from any number of channels are put on a bounded queue and flow through a chain of stages (for example
+decode -> filter -> enrich -> sink), each with its own bounded queue and its own tasks. The receive loop only ever
+does a non-blocking put, so a slow stage never holds up receiving; when the first queue is full the overflow policy
+decides what's dropped. Between stages, a full queue makes the stage before it wait, so a slow sink slows the
+whole pipeline down rather than letting it buffer without limit.
+
+Stages can be coroutine functions, or plain functions run on the event loop (for cheap work) or in an executor
+(for CPU heavy work like decoding, so it doesn't stall the loop). A stage returns the item to pass on, or None to
+drop it. A stage with a batch_size takes whatever is waiting, up to that many items, in one call: worth it for an
+executor stage, where each call has to send its items to another process and back.
+
+    pipeline = Pipeline([
+        Stage(decode_batch, executor=ProcessPoolExecutor(), concurrency=4, batch_size=100),
+        Stage(keep_plymouth_road),
+        Stage(print_spat),
+    ])
+    client = OctaneAsyncClient(server, api_key, channels=['v2x_rsu_23_parsed'], events=['v2x_SPaT'],
+                               pipeline=pipeline)
+    asyncio.run(client.run())
+"""
+import asyncio
+import time
+
+import socketio
+
+overflow_policies = ("drop_oldest", "drop_newest", "block")
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    :param function: Called with each item; returns the item for the next stage, or None to drop it. May be a
+                     coroutine function.
+    :param concurrency: How many items this stage works on at once. Above 1, items can leave the stage out of order.
+    :param executor: Run function in this concurrent.futures executor rather than on the event loop. With a
+                     ProcessPoolExecutor, function and items must be picklable.
+    :param queue_size: Most items waiting for this stage
+    :param batch_size: Above 1, function is called with a list of up to this many items, as many as are waiting
+                       (so batches only grow when the stage is behind), and what it returns goes on as one item
+    :param name: For reports; defaults to the function's name
+    """
+    def __init__(self, function, concurrency=1, executor=None, queue_size=1000, batch_size=1, name=None):
+        self.function = function
+        self.concurrency = concurrency
+        self.executor = executor
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.name = name or getattr(function, "__name__", "stage")
+        self.is_async = asyncio.iscoroutinefunction(function)
+        self.queue = None
+
+        # Metrics
+        self.processed = 0
+        self.filtered = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self.max_depth = 0
+
+    async def apply(self, item):
+        if self.is_async:
+            return await self.function(item)
+        if self.executor is not None:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.function, item)
+        return self.function(item)
+
+    def metrics(self):
+        return {
+            "name": self.name,
+            "processed": self.processed,
+            "filtered": self.filtered,
+            "errors": self.errors,
+            "busy_s": self.busy_s,
+            "depth": self.queue.qsize() if self.queue else 0,
+            "max_depth": self.max_depth,
+        }
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues.
+
+    :param overflow: What put() does when the first stage's queue is full: "drop_oldest" makes room by discarding
+                     the oldest waiting item (right for streams where only the latest matters, like SPaT),
+                     "drop_newest" discards the new item, and "block" waits for room. Blocking only holds up the
+                     caller, not the receive loop: socketio.AsyncClient handles each event in a task of its own, so
+                     blocked events just pile up as tasks. max_waiting caps them.
+    :param max_waiting: With "block", most put() calls waiting at once; past that new items are dropped and counted
+                        as overflowed, so a pipeline that can't keep up doesn't hold an unbounded number of tasks
+    """
+    def __init__(self, stages, overflow="drop_oldest", error_callback=None, max_waiting=1000):
+        if overflow not in overflow_policies:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {overflow_policies}")
+        self.stages = list(stages)
+        self.overflow = overflow
+        self.max_waiting = max_waiting
+        self.error_callback = error_callback or (lambda stage, err: print(f"Stage {stage.name} failed: {err!r}"))
+        self._tasks = []
+        self._waiting = 0
+
+        # Metrics
+        self.received = 0
+        self.overflowed = 0
+
+    def start(self):
+        """
+        Create the stages' queues and tasks. Must be called from within the event loop.
+        """
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(stage.queue_size)
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for _ in range(stage.concurrency):
+                self._tasks.append(asyncio.create_task(self._run_stage(stage, following)))
+
+    async def _run_stage(self, stage, following):
+        while True:
+            item = await stage.queue.get()
+            taken = 1
+            if stage.batch_size > 1:
+                item = [item]
+                while len(item) < stage.batch_size and not stage.queue.empty():
+                    item.append(stage.queue.get_nowait())
+                taken = len(item)
+            try:
+                start = time.perf_counter()
+                try:
+                    result = await stage.apply(item)
+                finally:
+                    stage.busy_s += time.perf_counter() - start
+                stage.processed += taken
+                if following is not None:
+                    if result is None:
+                        stage.filtered += 1
+                    else:
+                        # Waits when the next stage is full, which is what pushes back on this one
+                        await following.queue.put(result)
+                        following.max_depth = max(following.max_depth, following.queue.qsize())
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                stage.errors += 1
+                self.error_callback(stage, err)
+            finally:
+                for _ in range(taken):
+                    stage.queue.task_done()
+
+    def put_nowait(self, item):
+        """
+        Feed an item into the pipeline without waiting, applying the overflow policy if it's full
+        :return: False if an item (this one or an older one) was dropped to make room
+        """
+        queue = self.stages[0].queue
+        self.received += 1
+        accepted = True
+        if queue.full():
+            if self.overflow == "drop_newest":
+                self.overflowed += 1
+                return False
+            # "drop_oldest", or "block" called from somewhere that can't wait
+            queue.get_nowait()
+            queue.task_done()
+            self.overflowed += 1
+            accepted = False
+        queue.put_nowait(item)
+        self.stages[0].max_depth = max(self.stages[0].max_depth, queue.qsize())
+        return accepted
+
+    async def put(self, item):
+        """
+        Feed an item into the pipeline, waiting for room if the overflow policy is "block"
+        :return: False if the item was dropped because max_waiting calls are already waiting
+        """
+        if self.overflow != "block":
+            return self.put_nowait(item)
+        self.received += 1
+        if self._waiting >= self.max_waiting:
+            self.overflowed += 1
+            return False
+        self._waiting += 1
+        try:
+            await self.stages[0].queue.put(item)
+        finally:
+            self._waiting -= 1
+        self.stages[0].max_depth = max(self.stages[0].max_depth, self.stages[0].queue.qsize())
+        return True
+
+    async def drain(self):
+        """
+        Wait until every item put so far has made it through every stage
+        """
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def metrics(self):
+        return {
+            "received": self.received,
+            "overflowed": self.overflowed,
+            "stages": [stage.metrics() for stage in self.stages],
+        }
+
+    def report(self):
+        m = self.metrics()
+        stages = ", ".join("{name}: {processed} done ({filtered} filtered, {errors} failed), {depth} queued "
+                           "(max {max_depth}), {busy_s:.2f}s busy".format(**stage) for stage in m["stages"])
+        return f"Pipeline: {m['received']} received, {m['overflowed']} dropped on overflow; {stages}"
+
+
+class OctaneAsyncClient:
+    """
+    Connects to OCTANE with socketio.AsyncClient, authenticates, joins channels, and feeds each of the given
+    events into a Pipeline as an (event, data) tuple. If OCTANE rejects the API key, it disconnects and run()
+    returns with auth_failed set.
+    """
+    def __init__(self, server, api_key, channels, events, pipeline, namespace="/octane", report_interval_s=None):
+        self.server = server
+        self.api_key = api_key
+        self.channels = list(channels)
+        self.events = list(events)
+        self.pipeline = pipeline
+        self.namespace = namespace
+        self.report_interval_s = report_interval_s
+        self.sio = socketio.AsyncClient()
+        self.auth_failed = False
+
+        self.sio.on('connect', self.on_connect, namespace=namespace)
+        self.sio.on('auth_ok', self.on_auth_ok, namespace=namespace)
+        self.sio.on('auth_fail', self.on_auth_fail, namespace=namespace)
+        self.sio.on('join', self.on_join, namespace=namespace)
+        self.sio.on('disconnect', self.on_disconnect, namespace=namespace)
+        for event in self.events:
+            self.sio.on(event, self._handler(event), namespace=namespace)
+
+    def _handler(self, event):
+        pipeline = self.pipeline
+        if pipeline.overflow == "block":
+            async def on_event(data):
+                await pipeline.put((event, data))
+        else:
+            # Plain function: put_nowait() never waits, so there's no coroutine to create for each event
+            def on_event(data):
+                pipeline.put_nowait((event, data))
+        return on_event
+
+    async def on_connect(self):
+        await self.sio.emit('auth', {'x-api-key': self.api_key}, namespace=self.namespace)
+
+    async def on_auth_ok(self, data):
+        for channel in self.channels:
+            await self.sio.emit('join', {'channel': channel}, namespace=self.namespace)
+
+    async def on_auth_fail(self, data):
+        # Reconnecting won't help, so stop
+        print('Failed auth, disconnecting.', data)
+        self.auth_failed = True
+        await self.sio.disconnect()
+
+    def on_join(self, data):
+        print('Join received:', data)
+
+    def on_disconnect(self):
+        print('Disconnected from OCTANE server.')
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval_s)
+            print(self.pipeline.report())
+
+    async def run(self):
+        """
+        Connect and process events until disconnected, or authentication fails
+        """
+        self.pipeline.start()
+        reporter = asyncio.create_task(self._report()) if self.report_interval_s else None
+        try:
+            await self.sio.connect(self.server, namespaces=[self.namespace])
+            await self.sio.wait()
+        finally:
+            if reporter:
+                reporter.cancel()
+            await self.pipeline.stop()
+            print(self.pipeline.report())
@@ -0,0 +1,70 @@
+"""
+publish-fleet-locations.py
+
+Gateway that publishes a whole fleet of proxies' positions to Mcity OS as beacons, over a single OCTANE connection.
+Where publish-proxy-location.py runs once per device, this reads every beacon from one shared redis instance, whose
+position hashes are named by MCITY_FLEET_KEY_PATTERN ({beacon_id} stands for each beacon's id), and sends each
+beacon's new fixes as they appear.
+
+Each beacon is limited to MCITY_FLEET_MAX_HZ updates a second, overridden per beacon with MCITY_FLEET_RATES
+(e.g. "A1B2C3=10,D4E5F6=1"). Fleet health (beacons with stale or missing fixes) is printed once a minute.
+
+While the connection to OCTANE is down, updates are held (up to MCITY_BEACON_BUFFER_SIZE) and sent once it's back,
+dropping any older than MCITY_BEACON_BUFFER_MAX_AGE_S apart from each beacon's latest.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import socketio
+from dotenv import load_dotenv
+
+from utils import FLEET_KEY_PATTERN, BeaconComm, Outbox, RedisFleetSource
+
+# BeaconComm does the reconnecting, so it can hold updates meanwhile
+sio = socketio.AsyncClient(logger=logging, reconnection=False)
+
+load_dotenv()
+api_key = os.environ.get('MCITY_OCTANE_KEY', None)
+server = os.environ.get('MCITY_OCTANE_SERVER', 'wss://octane.mvillage.um.city/')
+key_pattern = os.environ.get('MCITY_FLEET_KEY_PATTERN', FLEET_KEY_PATTERN)
+max_hz = float(os.environ.get('MCITY_FLEET_MAX_HZ', 5))
+rates = {beacon_id.strip(): float(hz) for beacon_id, hz in
+         (rate.split('=') for rate in os.environ.get('MCITY_FLEET_RATES', '').split(',') if rate.strip())}
+stale_s = float(os.environ.get('MCITY_FLEET_STALE_S', 5))
+buffer_size = int(os.environ.get('MCITY_BEACON_BUFFER_SIZE', 100000))
+buffer_max_age_s = float(os.environ.get('MCITY_BEACON_BUFFER_MAX_AGE_S', 30))
+# Print fleet health this often
+report_interval_s = 60
+
+
+async def gateway():
+    # Read as often as the fastest beacon is allowed to send
+    frequency = 1 / max([max_hz] + list(rates.values()))
+
+    fleet = RedisFleetSource(key_pattern, max_hz=max_hz, rates=rates, stale_s=stale_s)
+    comm = BeaconComm(sio, server, api_key, Outbox(buffer_size, buffer_max_age_s))
+    connection = asyncio.create_task(comm.keep_connected())
+    beacon_ids = await fleet.discover()
+    print('Publishing {} beacons found in redis under {}'.format(len(beacon_ids), key_pattern))
+    last_report = time.monotonic()
+    try:
+        while not comm.auth_failed:
+            started = time.monotonic()
+            for beacon_id, position in await fleet.read_new():
+                await comm.send(beacon_id, position)
+            if started - last_report >= report_interval_s:
+                print(fleet.report())
+                print(comm.report())
+                last_report = started
+            await asyncio.sleep(max(0.0, frequency - (time.monotonic() - started)))
+    finally:
+        connection.cancel()
+        await fleet.close()
+
+
+if not api_key:
+    print('No API KEY SPECIFIED. EXITING')
+    exit(1)
+asyncio.run(gateway())
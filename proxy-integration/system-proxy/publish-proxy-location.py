@@ -3,27 +3,47 @@ public_proxy_location.py
 
 Script to connect Mcity RTK and Oxford RTK devices to Mcity OS as beacons. Requires an Mcity OS Beacon or Oxford NCOM
 listener to be running, populating a local redis instance with position data.
+
+By default redis is polled 5 times a second. Set MCITY_BEACON_UPDATES=push to send each new fix as soon as it's
+written instead, woken by redis keyspace notifications (or by messages on MCITY_BEACON_CHANNEL, if the writer
+publishes one), at most MCITY_BEACON_MAX_HZ times a second. Either way a fix is only sent once.
+
+To publish faster than the RTK unit produces fixes, set MCITY_BEACON_PREDICT_HZ: between fixes, positions
+dead reckoned from the last fix's heading and speed are sent at that rate, for at most
+MCITY_BEACON_MAX_EXTRAPOLATION_S after the fix. Each update is then marked "predicted": true or false.
+
+If the connection to OCTANE drops, measured updates are held (up to MCITY_BEACON_BUFFER_SIZE of them) while it
+reconnects with exponential backoff, then sent once it's back. Held updates older than MCITY_BEACON_BUFFER_MAX_AGE_S
+are dropped then, apart from the latest.
 """
 import asyncio
 import logging
 import os
+import time
 
 import socketio
-from datetime import datetime, timezone
 from dotenv import load_dotenv
 
-from utils import RTKUtility
+from utils import BeaconComm, DeadReckoner, Outbox, RTKUtility, RedisPositionSource
 
 # logfile = 'logs/octane_comm.log'
 # logging.basicConfig(filename=logfile, level=logging.INFO,
 #                     format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
 #                     )
-sio = socketio.AsyncClient(logger=logging)
+# BeaconComm does the reconnecting, so it can hold updates meanwhile
+sio = socketio.AsyncClient(logger=logging, reconnection=False)
 logging.info('Created socketio client')
 
 load_dotenv()
 api_key = os.environ.get('MCITY_OCTANE_KEY', None)
 server = os.environ.get('MCITY_OCTANE_SERVER', 'wss://octane.mvillage.um.city/')
+updates_mode = os.environ.get('MCITY_BEACON_UPDATES', 'poll')
+max_hz = float(os.environ.get('MCITY_BEACON_MAX_HZ', 10))
+notify_channel = os.environ.get('MCITY_BEACON_CHANNEL', None)
+predict_hz = float(os.environ.get('MCITY_BEACON_PREDICT_HZ', 0))
+max_extrapolation_s = float(os.environ.get('MCITY_BEACON_MAX_EXTRAPOLATION_S', 1.0))
+buffer_size = int(os.environ.get('MCITY_BEACON_BUFFER_SIZE', 10000))
+buffer_max_age_s = float(os.environ.get('MCITY_BEACON_BUFFER_MAX_AGE_S', 30))
 
 try:
     beacon_id = os.environ.get('MCITY_BEACON_ID', None)
@@ -34,55 +54,70 @@ except ValueError:
     exit(1)
 
 
-class OctaneComm(socketio.AsyncClientNamespace):
-    async def on_connect(self):
-        #print(f'Connected to server [{server}]')
-        await self.emit('auth', {'x-api-key': api_key}, namespace='/octane')
-
-    async def connect(self):
-        print('Connecting to {}'.format(server))
-        await sio.connect(server, namespaces=['/octane'])
-
-    async def send_beacon_update(self):
-        latitude, longitude, heading, speed, reading_taken_s = RTKUtility.get_gps_latlong()
-        if latitude is None or latitude == 0:
-            return
-
-	reading_taken_dt = datetime.fromtimestamp(reading_taken_s, timezone.utc)
-
-        logging.info(f'Emitting beacon update lat = {latitude}, long = {longitude}')
-
-        message = {
-            "id":  beacon_id,
-            "payload": {
-                "state": {
-                    "dynamics": {
-                        "longitude": float(longitude),
-                        "latitude": float(latitude),
-                        "heading": heading,
-                        "velocity": speed,
-                        "acceleration": 0,
-                        "elevation": 0,
-			# Format is 2022-10-20T13:09:21.422Z
-			"updated": reading_taken_dt.isoformat(sep='T', timespec='milliseconds')
-                    }
-                }
-            }
-        }
-        await self.emit('beacon_message', message, namespace='/octane')
+async def send_predictions(comm, reckoner):
+    """
+    Fill the gaps between fixes with dead reckoned positions, predict_hz times a second
+    """
+    fixes = reckoner.fixes
+    while True:
+        await asyncio.sleep(1 / predict_hz)
+        if reckoner.fixes != fixes:
+            # A measured fix went out since the last tick, so there's nothing to fill
+            fixes = reckoner.fixes
+            continue
+        await comm.send(beacon_id, reckoner.predict(time.time()), predicted=True)
 
 
 async def octane_updater():
     # Send beacon updates 5 times per second
     frequency = 1 / 5
+    # Print redis read stats every 300 updates (once a minute when polling)
+    report_every = 300
 
-    comm = OctaneComm('/octane')
-    sio.register_namespace(comm)
-    await comm.connect()
+    # One pooled redis connection for the life of the script, rather than one per update
+    position_source = RedisPositionSource()
+    comm = BeaconComm(sio, server, api_key, Outbox(buffer_size, buffer_max_age_s))
+    connection = asyncio.create_task(comm.keep_connected())
     print(f"Waiting for internal (redis) beacon data for beacon ID {beacon_id}")
-    while True:
-        await comm.send_beacon_update()
-        await asyncio.sleep(frequency)
+
+    reckoner = DeadReckoner(max_extrapolation_s) if predict_hz else None
+    predictor = asyncio.create_task(send_predictions(comm, reckoner)) if reckoner else None
+
+    async def send_measured(position):
+        if reckoner:
+            reckoner.update(position)
+            await comm.send(beacon_id, position, predicted=False)
+        else:
+            await comm.send(beacon_id, position)
+
+    def report():
+        print(position_source.report())
+        print(comm.report())
+        if reckoner:
+            print(reckoner.report())
+
+    updates = 0
+    try:
+        if updates_mode == 'push':
+            async for position in position_source.updates(1 / max_hz, notify_channel):
+                if comm.auth_failed:
+                    break
+                await send_measured(position)
+                updates += 1
+                if updates % report_every == 0:
+                    report()
+        else:
+            while not comm.auth_failed:
+                await send_measured(await position_source.read_new())
+                updates += 1
+                if updates % report_every == 0:
+                    report()
+                await asyncio.sleep(frequency)
+    finally:
+        if predictor:
+            predictor.cancel()
+        connection.cancel()
+        await position_source.close()
 
 
 loop = asyncio.get_event_loop()
@@ -4,15 +4,24 @@ utils.py
 Utility methods for accessing beacon information stored in a local redis instance.
 """
 import logging
+import math
 import re
 import subprocess
 import os
+import asyncio
+import time
 import traceback
+from collections import deque, namedtuple
+from datetime import datetime, timezone
 import netifaces
 import redis
+import redis.asyncio
 import requests
+import socketio
 from dotenv import load_dotenv
 
+from octane_outbox import Outbox, backoff_delays
+
 load_dotenv()
 api_key = os.environ.get('MCITY_OCTANE_KEY', None)
 server = os.environ.get('MCITY_OCTANE_SERVER', 'wss://octane.mvillage.um.city/')
@@ -20,6 +29,603 @@ server = os.environ.get('MCITY_OCTANE_SERVER', 'wss://octane.mvillage.um.city/')
 GNSS_LOCATION_KEY = 'gnss:position:oxdecoder'
 GNSS_SATELLITES_KEY = 'gnss:position:satellites:5'
 GNSS_FIXTYPE_KEY = 'gnss:position:current:fixType:5'
+# Where a gateway finds each proxy's position hash; {beacon_id} is the part of the key that names the beacon
+FLEET_KEY_PATTERN = 'beacon:{beacon_id}:gnss:position'
+
+# A position read from GNSS_LOCATION_KEY. reading_taken_s is the machine time (seconds since the epoch) of the fix.
+Position = namedtuple('Position', ['latitude', 'longitude', 'heading', 'speed', 'reading_taken_s'])
+
+
+def decode_position(fields):
+    """
+    :param fields: The GNSS_LOCATION_KEY hash, as returned by redis (bytes keys and values)
+    :return: A Position of floats, or None if the hash is empty or has no position
+    """
+    if not fields or not fields.get(b'lat') or not fields.get(b'long'):
+        return None
+    return Position(float(fields[b'lat']), float(fields[b'long']), float(fields.get(b'heading') or 0),
+                    float(fields.get(b'speed') or 0), float(fields.get(b'machine_second') or 0))
+
+
+def beacon_message(beacon_id, position, predicted=None):
+    """
+    :param predicted: If given, the message's dynamics are marked "predicted": True for a dead reckoned position or
+                      False for a measured one
+    :return: The OCTANE beacon_message for a Position
+    """
+    reading_taken_dt = datetime.fromtimestamp(position.reading_taken_s, timezone.utc)
+    message = {
+        "id": beacon_id,
+        "payload": {
+            "state": {
+                "dynamics": {
+                    "longitude": position.longitude,
+                    "latitude": position.latitude,
+                    "heading": position.heading,
+                    "velocity": position.speed,
+                    "acceleration": 0,
+                    "elevation": 0,
+                    # Format is 2022-10-20T13:09:21.422Z
+                    "updated": reading_taken_dt.isoformat(sep='T', timespec='milliseconds')
+                }
+            }
+        }
+    }
+    if predicted is not None:
+        message["payload"]["state"]["dynamics"]["predicted"] = predicted
+    return message
+
+
+EARTH_RADIUS_M = 6378137.0
+
+
+def extrapolate(position, elapsed_s):
+    """
+    Dead reckon a Position forward, assuming constant speed (m/s) and heading (degrees clockwise from north). Over
+    the second or so between fixes a flat earth is accurate to well under a centimeter.
+    :return: A Position elapsed_s later
+    """
+    distance_m = position.speed * elapsed_s
+    heading = math.radians(position.heading)
+    latitude = position.latitude + math.degrees(distance_m * math.cos(heading) / EARTH_RADIUS_M)
+    longitude = position.longitude + math.degrees(
+        distance_m * math.sin(heading) / (EARTH_RADIUS_M * math.cos(math.radians(position.latitude))))
+    return position._replace(latitude=latitude, longitude=longitude,
+                             reading_taken_s=position.reading_taken_s + elapsed_s)
+
+
+class DeadReckoner:
+    """
+    Predicts where a beacon is between fixes from its last fix's heading and speed, so positions can be published
+    faster than the RTK unit produces them.
+
+    :param max_extrapolation_s: Stop predicting this long after the last fix; past that the beacon has probably
+                                turned or stopped, and publishing nothing is better than publishing a guess
+    """
+    def __init__(self, max_extrapolation_s=1.0):
+        self.max_extrapolation_s = max_extrapolation_s
+        self.fix = None
+
+        # Metrics
+        self.fixes = 0
+        self.predictions = 0
+        self.expired = 0
+
+    def update(self, position):
+        """
+        Start predicting from a new measured fix
+        """
+        if position is not None:
+            self.fix = position
+            self.fixes += 1
+
+    def predict(self, now):
+        """
+        :param now: Seconds since the epoch, on the same clock as the fixes' reading_taken_s
+        :return: The predicted Position at now, or None with no fix or only one older than max_extrapolation_s
+        """
+        if self.fix is None:
+            return None
+        # A fix stamped slightly in the future (clocks a little apart) is used as is
+        elapsed_s = max(0.0, now - self.fix.reading_taken_s)
+        if elapsed_s > self.max_extrapolation_s:
+            self.expired += 1
+            return None
+        self.predictions += 1
+        return extrapolate(self.fix, elapsed_s)
+
+    def report(self):
+        return 'Dead reckoning: {} fixes, {} predictions, {} skipped for a fix older than {}s'.format(
+            self.fixes, self.predictions, self.expired, self.max_extrapolation_s)
+
+
+class BeaconComm(socketio.AsyncClientNamespace):
+    """
+    The OCTANE namespace beacon updates are published on. Authenticates on connect, and while the connection is down
+    holds updates in an Outbox and reconnects with exponential backoff (see keep_connected), sending what it held once
+    authenticated again. If OCTANE rejects the API key it disconnects for good and sets auth_failed.
+
+    :param sio: The socketio.AsyncClient to publish with, created with reconnection=False
+    :param reconnect_reset_s: Only go back to the shortest backoff once a connection has stayed up this long
+    """
+    def __init__(self, sio, server, api_key, outbox=None, namespace='/octane', reconnect_reset_s=60.0):
+        super().__init__(namespace)
+        self.server = server
+        self.api_key = api_key
+        self.outbox = outbox or Outbox()
+        self.reconnect_reset_s = reconnect_reset_s
+        self.auth_failed = False
+        # Set once authenticated with nothing left in the outbox, while the client reports itself connected, and
+        # cleared on disconnect; until then updates go to the outbox
+        self.live = False
+        self.disconnected = asyncio.Event()
+        self._flusher = None
+        sio.register_namespace(self)
+
+        # Metrics
+        self.predictions_dropped = 0
+
+    async def on_connect(self):
+        await self.emit('auth', {'x-api-key': self.api_key}, namespace=self.namespace)
+
+    def on_auth_ok(self, data):
+        self._flusher = asyncio.create_task(self.flush())
+
+    async def on_auth_fail(self, data):
+        # Reconnecting won't help, so stop
+        print('Failed auth, disconnecting.', data)
+        self.auth_failed = True
+        await self.client.disconnect()
+
+    def on_disconnect(self):
+        self.live = False
+        if not self.auth_failed:
+            print('Disconnected from OCTANE, holding beacon updates until reconnected')
+        self.disconnected.set()
+
+    async def keep_connected(self):
+        """
+        Connect, and reconnect whenever the connection drops, backing off exponentially while the server can't be
+        reached. A connection that drops within reconnect_reset_s counts as a failed attempt, so a server that accepts
+        connections and then closes them isn't hammered. Runs until cancelled, or until authentication fails.
+        """
+        delays = backoff_delays()
+        while not self.auth_failed:
+            self.disconnected.clear()
+            try:
+                print('Connecting to {}'.format(self.server))
+                await self.client.connect(self.server, namespaces=[self.namespace])
+            except socketio.exceptions.ConnectionError as err:
+                delay_s = next(delays)
+                print("Couldn't connect to OCTANE ({}), trying again in {:.1f}s".format(err, delay_s))
+                await asyncio.sleep(delay_s)
+                continue
+            connected_at = time.monotonic()
+            await self.disconnected.wait()
+            if time.monotonic() - connected_at >= self.reconnect_reset_s:
+                delays = backoff_delays()
+            elif not self.auth_failed:
+                delay_s = next(delays)
+                print('Connection dropped after {:.1f}s, reconnecting in {:.1f}s'.format(
+                    time.monotonic() - connected_at, delay_s))
+                await asyncio.sleep(delay_s)
+
+    async def flush(self, batch_size=100):
+        """
+        Send what the outbox held, oldest first, yielding to the event loop after each batch so new updates keep
+        arriving meanwhile (they join the end of the outbox). Goes live once it's empty; if the connection drops
+        again first, what's left stays in the outbox for the next connection.
+        """
+        self.outbox.expire()
+        sent = 0
+        while True:
+            batch = self.outbox.take(batch_size)
+            if not batch:
+                break
+            for index, (_, event, message, _) in enumerate(batch):
+                if not self.client.connected:
+                    self.outbox.requeue(batch[index:])
+                    return
+                try:
+                    await self._emit(event, message)
+                except socketio.exceptions.SocketIOError:
+                    self.outbox.requeue(batch[index:])
+                    return
+                sent += 1
+                self.outbox.sent += 1
+            await asyncio.sleep(0)
+        if sent:
+            print('Sent {} beacon updates held while disconnected'.format(sent))
+        self.live = self.client.connected
+
+    async def _emit(self, event, message):
+        await self.emit(event, message, namespace=self.namespace)
+
+    async def send(self, beacon_id, position, predicted=None):
+        """
+        Publish a beacon update, or hold it in the outbox if disconnected. Predicted positions are only worth sending
+        live, so they're dropped rather than held.
+        """
+        if position is None or position.latitude == 0:
+            return
+
+        logging.info(f'Emitting beacon update for {beacon_id} lat = {position.latitude}, long = {position.longitude}')
+        message = beacon_message(beacon_id, position, predicted)
+        # Checked before every emit: the disconnect handler may not have run yet, and an emit on a dropped
+        # connection isn't guaranteed to raise
+        if self.live and not self.client.connected:
+            self.live = False
+        if self.live:
+            try:
+                await self._emit('beacon_message', message)
+                return
+            except socketio.exceptions.SocketIOError:
+                self.live = False
+        if predicted:
+            self.predictions_dropped += 1
+        else:
+            self.outbox.put('beacon_message', message, beacon_id)
+
+    def report(self):
+        report = self.outbox.report()
+        if self.predictions_dropped:
+            report += ', {} predictions dropped while disconnected'.format(self.predictions_dropped)
+        return report
+
+
+class RedisPositionSource:
+    """
+    Reads the latest GNSS position from the local redis instance without blocking the event loop. The connection
+    pool is created once and reused for every read, and each read's round trip time is recorded.
+
+    Positions can be read on demand with read(), or pushed as they arrive with updates().
+    """
+    def __init__(self, host='localhost', port=6379, db=0, key=GNSS_LOCATION_KEY, max_connections=2,
+                 latency_samples=1000):
+        self.key = key
+        self.db = db
+        self._last_taken_s = None
+        self.pool = redis.asyncio.ConnectionPool(host=host, port=port, db=db, max_connections=max_connections)
+        self.redis = redis.asyncio.Redis(connection_pool=self.pool)
+
+        # Metrics
+        self.reads = 0
+        self.misses = 0
+        self.errors = 0
+        self.notifications = 0
+        self.duplicates = 0
+        self.max_latency_s = 0.0
+        self.latencies_s = deque(maxlen=latency_samples)
+
+    async def read(self):
+        """
+        :return: The current Position, or None if there isn't one (or redis couldn't be reached)
+        """
+        start = time.perf_counter()
+        try:
+            fields = await self.redis.hgetall(self.key)
+        except redis.RedisError:
+            self.errors += 1
+            logging.error(traceback.format_exc())
+            return None
+        finally:
+            latency_s = time.perf_counter() - start
+            self.latencies_s.append(latency_s)
+            self.max_latency_s = max(self.max_latency_s, latency_s)
+        self.reads += 1
+
+        position = decode_position(fields)
+        if position is None:
+            self.misses += 1
+            logging.info('No GPS location found - redis key [{}]'.format(self.key))
+        return position
+
+    async def read_new(self):
+        """
+        :return: The current Position if it's a different reading from the last one read_new() returned, else None
+        """
+        position = await self.read()
+        if position is None:
+            return None
+        if position.reading_taken_s == self._last_taken_s:
+            self.duplicates += 1
+            return None
+        self._last_taken_s = position.reading_taken_s
+        return position
+
+    async def _notifications_enabled(self):
+        try:
+            flags = (await self.redis.config_get('notify-keyspace-events')).get('notify-keyspace-events', '')
+        except redis.RedisError:
+            # Managed redis instances can refuse CONFIG; assume the best
+            return True
+        return 'K' in flags and ('h' in flags or 'A' in flags)
+
+    async def _listen(self, pubsub, notified):
+        async for message in pubsub.listen():
+            if message['type'] in ('message', 'pmessage'):
+                self.notifications += 1
+                notified.set()
+
+    async def updates(self, min_interval_s=0.0, channel=None, idle_poll_s=1.0):
+        """
+        Yield each new Position as soon as it's written, rather than polling on a fixed period.
+
+        Wakes on keyspace notifications for the position hash (redis needs notify-keyspace-events to include
+        'Kh': redis-cli config set notify-keyspace-events Kh), or on any message to channel if the writer
+        publishes one. Positions with the same reading time as the last one are skipped.
+
+        :param min_interval_s: Yield at most one position per this many seconds; positions that arrive in between
+                               are coalesced into the latest, never delayed by more than the interval
+        :param idle_poll_s: Read anyway after this long without a notification, in case notifications are off
+        """
+        if channel is None and not await self._notifications_enabled():
+            logging.warning('Keyspace notifications are off in redis, so position updates will only be seen every '
+                            '{}s. Enable them with: redis-cli config set notify-keyspace-events Kh'.format(idle_poll_s))
+
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(channel or '__keyspace@{}__:{}'.format(self.db, self.key))
+        notified = asyncio.Event()
+        listener = asyncio.create_task(self._listen(pubsub, notified))
+        last_sent = 0.0
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(notified.wait(), idle_poll_s)
+                except asyncio.TimeoutError:
+                    pass
+                # Rate cap: anything arriving while we wait is picked up by the read below
+                wait_s = last_sent + min_interval_s - time.monotonic()
+                if wait_s > 0:
+                    await asyncio.sleep(wait_s)
+                notified.clear()
+
+                position = await self.read_new()
+                if position is not None:
+                    last_sent = time.monotonic()
+                    yield position
+        finally:
+            listener.cancel()
+            await pubsub.unsubscribe()
+            await pubsub.close()
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'misses': self.misses,
+            'errors': self.errors,
+            'notifications': self.notifications,
+            'duplicates': self.duplicates,
+            'p50_ms': _percentile_ms(self.latencies_s, 50),
+            'p99_ms': _percentile_ms(self.latencies_s, 99),
+            'max_ms': self.max_latency_s * 1000,
+        }
+
+    def report(self):
+        s = self.stats()
+        if s['p50_ms'] is None:
+            return 'Redis position reads: none yet'
+        return ('Redis position reads: {reads} ({misses} without a position, {errors} failed, {duplicates} repeats '
+                'skipped, {notifications} notifications), latency p50 {p50_ms:.2f}ms p99 {p99_ms:.2f}ms '
+                'max {max_ms:.2f}ms'.format(**s))
+
+    async def close(self):
+        await self.redis.close()
+        await self.pool.disconnect()
+
+
+def _percentile_ms(latencies_s, p):
+    if not latencies_s:
+        return None
+    latencies = sorted(latencies_s)
+    return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] * 1000
+
+
+class BeaconHealth:
+    """
+    Counters for one beacon of a RedisFleetSource
+    """
+    def __init__(self):
+        self.reads = 0
+        self.misses = 0
+        self.repeats = 0
+        self.throttled = 0
+        self.sent = 0
+        # reading_taken_s of the latest fix seen and of the last one sent, and when (monotonic) that was sent
+        self.last_fix_s = None
+        self.last_sent_fix_s = None
+        self.last_sent_at = float('-inf')
+
+
+class RedisFleetSource:
+    """
+    Reads the positions of a whole fleet of beacons from one redis instance, so a single process and a single OCTANE
+    connection can publish them all.
+
+    Beacons are found by scanning for keys matching key_pattern, and found again every discover_interval_s so proxies
+    can join and leave. Every beacon's hash is read with pipelined HGETALLs, one round trip per batch_size beacons.
+    Each beacon has its own rate limit, and its own health counters.
+
+    :param key_pattern: The position hash's key, with {beacon_id} in place of the beacon's id
+    :param max_hz: Most updates a second for any one beacon
+    :param rates: {beacon_id: max updates a second} for beacons that need a different limit
+    :param stale_s: A beacon whose latest fix is older than this is reported as stale
+    """
+    def __init__(self, key_pattern=FLEET_KEY_PATTERN, host='localhost', port=6379, db=0, max_hz=5.0, rates=None,
+                 stale_s=5.0, discover_interval_s=30.0, batch_size=200, max_connections=2, latency_samples=1000,
+                 clock=time.time):
+        if key_pattern.count('{beacon_id}') != 1:
+            raise ValueError("key_pattern must contain {{beacon_id}} once, got {!r}".format(key_pattern))
+        prefix, _, suffix = key_pattern.partition('{beacon_id}')
+        self.key_pattern = key_pattern
+        self.match = prefix + '*' + suffix
+        self._key_re = re.compile(re.escape(prefix) + '([^:]+)' + re.escape(suffix))
+        self.min_interval_s = 1 / max_hz if max_hz else 0.0
+        self.intervals = {beacon_id: 1 / hz for beacon_id, hz in (rates or {}).items()}
+        self.stale_s = stale_s
+        self.discover_interval_s = discover_interval_s
+        self.batch_size = batch_size
+        self.clock = clock
+        self.pool = redis.asyncio.ConnectionPool(host=host, port=port, db=db, max_connections=max_connections)
+        self.redis = redis.asyncio.Redis(connection_pool=self.pool)
+        # beacon_id -> key, for the beacons found by the last discover()
+        self.keys = {}
+        self._discovered_at = None
+
+        # Metrics
+        self.beacons = {}
+        self.batches = 0
+        self.errors = 0
+        self.max_latency_s = 0.0
+        self.latencies_s = deque(maxlen=latency_samples)
+
+    async def discover(self):
+        """
+        Scan redis for beacons' position hashes
+        :return: The beacon ids found
+        """
+        keys = {}
+        try:
+            async for key in self.redis.scan_iter(match=self.match, count=1000):
+                found = self._key_re.fullmatch(key.decode())
+                if found:
+                    keys[found.group(1)] = key
+        except redis.RedisError:
+            # Keep publishing the beacons we already know about
+            self.errors += 1
+            logging.error(traceback.format_exc())
+            return list(self.keys)
+
+        for beacon_id in keys.keys() - self.keys.keys():
+            logging.info('Found beacon {}'.format(beacon_id))
+            self.beacons.setdefault(beacon_id, BeaconHealth())
+        for beacon_id in self.keys.keys() - keys.keys():
+            logging.info('Beacon {} is no longer in redis'.format(beacon_id))
+        self.keys = keys
+        self._discovered_at = time.monotonic()
+        return list(keys)
+
+    async def read_all(self):
+        """
+        Read every beacon's position, discovering beacons first if it's time to
+        :return: {beacon_id: Position or None}
+        """
+        if self._discovered_at is None or time.monotonic() - self._discovered_at >= self.discover_interval_s:
+            await self.discover()
+        beacon_ids = list(self.keys)
+        positions = {}
+        for start in range(0, len(beacon_ids), self.batch_size):
+            batch = beacon_ids[start:start + self.batch_size]
+            started = time.perf_counter()
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for beacon_id in batch:
+                        pipe.hgetall(self.keys[beacon_id])
+                    # A key that's been replaced by something other than a hash fails alone, not the whole batch
+                    results = await pipe.execute(raise_on_error=False)
+            except redis.RedisError:
+                self.errors += 1
+                logging.error(traceback.format_exc())
+                continue
+            finally:
+                latency_s = time.perf_counter() - started
+                self.latencies_s.append(latency_s)
+                self.max_latency_s = max(self.max_latency_s, latency_s)
+            self.batches += 1
+            for beacon_id, fields in zip(batch, results):
+                positions[beacon_id] = None if isinstance(fields, Exception) else decode_position(fields)
+        return positions
+
+    async def read_new(self):
+        """
+        :return: [(beacon_id, Position)] for each beacon with a fix it hasn't sent yet and whose rate limit allows
+                 sending one now. A fix held back by the rate limit is replaced by any newer one before it's sent.
+        """
+        now = time.monotonic()
+        due = []
+        for beacon_id, position in (await self.read_all()).items():
+            health = self.beacons[beacon_id]
+            health.reads += 1
+            if position is None:
+                health.misses += 1
+                continue
+            health.last_fix_s = position.reading_taken_s
+            if position.reading_taken_s == health.last_sent_fix_s:
+                health.repeats += 1
+                continue
+            if now - health.last_sent_at < self.intervals.get(beacon_id, self.min_interval_s):
+                health.throttled += 1
+                continue
+            health.sent += 1
+            health.last_sent_fix_s = position.reading_taken_s
+            health.last_sent_at = now
+            due.append((beacon_id, position))
+        return due
+
+    def health(self):
+        """
+        :return: {beacon_id: counters, fix_age_s and status}. Status is 'ok', 'stale' (no fix for stale_s),
+                 'no fix' (never had a position) or 'gone' (its key has disappeared from redis).
+        """
+        now = self.clock()
+        beacons = {}
+        for beacon_id, health in self.beacons.items():
+            fix_age_s = now - health.last_fix_s if health.last_fix_s is not None else None
+            if beacon_id not in self.keys:
+                status = 'gone'
+            elif fix_age_s is None:
+                status = 'no fix'
+            elif fix_age_s > self.stale_s:
+                status = 'stale'
+            else:
+                status = 'ok'
+            beacons[beacon_id] = {
+                'reads': health.reads,
+                'misses': health.misses,
+                'repeats': health.repeats,
+                'throttled': health.throttled,
+                'sent': health.sent,
+                'fix_age_s': fix_age_s,
+                'status': status,
+            }
+        return beacons
+
+    def stats(self):
+        beacons = self.health()
+        statuses = {}
+        for beacon in beacons.values():
+            statuses[beacon['status']] = statuses.get(beacon['status'], 0) + 1
+        return {
+            'beacons': len(beacons),
+            'statuses': statuses,
+            'sent': sum(beacon['sent'] for beacon in beacons.values()),
+            'batches': self.batches,
+            'errors': self.errors,
+            'p50_ms': _percentile_ms(self.latencies_s, 50),
+            'p99_ms': _percentile_ms(self.latencies_s, 99),
+            'max_ms': self.max_latency_s * 1000,
+        }
+
+    def report(self):
+        """
+        A summary of the fleet, with a line for each beacon that isn't ok
+        """
+        s = self.stats()
+        statuses = ', '.join('{} {}'.format(count, status) for status, count in sorted(s['statuses'].items()))
+        lines = ['Fleet: {} beacons ({}), {} updates sent, {} batch reads ({} failed)'.format(
+            s['beacons'], statuses or 'none found yet', s['sent'], s['batches'], s['errors'])]
+        if s['p50_ms'] is not None:
+            lines[0] += ', latency p50 {p50_ms:.2f}ms p99 {p99_ms:.2f}ms max {max_ms:.2f}ms'.format(**s)
+        for beacon_id, beacon in sorted(self.health().items()):
+            if beacon['status'] != 'ok':
+                age = '{:.1f}s old'.format(beacon['fix_age_s']) if beacon['fix_age_s'] is not None else 'no fix'
+                lines.append('  {}: {} ({}, {} sent, {} reads without a position)'.format(
+                    beacon_id, beacon['status'], age, beacon['sent'], beacon['misses']))
+        return '\n'.join(lines)
+
+    async def close(self):
+        await self.redis.close()
+        await self.pool.disconnect()
 
 
 class RTKUtility:
@@ -0,0 +1,97 @@
+"""
+python-v2x-async.py
+Sample Mcity OCTANE Python script that listens to many V2X channels at once with asyncio.
+
+Instead of doing work in Socket.IO callbacks, events are fed into a pipeline (see octane_async.py):
+decode -> filter -> enrich -> sink, each stage with a bounded queue. The RSUs' raw TSCBM SPaT is decoded
+locally (see tscbm.py), in batches of whatever has queued up, in a process pool so it never blocks the
+event loop that's receiving packets; a batch makes each trip to a decoder process worth its pickling.
+When the pipeline can't keep up the oldest waiting packets are dropped rather than falling further and
+further behind. The filter only passes on phase changes (see SpatDeltaEncoder in v2x_spat.py), a small
+fraction of the 10hz SPaT stream.
+
+Pre-requisite is installation of python-socketio and aiohttp packages.
+
+See this link for documentation on joinable channels, events, and event payloads:
+https://mcity.um.city/apidocs/#/WebSockets-Events
+"""
+import os
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from octane_async import OctaneAsyncClient, Pipeline, Stage
+from tscbm import decode_messages
+from v2x_latency import parse_updated
+from v2x_spat import SpatDeltaEncoder, SpatState, format_event
+
+#Load environment variables
+load_dotenv()
+api_key = os.environ.get('MCITY_OCTANE_KEY', None)
+server = os.environ.get('MCITY_OCTANE_SERVER', 'https://octane.aace.um.city/')
+namespace = "/octane"
+number_of_decoders = 4 #Processes used to decode packets.
+decode_batch_size = 100 #Most packets sent to a decoder process at once.
+report_interval_s = 10 #How often to print pipeline metrics, None to disable.
+keyframe_interval_s = 10 #How often to print every phase's color, besides printing each change.
+
+#Every RSU on the Plymouth road corridor, one channel each. One process handles them all.
+channels = ['v2x_rsu_{}_raw'.format(rsu) for rsu in (23, 26, 28, 31, 53, 55, 56)]
+events = ['v2x_raw']
+
+#If no API Key provided, exit.
+if not api_key:
+    print ("No API KEY SPECIFIED. EXITING")
+    exit()
+
+def decode(items):
+    """
+    Runs in the process pool. Decodes a batch of raw TSCBM SPaT messages into compact SpatStates,
+    skipping any that aren't valid TSCBMs.
+    """
+    messages = [data for event, data in items]
+    records, decoded = decode_messages(messages)
+    # Keep each message's own 'updated' timestamp, as the parsed channel would have sent it
+    return [SpatState(record['id'].decode(), messages[index]['updated'], int(record['red']),
+                      int(record['yellow']), int(record['green']))
+            for record, index in zip(records, decoded)] or None
+
+delta = SpatDeltaEncoder(keyframe_interval_s)
+
+def to_changes(spats):
+    """
+    Only pass on phase changes (and the occasional keyframe with every phase's color).
+    Decoders run in parallel and can finish out of order; the encoder ignores anything older than the last SPaT seen.
+    """
+    return [event for spat in spats for event in delta.encode(spat)] or None
+
+def add_age(events):
+    """
+    How long ago the RSU sent the SPaT behind each event.
+    """
+    now = time.time()
+    for event in events:
+        event['age_s'] = now - parse_updated(event['updated'])
+    return events
+
+async def show(events):
+    for event in events:
+        print('{} ({:.2f}s old)'.format(format_event(event), event['age_s']))
+
+async def main():
+    with ProcessPoolExecutor(number_of_decoders) as decoders:
+        pipeline = Pipeline([
+            Stage(decode, concurrency=number_of_decoders, executor=decoders, batch_size=decode_batch_size),
+            Stage(to_changes),
+            Stage(add_age),
+            Stage(show),
+        ], overflow='drop_oldest')
+        client = OctaneAsyncClient(server, api_key, channels, events, pipeline, namespace=namespace,
+                                   report_interval_s=report_interval_s)
+        try:
+            await client.run()
+        finally:
+            print(delta.report())
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -7,6 +7,29 @@ to workers in queues on other threads/processes depending on system architecture
 On Linux/Mac this is handled via fork and system threads.
 On Windows it may not be supported.
 
+Packets are not sent to workers one at a time; a BatchDispatcher (see v2x_dispatch.py) gathers them
+into batches bounded by size and age, so each trip to a worker carries many packets. SPaT and intersection
+updates instead go through a CoalescingQueue: only the latest packet per intersection waits for a worker, and
+packets older than spat_max_age_s are shed, so a backlog can't build up behind workers that fall behind.
+
+Set transport = 'ring' to skip the pool entirely: the raw text of each V2X event is copied into a shared memory
+ring buffer (see v2x_ring.py) before Socket.IO decodes it, and each worker process reads its share of packets
+straight out of shared memory. Nothing is pickled or sent over a pipe, and the receiving thread never parses JSON.
+
+Set transport = 'shards' for stateful processing: a ShardedPool (see v2x_shards.py) gives each worker a fixed
+share of intersection and vehicle ids, delivers each id's packets in order to the same worker, and lets it keep
+per-id state between packets (here, the last signal state seen, to report phase changes).
+
+Every packet's latency (time received minus its 'updated' timestamp) is recorded in histograms per channel and
+per RSU (see v2x_latency.py). Send the process SIGUSR1 to print p50/p99/max at any time. With transport = 'ring'
+each worker process measures its own packets, so the signal is passed on to every worker, and each dumps its own
+histograms (to latency_dump_filename with .worker<n> before the extension, if set).
+
+If the connection drops, run() reconnects, waiting longer after each failed attempt (exponential backoff, up to
+reconnect_max_s) while the server can't be reached. A connection that drops again within reconnect_reset_s counts
+as a failed attempt, so a server that accepts connections and then closes them isn't hammered. The workers keep
+running throughout.
+
 Pre-requisite is installation of websocket-client and python-socketio packages.
 
 See this link for documentation on joinable channels, events, and event payloads:
@@ -16,8 +39,15 @@ import os
 import json
 import socketio #You'll want to install python-socketio and websocket-client packages using PIP
 import arrow
+import signal
 import time
-from multiprocessing import Pool
+from multiprocessing import Pool, Process
+from octane_outbox import backoff_delays
+from v2x_latency import LatencyRecorder, parse_updated
+from v2x_dispatch import BatchDispatcher, CoalescingQueue
+from v2x_ring import SharedRing
+from v2x_shards import ShardedPool
+from v2x_spat import SpatState
 
 
 #Load environment variables
@@ -25,6 +55,22 @@ api_key = os.environ.get('MCITY_OCTANE_KEY', None)
 server = 'https://octane.aace.um.city/'
 namespace = "/octane"
 number_of_workers = 4 #Number of processes used to handle incoming data.
+max_batch_size = 64 #Most packets sent to a worker at once.
+max_batch_latency_s = 0.05 #Longest a packet waits for its batch to fill before being sent anyway.
+metrics_interval_s = 10 #How often to print batch size and queue depth metrics, None to disable.
+coalesce_spat = True #Only process the latest SPaT/intersection update per intersection, shedding stale ones.
+spat_max_age_s = 2.0 #Longest a SPaT waits for a worker before it's dropped as stale.
+transport = 'batch' #'batch' to send batches to a worker pool, 'ring' to share packets through shared memory,
+                    #'shards' to give each worker its own intersections and vehicles.
+latency_dump_filename = None #Also write latency summaries to this file as JSON whenever they're dumped.
+ring_slots = 8192 #Packets the ring holds before the oldest unread ones are overwritten.
+ring_slot_size = 4096 #Largest packet the ring will carry, in bytes; bigger ones are dropped and counted.
+reconnect_min_s = 1.0 #Wait before the first reconnection attempt; doubles after each failed attempt...
+reconnect_max_s = 30.0 #...up to this.
+reconnect_reset_s = 60.0 #Only go back to reconnect_min_s once a connection has stayed up this long.
+
+#Socket.IO events read from the ring, and the packet type each one is processed as.
+ring_events = {'v2x_SPaT': 'SPAT', 'v2x_BSM': 'BSM', 'v2x_raw': 'RAW', 'intersection_update': 'INTERSECTION'}
 
 #If no API Key provided, exit.
 if not api_key:
@@ -36,14 +82,14 @@ def process_data(type: str, data: dict):
     Each packet processed will be run by a worker who will call this function.
     Utilize the type string to determine how to process the data dictionary.
     """
-    if type == 'INT':
+    if type == 'INTERSECTION':
         print('INT 1HZ {}: ID: {} Phase {} will be {} for at least {} seconds.'.format(arrow.utcnow().format('YYYY-MM-DDTHH:mm:ssZZ'), 
             data['id'], data['state']['phases'][0]['phase'], data['state']['phases'][0]['color'], data['state']['phases'][0]['vehTimeMin']))
     elif type == 'SPAT':
         #See how far behind we are.
-        diff = arrow.utcnow() - arrow.get(data['updated'])
-        if diff.seconds > 2:
-            print ("SPAT Drift {}".format(diff))
+        drift = time.time() - parse_updated(data['updated'])
+        if drift > 2:
+            print ("SPAT Drift {:.3f}s".format(drift))
         #Keep process busy to simulate work
         #If you see the message above triggering, decrease work length, or increase workers
         time.sleep(.02)
@@ -56,7 +102,95 @@ def process_data(type: str, data: dict):
     else:
         print ("UNKNWON:" + data)
 
-def error_callback(self, err):
+def process_batch(batch: list):
+    """
+    Workers are handed batches of (type, data) packets from the dispatcher.
+    """
+    for type, data in batch:
+        process_data(type, data)
+
+def shard_key(type: str, data):
+    """
+    Packets with the same key always go to the same shard worker, in order.
+    """
+    return type, data.get('id') if isinstance(data, dict) else None
+
+def process_sharded(type: str, data, state: dict):
+    """
+    Run by the shard worker that owns this packet's intersection or vehicle. state persists between
+    packets with the same key, so it's safe to compare against what came before.
+    """
+    if type == 'SPAT':
+        spat = SpatState.from_message(data)
+        changed = spat.changed_phases(state.get('spat'))
+        if changed:
+            print('SPAT {}: phases {} changed at {}'.format(data['id'], changed, data['updated']))
+        state['spat'] = spat
+    process_data(type, data)
+
+def worker_dump_filename(consumer: int):
+    """
+    Where a ring worker writes its latency summaries: latency_dump_filename with .worker<n> before the extension.
+    """
+    if not latency_dump_filename:
+        return None
+    root, extension = os.path.splitext(latency_dump_filename)
+    return '{}.worker{}{}'.format(root, consumer, extension)
+
+def ring_worker(ring_args: dict, consumer: int):
+    """
+    Runs in each worker process when transport = 'ring', reading this worker's share of packets from the ring.
+    """
+    # The receiver doesn't decode packets in this mode, so latency is measured here, as each packet is read
+    latency = LatencyRecorder()
+    def dump_latency(*_):
+        latency.dump(worker_dump_filename(consumer), 'Worker {}'.format(consumer))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump_latency)
+    with SharedRing(**ring_args) as ring:
+        reader = ring.reader(consumer)
+        for view in reader:
+            # Decoded straight out of shared memory: the one copy made of each packet
+            raw = str(view, 'utf-8')
+            if not reader.intact():
+                # Overwritten while we were decoding it; the ring counts it as an overflow
+                continue
+            try:
+                event, data = json.loads(raw)
+                type = ring_events[event]
+                if isinstance(data, dict) and 'updated' in data:
+                    latency.record(type, data.get('id'), data['updated'])
+                process_data(type, data)
+            except Exception as err:
+                error_callback(err)
+        if reader.lost:
+            print('Worker {} fell behind and lost {} packets'.format(consumer, reader.lost))
+    dump_latency()
+
+class RingClient(socketio.Client):
+    """
+    A Socket.IO client that copies the raw text of V2X events into a SharedRing, rather than decoding them
+    and calling event handlers. Everything else is handled as usual.
+    """
+    def __init__(self, ring: SharedRing, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = ring
+        self.event_prefix = '2{},'.format(namespace)
+        self.event_starts = tuple('["{}"'.format(event) for event in ring_events)
+        self.last_report = time.monotonic()
+
+    def _handle_eio_message(self, data):
+        # Event packets look like 2/octane,["v2x_SPaT",{...}]
+        if (not self._binary_packet and isinstance(data, str) and data.startswith(self.event_prefix)
+                and data.startswith(self.event_starts, len(self.event_prefix))):
+            self.ring.write(data[len(self.event_prefix):].encode())
+            if metrics_interval_s and time.monotonic() - self.last_report >= metrics_interval_s:
+                print(self.ring.report())
+                self.last_report = time.monotonic()
+        else:
+            super()._handle_eio_message(data)
+
+def error_callback(err):
     """ 
     If a worker fails to process a packet, this is function will be called in the main/parent process.
     """
@@ -132,6 +266,21 @@ def on_channels(data: dict):
     #sio.emit('join', {'channel': channel}, namespace=namespace)
 
 
+def submit(type: str, data):
+    """
+    Record how late a packet arrived, and hand it to the workers.
+    """
+    if isinstance(data, dict) and 'updated' in data:
+        latency.record(type, data.get('id'), data['updated'])
+    if transport == 'shards':
+        shards.submit(shard_key(type, data), type, data)
+    elif coalesce_spat and type in ('SPAT', 'INTERSECTION'):
+        # Only the newest signal state matters, so a packet still waiting when a newer one for the same
+        # intersection arrives is replaced.
+        coalescer.submit((type, data['id']), type, data)
+    else:
+        dispatcher.submit(type, data)
+
 def on_spat(data: dict):
     """
     Event fired for each V2X Parsed SPaT message
@@ -140,74 +289,132 @@ def on_spat(data: dict):
     # data['walkDont']
     # 
     # To speed up how we process the data, we'll add any received packets to a queue.
-    # This thread will immediately acknowledge the packet and our Asynchronous workers will handle it.
-    # We share workers between SPaT and BSM in this example.
-    pool.apply_async(process_data,
-                    args=('SPAT', data,),
-                    error_callback=error_callback)
+    # This thread will immediately acknowledge the packet and our Asynchronous workers will handle it,
+    # a batch at a time. We share workers between SPaT and BSM in this example.
+    submit('SPAT', data)
 
 def on_bsm(data: dict):
     """
     Event fired for each V2X RAW message
     """
-    pool.apply_async(process_data,
-                    args=('BSM', data,),
-                    error_callback=error_callback)
+    submit('BSM', data)
 
 def on_raw(data: dict):
     """
     Event fired for each V2X RAW message
     """
-    pool.apply_async(process_data,
-                    args=('RAW', data,),
-                    error_callback=error_callback)
+    submit('RAW', data)
 
 def on_int_update(data: dict):
     """
     Event fired for each Intersection update.
     Returns the OCTANE intersection ID and it's state value.
     """
-    pool.apply_async(process_data,
-                    args=('INTERSECTION', data,),
-                    error_callback=error_callback)
+    submit('INTERSECTION', data)
+
+auth_failed = False #Set when OCTANE rejects the API key, to stop run() reconnecting.
 
 def on_auth_fail(data: str):
     """
-    Event fired on disconnect.
+    Event fired when authentication fails. Reconnecting won't help, so stop.
     """
+    global auth_failed
     print('Failed auth, disconnecting.', data)
-    print ("Shutting down workers.")
-    pool.close()
-    pool.join()
-    exit()
+    auth_failed = True
+    sio.disconnect()
 
 def on_disconnect():
     """
-    Event fired on disconnect.
+    Event fired on disconnect. run() takes care of reconnecting.
     """
     print('Disconnected from OCTANE server.')
-    # Reconnect on disconnect:
-    sio.disconnect()
-    reconnect()
 
-def reconnect():
-    #Make connection
-    print ("Connecting to OCTANE via Socket.IO...")
-    sio.connect(server, transports=None, namespaces=[namespace])
-    print ("Connected to OCTANE!")
-    sio.wait()
+def run():
+    """
+    Connect, and reconnect whenever the connection drops, until authentication fails. A loop rather than
+    reconnecting from on_disconnect, so however many times the connection drops, calls don't pile up.
+    """
+    delays = backoff_delays(reconnect_min_s, reconnect_max_s)
+    while not auth_failed:
+        print ("Connecting to OCTANE via Socket.IO...")
+        try:
+            sio.connect(server, transports=None, namespaces=[namespace])
+        except socketio.exceptions.ConnectionError as err:
+            wait_s = next(delays)
+            print ("Couldn't connect ({}), trying again in {:.1f}s".format(err, wait_s))
+            time.sleep(wait_s)
+            continue
+        print ("Connected to OCTANE!")
+        connected_at = time.monotonic()
+        sio.wait()
+        if time.monotonic() - connected_at >= reconnect_reset_s:
+            delays = backoff_delays(reconnect_min_s, reconnect_max_s)
+        elif not auth_failed:
+            wait_s = next(delays)
+            print ("Connection dropped after {:.1f}s, reconnecting in {:.1f}s".format(
+                time.monotonic() - connected_at, wait_s))
+            time.sleep(wait_s)
+
+def shutdown():
+    """
+    Let the workers finish what they've been given, then stop them.
+    """
+    print ("Shutting down workers.")
+    if transport == 'ring':
+        ring.close_for_writing()
+        for worker in workers:
+            worker.join()
+        print(ring.report())
+        ring.release()
+    elif transport == 'shards':
+        shards.close()
+        print(shards.report())
+    else:
+        dispatcher.close()
+        coalescer.close()
+        print(dispatcher.report())
+        print(coalescer.report())
+        pool.close()
+        pool.join()
+    if transport != 'ring':
+        latency.dump(latency_dump_filename)
 
 #Only connect in the main thread, workers will start but should not connect to Socket.IO themselves.
 if __name__ == '__main__':
 
+    if transport == 'ring':
+        ring = SharedRing(ring_slots, ring_slot_size, number_of_workers)
+        workers = [Process(target=ring_worker, args=(ring.attach_args(), consumer))
+                   for consumer in range(number_of_workers)]
+        for worker in workers:
+            worker.start()
+        print ("Ring workers started")
+        sio = RingClient(ring, reconnection=False)
+    elif transport == 'shards':
+        shards = ShardedPool(process_sharded, number_of_workers, max_batch_size=max_batch_size,
+                             max_batch_latency_s=max_batch_latency_s)
+        print ("Shard workers started")
+        sio = socketio.Client(reconnection=False)
+    else:
+        pool = Pool(number_of_workers, initializer=None, initargs=(None), maxtasksperchild=10000)
+        print ("Worker pool initialized")
+        dispatcher = BatchDispatcher(pool, process_batch, max_batch_size, max_batch_latency_s,
+                                     error_callback=error_callback, report_interval_s=metrics_interval_s)
+        coalescer = CoalescingQueue(pool, process_batch, number_of_workers, max_age_s=spat_max_age_s,
+                                    error_callback=error_callback, report_interval_s=metrics_interval_s)
+        # Uncomment the next line if you'd like a logger showing all messages coming in and out.
+        sio = socketio.Client(reconnection=False)
+        #sio = socketio.Client(reconnection=False, logger=True, engineio_logger=True)
     print ("Created Socket.IO client")
-    # Uncomment the next line if you'd like a logger showing all messages coming in and out.
-    sio = socketio.Client()
-    #sio = socketio.Client(logger=True, engineio_logger=True)
-
 
-    pool = Pool(number_of_workers, initializer=None, initargs=(None), maxtasksperchild=10000)
-    print ("Worker pool initialized")
+    latency = LatencyRecorder()
+    if transport == 'ring' and hasattr(signal, 'SIGUSR1'):
+        # Packets are only decoded, and their latency recorded, in the workers, so have each of them dump
+        signal.signal(signal.SIGUSR1, lambda *_: [os.kill(worker.pid, signal.SIGUSR1)
+                                                  for worker in workers if worker.is_alive()])
+    else:
+        latency.dump_on_signal(latency_dump_filename)
+    print ("Send SIGUSR1 to dump latency histograms: kill -USR1 {}".format(os.getpid()))
 
     sio.on('disconnect', on_disconnect, namespace=namespace)
     sio.on('auth_fail', on_auth_fail, namespace=namespace)
@@ -219,8 +426,6 @@ if __name__ == '__main__':
     sio.on('v2x_raw', on_raw, namespace=namespace)
     sio.on('intersection_update', on_int_update, namespace=namespace)
 
-    reconnect()
-    print ("Shutting down workers.")
-    pool.close()
-    pool.join()
+    run()
+    shutdown()
     print ("Workers done, exiting")
\ No newline at end of file
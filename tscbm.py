@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+tscbm.py
+
+Decodes raw TSCBM SPaT (the NTCIP 1202 signal controller broadcast message carried on the v2x_rsu_raw channel)
+locally, so SPaT can be used without waiting on the server's _parsed channels.
+
+A TSCBM is a fixed 245 byte big-endian record, so a batch of them is decoded by joining the payloads and viewing
+them through a NumPy structured dtype - one pass, no per-message parsing. decode_batch() returns a structured
+array whose id/updated/red/yellow/green columns match v2x_spat.SPAT_DTYPE (so colors() and changes() work on
+it), plus the other status masks and the per-phase countdowns.
+
+Phase status masks use the same layout as the parsed channel's strings and v2x_spat: phases 1-8 are bits 8-15
+and phases 9-16 are bits 0-7, which is each 16 bit word read as little-endian.
+
+To check the decoder against the server's own parsing, capture both channels and compare them:
+
+    $ ./tscbm.py capture capture.jsonl --seconds 60
+    $ ./tscbm.py validate capture.jsonl
+"""
+import argparse
+import base64
+import binascii
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from v2x_latency import parse_updated
+from v2x_spat import to_states
+
+TSCBM_HEADER = 0xCD
+TSCBM_SIZE = 245
+PHASE_BLOCKS = 16
+
+_PHASE_BLOCK = np.dtype([
+    ("phase", "u1"),
+    ("vehTimeMin", ">u2"),
+    ("vehTimeMax", ">u2"),
+    ("pedTimeMin", ">u2"),
+    ("pedTimeMax", ">u2"),
+    ("ovlpTimeMin", ">u2"),
+    ("ovlpTimeMax", ">u2"),
+])
+
+# The message as sent. Status masks are big-endian words, read little-endian to put phase 1 at bit 8.
+TSCBM_DTYPE = np.dtype([
+    ("header", "u1"),
+    ("blockCount", "u1"),
+    ("blocks", _PHASE_BLOCK, (PHASE_BLOCKS,)),
+    ("red", "<u2"),
+    ("yellow", "<u2"),
+    ("green", "<u2"),
+    ("walkDont", "<u2"),
+    ("pedClear", "<u2"),
+    ("walk", "<u2"),
+    ("overlapRed", "<u2"),
+    ("overlapYellow", "<u2"),
+    ("overlapGreen", "<u2"),
+    ("flashingPhases", "<u2"),
+    ("flashingOverlaps", "<u2"),
+    ("intersectionStatus", "u1"),
+    ("timebaseAction", "u1"),
+    ("discontinuousChange", "u1"),
+    ("sequence", "u1"),
+    ("systemSeconds", "u1", (3,)),
+    ("systemMilliseconds", ">u2"),
+    ("pedDirectCalls", "<u2"),
+    ("pedLatchedCalls", "<u2"),
+])
+assert TSCBM_DTYPE.itemsize == TSCBM_SIZE
+
+MASK_FIELDS = ("red", "yellow", "green", "walkDont", "pedClear", "walk", "overlapRed", "overlapYellow",
+               "overlapGreen", "flashingPhases", "flashingOverlaps", "pedDirectCalls", "pedLatchedCalls")
+TIME_FIELDS = ("vehTimeMin", "vehTimeMax", "pedTimeMin", "pedTimeMax", "ovlpTimeMin", "ovlpTimeMax")
+
+# Decoded SPaT: the v2x_spat.SPAT_DTYPE columns first, then everything else in native byte order, with
+# countdowns in seconds for each of the 16 phase blocks
+RECORD_DTYPE = np.dtype(
+    [("id", "S16"), ("updated", "f8"), ("red", "u4"), ("yellow", "u4"), ("green", "u4")] +
+    [(field, "u2") for field in MASK_FIELDS[3:]] +
+    [("intersectionStatus", "u1"), ("sequence", "u1"), ("systemSeconds", "f8"), ("phase", "u1", (PHASE_BLOCKS,))] +
+    [(field, "f4", (PHASE_BLOCKS,)) for field in TIME_FIELDS]
+)
+
+PAYLOAD_KEYS = ("payload", "data", "raw", "message")
+
+
+def raw_payload(message):
+    """
+    :param message: A v2x_rsu_raw message: the TSCBM's bytes, or a hex or base64 string of them, or a dict
+                    holding one of those
+    :return: The TSCBM's bytes
+    """
+    if isinstance(message, dict):
+        for key in PAYLOAD_KEYS:
+            if key in message:
+                return raw_payload(message[key])
+        raise ValueError(f"No payload in raw message with keys {sorted(message)}")
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return bytes(message)
+    try:
+        return bytes.fromhex(message)
+    except ValueError:
+        return base64.b64decode(message, validate=True)
+
+
+def decode_batch(payloads, ids=None, updated=None):
+    """
+    :param payloads: TSCBM payloads, as bytes
+    :param ids: The RSU id for each payload, if known
+    :param updated: Each payload's 'updated' timestamp (ISO-8601 string or seconds since the epoch), if known
+    :return: (RECORD_DTYPE array, indices of the payloads decoded). Payloads of the wrong size or without
+             the TSCBM header are skipped.
+    """
+    valid = [index for index, payload in enumerate(payloads) if len(payload) == TSCBM_SIZE]
+    raw = np.frombuffer(b"".join(payloads[index] for index in valid), dtype=TSCBM_DTYPE)
+    has_header = raw["header"] == TSCBM_HEADER
+    raw = raw[has_header]
+    valid = np.asarray(valid, dtype=np.intp)[has_header]
+
+    records = np.zeros(len(raw), dtype=RECORD_DTYPE)
+    for field in MASK_FIELDS:
+        records[field] = raw[field]
+    records["intersectionStatus"] = raw["intersectionStatus"]
+    records["sequence"] = raw["sequence"]
+    seconds = raw["systemSeconds"].astype(np.uint32)
+    records["systemSeconds"] = ((seconds[:, 0] << 16) | (seconds[:, 1] << 8) | seconds[:, 2]) + \
+        raw["systemMilliseconds"] / 1000
+    records["phase"] = raw["blocks"]["phase"]
+    for field in TIME_FIELDS:
+        # Sent in tenths of a second
+        records[field] = raw["blocks"][field] / 10
+
+    if ids is not None:
+        records["id"] = np.array([ids[index] for index in valid], dtype="S16")
+    if updated is not None:
+        records["updated"] = [parse_updated(updated[index]) if isinstance(updated[index], str) else updated[index]
+                              for index in valid]
+    return records, valid
+
+
+def decode_messages(messages):
+    """
+    Decode v2x_rsu_raw messages, taking id and updated from each message where present
+    :return: (RECORD_DTYPE array, indices of the messages decoded)
+    """
+    payloads, ids, updated = [], [], []
+    for message in messages:
+        try:
+            payloads.append(raw_payload(message))
+        except (ValueError, TypeError, binascii.Error):
+            payloads.append(b"")
+        details = message if isinstance(message, dict) else {}
+        ids.append(str(details.get("id", "")))
+        updated.append(details.get("updated", 0.0))
+    return decode_batch(payloads, ids, updated)
+
+
+def to_parsed(record):
+    """
+    One decoded record as a dict laid out like a v2x_rsu_parsed message, for comparison or for code written
+    against the parsed channel
+    """
+    parsed = {"id": record["id"].decode(), "updated": float(record["updated"])}
+    for field in MASK_FIELDS:
+        parsed[field] = to_states(int(record[field]))
+    for field in ("intersectionStatus", "sequence"):
+        parsed[field] = int(record[field])
+    for field in TIME_FIELDS:
+        parsed[field] = [round(float(value), 1) for value in record[field]]
+    return parsed
+
+
+def validate(records, parsed_messages):
+    """
+    Compare decoded records with the parsed channel's messages for the same SPaTs, field by field, over every
+    field both have
+    :return: Counts of records compared and of mismatches per field, with a few examples
+    """
+    mismatches = {}
+    examples = []
+    for record, parsed in zip(records, parsed_messages):
+        decoded = to_parsed(record)
+        for field, value in parsed.items():
+            if field in ("id", "updated") or field not in decoded:
+                continue
+            if decoded[field] != value:
+                mismatches[field] = mismatches.get(field, 0) + 1
+                if len(examples) < 10:
+                    examples.append({"field": field, "id": parsed.get("id"), "updated": parsed.get("updated"),
+                                     "decoded": decoded[field], "parsed": value})
+    return {"compared": min(len(records), len(parsed_messages)), "mismatches": mismatches, "examples": examples}
+
+
+def pair_capture(lines):
+    """
+    Match raw and parsed messages from a capture file by RSU id and 'updated'
+    :return: (raw messages, parsed messages), in matching order
+    """
+    raw, parsed = {}, {}
+    for line in lines:
+        entry = json.loads(line)
+        data = entry["data"]
+        key = (str(data.get("id")), data.get("updated"))
+        (raw if entry["event"] == "v2x_raw" else parsed)[key] = data
+    keys = [key for key in raw if key in parsed]
+    return [raw[key] for key in keys], [parsed[key] for key in keys]
+
+
+def capture(filename, seconds, rsu=None):
+    """
+    Record the raw and parsed SPaT channels side by side, one JSON line per message
+    """
+    import socketio
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    api_key = os.environ.get('MCITY_OCTANE_KEY', None)
+    server = os.environ.get('MCITY_OCTANE_SERVER', 'wss://octane.um.city/')
+    namespace = "/octane"
+    if not api_key:
+        sys.exit("No API KEY SPECIFIED. EXITING")
+
+    sio = socketio.Client()
+    channels = [f"v2x_rsu_{rsu}_raw", f"v2x_rsu_{rsu}_parsed"] if rsu else ["v2x_rsu_raw", "v2x_rsu_parsed"]
+    with open(filename, "w") as capture_file:
+        def record(event):
+            def on_event(data):
+                capture_file.write(json.dumps({"event": event, "data": data}) + "\n")
+            return on_event
+
+        sio.on('connect', lambda: sio.emit('auth', {'x-api-key': api_key}, namespace=namespace), namespace=namespace)
+        sio.on('auth_ok', lambda data: [sio.emit('join', {'channel': channel}, namespace=namespace)
+                                        for channel in channels], namespace=namespace)
+        sio.on('v2x_raw', record('v2x_raw'), namespace=namespace)
+        sio.on('v2x_SPaT', record('v2x_SPaT'), namespace=namespace)
+        sio.connect(server, namespaces=[namespace])
+        time.sleep(seconds)
+        sio.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode raw TSCBM SPaT and check it against the parsed channel")
+    commands = parser.add_subparsers(dest="command", required=True)
+    capture_parser = commands.add_parser("capture", help="Record raw and parsed SPaT from OCTANE to a file")
+    capture_parser.add_argument("filename")
+    capture_parser.add_argument("--seconds", type=float, default=60.0, help="How long to record for")
+    capture_parser.add_argument("--rsu", help="Only record this RSU's channels")
+    validate_parser = commands.add_parser("validate", help="Decode a capture's raw SPaT and compare it with the "
+                                                           "parsed SPaT for the same messages")
+    validate_parser.add_argument("filename")
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        capture(args.filename, args.seconds, args.rsu)
+        return
+
+    with open(args.filename) as capture_file:
+        raw, parsed = pair_capture(capture_file)
+    start = time.perf_counter()
+    records, decoded = decode_messages(raw)
+    elapsed = time.perf_counter() - start
+    result = validate(records, [parsed[index] for index in decoded])
+    result["undecodable"] = len(raw) - len(decoded)
+    result["decode_us_per_msg"] = 1e6 * elapsed / len(raw) if raw else None
+    json.dump(result, sys.stdout, indent=2, default=str)
+    print()
+    if result["mismatches"] or not result["compared"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
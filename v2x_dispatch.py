@@ -0,0 +1,266 @@
+"""
+v2x_dispatch.py
+
+Helpers for handing V2X packets from a Socket.IO receive thread to a multiprocessing worker pool.
+
+BatchDispatcher gathers packets into batches, bounded by size and by age, so that each trip to a worker
+(pickle, pipe write, result object) carries many packets instead of one.
+
+CoalescingQueue is for packets where only the latest value matters, like SPaT: it keeps at most one pending
+packet per key, replacing it when a newer one arrives, and sheds packets that waited too long to be worth
+processing.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class BatchDispatcher:
+    """
+    Collects (type, data) packets and submits them to a multiprocessing Pool in batches. A batch is sent when it
+    reaches max_batch_size packets, or when its oldest packet has waited max_batch_latency_s, whichever is first.
+
+    handler is called in a worker with a list of (type, data) tuples, so it must be a module level function.
+    """
+    def __init__(self, pool, handler, max_batch_size=64, max_batch_latency_s=0.05, error_callback=None,
+                 report_interval_s=None):
+        self.pool = pool
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_batch_latency_s = max_batch_latency_s
+        self.error_callback = error_callback
+        self.report_interval_s = report_interval_s
+
+        self._batch = []
+        self._batch_started = None
+        self._lock = threading.Condition()
+        self._closed = False
+
+        # Metrics
+        self.packets = 0
+        self.batches = 0
+        self.max_batch_seen = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.flushed_by_size = 0
+        self.flushed_by_age = 0
+
+        self._flusher = threading.Thread(target=self._flush_when_due, name="batch-flusher", daemon=True)
+        self._flusher.start()
+
+    def submit(self, type, data):
+        """
+        Queue a packet for the workers. Cheap enough to call from a socket event handler.
+        """
+        with self._lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+                self._lock.notify()
+            self._batch.append((type, data))
+            if len(self._batch) >= self.max_batch_size:
+                self.flushed_by_size += 1
+                self._flush()
+
+    def _flush(self):
+        # Called with the lock held
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        self.packets += len(batch)
+        self.batches += 1
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.pool.apply_async(self.handler, args=(batch,), callback=self._done, error_callback=self._failed)
+
+    def _done(self, result):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _failed(self, err):
+        self._done(None)
+        if self.error_callback:
+            self.error_callback(err)
+
+    def _flush_when_due(self):
+        last_report = time.monotonic()
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                if self._batch and now - self._batch_started >= self.max_batch_latency_s:
+                    self.flushed_by_age += 1
+                    self._flush()
+                if self._batch:
+                    timeout = self._batch_started + self.max_batch_latency_s - now
+                else:
+                    timeout = self.report_interval_s
+                self._lock.wait(timeout)
+
+            if self.report_interval_s and time.monotonic() - last_report >= self.report_interval_s:
+                print(self.report())
+                last_report = time.monotonic()
+
+    @property
+    def queue_depth(self):
+        """
+        Packets waiting to be batched, plus batches sent to workers that haven't finished yet
+        """
+        return len(self._batch), self.in_flight
+
+    def metrics(self):
+        return {
+            "packets": self.packets,
+            "batches": self.batches,
+            "mean_batch_size": self.packets / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "flushed_by_size": self.flushed_by_size,
+            "flushed_by_age": self.flushed_by_age,
+            "pending_packets": len(self._batch),
+            "batches_in_flight": self.in_flight,
+            "max_batches_in_flight": self.max_in_flight,
+        }
+
+    def report(self):
+        m = self.metrics()
+        return ("Dispatch: {packets} packets in {batches} batches (mean {mean_batch_size:.1f}, max {max_batch_size}), "
+                "{pending_packets} pending, {batches_in_flight} batches in flight "
+                "(max {max_batches_in_flight})".format(**m))
+
+    def close(self):
+        """
+        Send whatever is left and stop the flusher thread
+        """
+        with self._lock:
+            self._flush()
+            self._closed = True
+            self._lock.notify()
+        self._flusher.join()
+
+
+class CoalescingQueue:
+    """
+    Holds the latest packet for each key (e.g. each intersection's SPaT) and submits them to a multiprocessing
+    Pool in batches as workers free up. A packet that's replaced by a newer one for the same key before it's
+    sent is counted as coalesced; one that has waited longer than max_age_s is dropped rather than sent.
+
+    Unlike BatchDispatcher, this never has more than max_in_flight batches with the pool at once, so any backlog
+    builds up here, where it can be coalesced, rather than in the pool's task queue.
+
+    handler is called in a worker with a list of (type, data) tuples, so it must be a module level function.
+    """
+    def __init__(self, pool, handler, max_in_flight, max_batch_size=16, max_age_s=2.0, error_callback=None,
+                 report_interval_s=None, clock=time.monotonic):
+        self.pool = pool
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.max_batch_size = max_batch_size
+        self.max_age_s = max_age_s
+        self.error_callback = error_callback
+        self.report_interval_s = report_interval_s
+        self.clock = clock
+
+        # key -> (received time, type, data), oldest key first
+        self._pending = OrderedDict()
+        self._lock = threading.Condition()
+        self._closed = False
+
+        # Metrics
+        self.received = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.in_flight = 0
+        self.max_pending = 0
+
+        self._sender = threading.Thread(target=self._send_when_ready, name="coalescing-sender", daemon=True)
+        self._sender.start()
+
+    def submit(self, key, type, data):
+        """
+        Queue a packet for the workers, replacing any packet with the same key that hasn't been sent yet.
+        Cheap enough to call from a socket event handler.
+        """
+        with self._lock:
+            self.received += 1
+            if key in self._pending:
+                # Keep the key's place in line so a busy key can't starve the others
+                self.coalesced += 1
+            self._pending[key] = (self.clock(), type, data)
+            self.max_pending = max(self.max_pending, len(self._pending))
+            self._lock.notify()
+
+    def _take_batch(self):
+        # Called with the lock held
+        now = self.clock()
+        batch = []
+        while self._pending and len(batch) < self.max_batch_size:
+            _, (received, type, data) = self._pending.popitem(last=False)
+            if self.max_age_s is not None and now - received > self.max_age_s:
+                self.dropped += 1
+            else:
+                batch.append((type, data))
+        return batch
+
+    def _send_when_ready(self):
+        last_report = self.clock()
+        while True:
+            with self._lock:
+                while self.in_flight < self.max_in_flight and self._pending:
+                    batch = self._take_batch()
+                    if batch:
+                        self.sent += len(batch)
+                        self.in_flight += 1
+                        self.pool.apply_async(self.handler, args=(batch,), callback=self._done,
+                                              error_callback=self._failed)
+                if self._closed and not self._pending:
+                    return
+                self._lock.wait(self.report_interval_s)
+
+            if self.report_interval_s and self.clock() - last_report >= self.report_interval_s:
+                print(self.report())
+                last_report = self.clock()
+
+    def _done(self, result):
+        with self._lock:
+            self.in_flight -= 1
+            self._lock.notify()
+
+    def _failed(self, err):
+        self._done(None)
+        if self.error_callback:
+            self.error_callback(err)
+
+    @property
+    def queue_depth(self):
+        """
+        Keys waiting to be sent, plus batches sent to workers that haven't finished yet
+        """
+        return len(self._pending), self.in_flight
+
+    def metrics(self):
+        return {
+            "received": self.received,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "batches_in_flight": self.in_flight,
+        }
+
+    def report(self):
+        m = self.metrics()
+        return ("Coalescing: {received} packets received, {sent} sent, {coalesced} replaced by newer ones, "
+                "{dropped} dropped as stale, {pending} pending (max {max_pending}), "
+                "{batches_in_flight} batches in flight".format(**m))
+
+    def close(self):
+        """
+        Send whatever is left (as workers free up) and stop the sender thread
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._sender.join()
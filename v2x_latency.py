@@ -0,0 +1,195 @@
+"""
+v2x_latency.py
+
+Measures how far behind V2X packets arrive: the time a packet is received minus its OCTANE 'updated' timestamp,
+kept in histograms per channel and per RSU so p50/p99/max can be reported at any time.
+
+parse_updated() handles OCTANE's fixed ISO-8601 format (2023-04-05T16:20:31.123Z, or with a +00:00 style offset)
+by slicing rather than general purpose parsing, and remembers the epoch of the last date it saw, so it's a few
+integer conversions per packet.
+
+Socket.IO clients call event handlers from several threads at once, so LatencyRecorder locks around recording, and
+parse_updated() keeps its remembered date and epoch as one tuple, replaced whole, so no thread sees one without
+the other.
+"""
+import calendar
+import json
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+
+# (date, epoch of its midnight) of the last timestamp parsed
+_midnight = (None, 0)
+
+
+def parse_updated(updated):
+    """
+    :param updated: An ISO-8601 UTC timestamp like 2023-04-05T16:20:31.123456Z
+    :return: Seconds since the epoch
+    """
+    global _midnight
+    try:
+        date = updated[:10]
+        midnight_date, midnight_epoch = _midnight
+        if date != midnight_date:
+            midnight_epoch = calendar.timegm((int(date[:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+            _midnight = (date, midnight_epoch)
+        seconds = (midnight_epoch + int(updated[11:13]) * 3600 + int(updated[14:16]) * 60 +
+                   int(updated[17:19]))
+
+        end = len(updated)
+        if updated[-1] == 'Z':
+            end -= 1
+        elif updated[-6] in '+-' and updated[-3] == ':':
+            offset = int(updated[-5:-3]) * 3600 + int(updated[-2:]) * 60
+            seconds -= offset if updated[-6] == '+' else -offset
+            end -= 6
+        if end > 19:
+            if updated[19] != '.':
+                raise ValueError(updated)
+            fraction = updated[20:end]
+            return seconds + int(fraction) / 10 ** len(fraction)
+        return float(seconds)
+    except (ValueError, IndexError):
+        # Anything off the fixed format, e.g. missing seconds or a space instead of T
+        return datetime.fromisoformat(updated.replace('Z', '+00:00')).timestamp()
+
+
+class LatencyHistogram:
+    """
+    Fixed width buckets of resolution_s up to max_s; anything slower lands in the last bucket, but the true
+    max is kept separately.
+    """
+    def __init__(self, max_s=10.0, resolution_s=0.001):
+        self.resolution_s = resolution_s
+        self.buckets = [0] * (int(max_s / resolution_s) + 1)
+        self.count = 0
+        self.total_s = 0.0
+        self.min_s = float('inf')
+        self.max_s = float('-inf')
+
+    def record(self, latency_s):
+        self.count += 1
+        self.total_s += latency_s
+        if latency_s < self.min_s:
+            self.min_s = latency_s
+        if latency_s > self.max_s:
+            self.max_s = latency_s
+        # Negative latency means the sender's clock is ahead of ours; count it as no delay
+        bucket = int(latency_s / self.resolution_s) if latency_s > 0 else 0
+        self.buckets[min(bucket, len(self.buckets) - 1)] += 1
+
+    def percentile(self, p):
+        """
+        :return: The upper edge of the bucket holding the p'th percentile (0-100) latency, in seconds
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if bucket == len(self.buckets) - 1:
+                    # The overflow bucket has no upper edge
+                    return self.max_s
+                return min((bucket + 1) * self.resolution_s, self.max_s)
+        return self.max_s
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_s": self.total_s / self.count,
+            "min_s": self.min_s,
+            "p50_s": self.percentile(50),
+            "p99_s": self.percentile(99),
+            "max_s": self.max_s,
+        }
+
+
+class LatencyRecorder:
+    """
+    Latency histograms per channel (the Socket.IO event) and per RSU (the packet's id). Safe to record to from
+    several threads.
+    """
+    def __init__(self, max_s=10.0, resolution_s=0.001, clock=time.time):
+        self.max_s = max_s
+        self.resolution_s = resolution_s
+        self.clock = clock
+        self.channels = {}
+        self.rsus = {}
+        self.unparsed = 0
+        # Reentrant, as dump_on_signal's handler can run on a thread that's in the middle of recording
+        self._lock = threading.RLock()
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram(self.max_s, self.resolution_s)
+        return histogram
+
+    def record(self, channel, rsu, updated, received=None):
+        """
+        :param updated: The packet's 'updated' timestamp, as sent
+        :param received: When the packet arrived, in seconds since the epoch; now if not given
+        :return: The packet's latency in seconds, or None if its timestamp couldn't be read
+        """
+        if received is None:
+            received = self.clock()
+        try:
+            latency_s = received - parse_updated(updated)
+        except (TypeError, ValueError):
+            with self._lock:
+                self.unparsed += 1
+            return None
+        with self._lock:
+            self._histogram(self.channels, channel).record(latency_s)
+            self._histogram(self.rsus, (channel, rsu)).record(latency_s)
+        return latency_s
+
+    def summaries(self):
+        with self._lock:
+            return {
+                "channels": {channel: histogram.summary() for channel, histogram in self.channels.items()},
+                "rsus": {f"{channel} {rsu}": histogram.summary() for (channel, rsu), histogram in self.rsus.items()},
+                "unparsed": self.unparsed,
+            }
+
+    def report(self):
+        lines = ["Latency (received - updated):    count      p50      p99      max"]
+        with self._lock:
+            rows = [(channel, histogram.summary()) for channel, histogram in sorted(self.channels.items())]
+            rows += [(f"  {channel} {rsu}", histogram.summary())
+                     for (channel, rsu), histogram in sorted(self.rsus.items(), key=lambda item: str(item[0]))]
+            unparsed = self.unparsed
+        for name, s in rows:
+            lines.append(f"{name:<32} {s['count']:>6} {s['p50_s']:>7.3f}s {s['p99_s']:>7.3f}s {s['max_s']:>7.3f}s")
+        if unparsed:
+            lines.append(f"{unparsed} packets had an unreadable 'updated' timestamp")
+        return "\n".join(lines)
+
+    def dump(self, filename=None, heading=None):
+        """
+        Print the report, under heading if given, and write the summaries to filename as JSON if given
+        """
+        report = f"{heading}\n{self.report()}" if heading else self.report()
+        # One write, newline included, so reports dumped by several processes at once don't interleave
+        print(report + "\n", end="", flush=True)
+        if filename:
+            with open(filename, "w") as dump_file:
+                json.dump(self.summaries(), dump_file, indent=2)
+
+    def dump_on_signal(self, filename=None, signum=getattr(signal, "SIGUSR1", None)):
+        """
+        Dump whenever the process gets signum (SIGUSR1 by default: kill -USR1 <pid>). Must be called from the main
+        thread. Does nothing where the signal doesn't exist (Windows).
+        """
+        if signum is None:
+            print("Latency dumps on signal aren't supported on this platform", file=sys.stderr)
+            return
+        signal.signal(signum, lambda *_: self.dump(filename))
@@ -0,0 +1,282 @@
+"""
+v2x_ring.py
+
+A shared memory ring buffer for handing V2X packets from one receiving process to many worker processes
+without pickling or pipes. The receiver copies each packet's bytes into a fixed size slot; workers read slots
+in place, using sequence numbers to know what's new and whether it was overwritten while they read it.
+
+Packets are spread across consumers by sequence number (consumer c reads every packet where
+sequence % consumers == c), so consumers never contend with each other. The writer never waits on a consumer: if
+a consumer falls a whole ring behind, its oldest unread packets are overwritten and counted as overflows.
+
+There's one writing process, but not necessarily one writing thread: the Socket.IO client handles each message on
+its own thread, so write() takes a lock, and packets are written one whole slot at a time.
+
+A consumer with nothing to read sleeps on its own Event rather than polling. It raises its waiting flag in the
+header first, and the writer only sets the Event of a consumer whose flag is up, so while consumers are keeping
+busy, writes cost no more than a read of the flag.
+
+Readers hand out memoryviews of the slots themselves rather than copies. A consumer's read sequence only moves
+past a slot once it asks for the next packet, so the writer counts an overflow if it laps a packet still in use.
+
+Layout of the shared memory block:
+    header      - write sequence, overflow count, oversize count, closed flag, then each consumer's read sequence,
+                  then each consumer's waiting flag
+    slots       - slot_count slots of slot_size bytes: sequence (8 bytes), length (4 bytes), padding, payload
+
+A slot's sequence is only ever set with a single aligned 8 byte store, after the rest of the slot is written.
+"""
+import multiprocessing
+import struct
+import threading
+from multiprocessing import shared_memory
+
+_WRITE_SEQ, _OVERFLOWS, _OVERSIZE, _CLOSED = range(4)
+_HEADER_FIELDS = 4
+_SLOT_HEADER_SIZE = 16
+_LENGTH = struct.Struct("<I")
+_UNWRITTEN = 0xFFFFFFFFFFFFFFFF
+
+
+class SharedRing:
+    """
+    The writer's side of the ring, and the owner of its shared memory. Pass name and events (with the same sizes)
+    to attach to an existing ring from another process; attach_args() has them all.
+    """
+    def __init__(self, slot_count=8192, slot_size=2048, consumers=4, name=None, events=None):
+        self.slot_count = slot_count
+        # Keep every slot's sequence 8 byte aligned
+        self.slot_size = slot_size = slot_size + (-slot_size % 8)
+        self.consumers = consumers
+        self.payload_size = slot_size - _SLOT_HEADER_SIZE
+        header_size = 8 * (_HEADER_FIELDS + 2 * consumers)
+        self._waiting_index = _HEADER_FIELDS + consumers
+        self._slots_offset = header_size + (-header_size % 64)
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self._slots_offset + slot_count * slot_size)
+        else:
+            # Workers started by multiprocessing share the owner's resource tracker, so attaching doesn't
+            # leave anyone else responsible for removing the block
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        # Only passing these to the workers when they're started shares them, so they come from the owner
+        self.events = events if events is not None else [multiprocessing.Event() for _ in range(consumers)]
+        self._write_lock = threading.Lock()
+        self.header = self.shm.buf[:header_size].cast("Q")
+        self.slots = self.shm.buf[self._slots_offset:]
+        self.slot_sequences = self.slots.cast("Q")
+        self._stride = slot_size // 8
+
+        if self.owner:
+            for field in range(_HEADER_FIELDS):
+                self.header[field] = 0
+            for consumer in range(consumers):
+                self.header[_HEADER_FIELDS + consumer] = consumer
+                self.header[self._waiting_index + consumer] = 0
+            for slot in range(slot_count):
+                self.slot_sequences[slot * self._stride] = _UNWRITTEN
+
+    def attach_args(self):
+        """
+        Arguments for SharedRing(...) to attach to this ring from another process
+        """
+        return dict(slot_count=self.slot_count, slot_size=self.slot_size, consumers=self.consumers, name=self.name,
+                    events=self.events)
+
+    def write(self, data):
+        """
+        Copy a packet into the ring. Never waits for consumers, only for other threads writing at the same time.
+        :return: False if the packet is too big for a slot (and was dropped), True otherwise
+        """
+        with self._write_lock:
+            return self._write(data)
+
+    def _write(self, data):
+        if len(data) > self.payload_size:
+            self.header[_OVERSIZE] += 1
+            return False
+
+        header = self.header
+        sequence = header[_WRITE_SEQ]
+        previous = sequence - self.slot_count
+        if previous >= 0 and header[_HEADER_FIELDS + previous % self.consumers] <= previous:
+            header[_OVERFLOWS] += 1
+
+        slot = sequence % self.slot_count
+        offset = slot * self.slot_size
+        # Invalidate the slot, fill it in, then publish it under its new sequence number
+        self.slot_sequences[slot * self._stride] = _UNWRITTEN
+        _LENGTH.pack_into(self.slots, offset + 8, len(data))
+        start = offset + _SLOT_HEADER_SIZE
+        self.slots[start:start + len(data)] = data
+        self.slot_sequences[slot * self._stride] = sequence
+        header[_WRITE_SEQ] = sequence + 1
+        consumer = sequence % self.consumers
+        if header[self._waiting_index + consumer]:
+            header[self._waiting_index + consumer] = 0
+            self.events[consumer].set()
+        return True
+
+    def close_for_writing(self):
+        """
+        Tell consumers no more packets are coming; they'll stop once they've caught up
+        """
+        self.header[_CLOSED] = 1
+        for event in self.events:
+            event.set()
+
+    @property
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    @property
+    def written(self):
+        return self.header[_WRITE_SEQ]
+
+    @property
+    def overflows(self):
+        return self.header[_OVERFLOWS]
+
+    def lag(self, consumer):
+        """
+        How many packets written for a consumer it hasn't read yet
+        """
+        written = self.header[_WRITE_SEQ]
+        read = self.header[_HEADER_FIELDS + consumer]
+        if written <= read:
+            return 0
+        return (written - read + self.consumers - 1) // self.consumers
+
+    def metrics(self):
+        return {
+            "written": self.header[_WRITE_SEQ],
+            "overflows": self.header[_OVERFLOWS],
+            "oversize": self.header[_OVERSIZE],
+            "consumer_lag": [self.lag(consumer) for consumer in range(self.consumers)],
+        }
+
+    def report(self):
+        m = self.metrics()
+        return ("Ring: {written} packets written, {overflows} overwritten before being read, {oversize} too big, "
+                "consumer lag {consumer_lag}".format(**m))
+
+    def reader(self, consumer):
+        return RingReader(self, consumer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """
+        Detach from the shared memory, removing it if this is the ring's owner. Views from readers must have been
+        released first.
+        """
+        self.header.release()
+        self.slot_sequences.release()
+        self.slots.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingReader:
+    """
+    One consumer's view of a SharedRing
+    """
+    def __init__(self, ring, consumer):
+        self.ring = ring
+        self.consumer = consumer
+        self.lost = 0
+        self._read_index = _HEADER_FIELDS + consumer
+        self._waiting_index = ring._waiting_index + consumer
+        self._event = ring.events[consumer]
+        # The packet handed out by read() and not yet released: (sequence, view)
+        self._held = None
+
+    def read(self, max_wait_s=0.05):
+        """
+        Release the previous packet, and wait for this consumer's next one.
+
+        :param max_wait_s: Longest to sleep between checks, as a backstop should a wakeup ever be missed
+        :return: A memoryview of the packet's bytes in the ring, valid until the next read() or release(), or None
+                 once the ring is closed and drained
+        """
+        self.release()
+        ring = self.ring
+        header, slots, slot_sequences = ring.header, ring.slots, ring.slot_sequences
+        while True:
+            sequence = header[self._read_index]
+            slot = sequence % ring.slot_count
+            slot_sequence = slot_sequences[slot * ring._stride]
+
+            if slot_sequence == sequence:
+                offset = slot * ring.slot_size
+                length, = _LENGTH.unpack_from(slots, offset + 8)
+                start = offset + _SLOT_HEADER_SIZE
+                view = slots[start:start + length]
+                # If the writer lapped us while reading the length the sequence will have moved on; go around again
+                if slot_sequences[slot * ring._stride] == sequence:
+                    self._held = sequence, view
+                    return view
+                view.release()
+            elif slot_sequence != _UNWRITTEN and slot_sequence > sequence:
+                # Overwritten before we got to it; skip to our oldest packet still in the ring
+                written = header[_WRITE_SEQ]
+                oldest = max(written - ring.slot_count, 0)
+                oldest += (self.consumer - oldest) % ring.consumers
+                self.lost += (oldest - sequence) // ring.consumers
+                header[self._read_index] = oldest
+                continue
+            elif header[_CLOSED] and header[_WRITE_SEQ] <= sequence:
+                return None
+            else:
+                self._wait(sequence, max_wait_s)
+
+    def _wait(self, sequence, max_wait_s):
+        ring = self.ring
+        self._event.clear()
+        self.ring.header[self._waiting_index] = 1
+        # Look again now the flag is up, in case the packet was written just before
+        slot = sequence % ring.slot_count
+        if ring.slot_sequences[slot * ring._stride] == sequence or ring.header[_CLOSED]:
+            ring.header[self._waiting_index] = 0
+            return
+        self._event.wait(max_wait_s)
+        ring.header[self._waiting_index] = 0
+
+    def intact(self):
+        """
+        :return: Whether the packet from the last read() is still as it was, i.e. the writer hasn't lapped it
+        """
+        if self._held is None:
+            return False
+        sequence, _ = self._held
+        return self.ring.slot_sequences[sequence % self.ring.slot_count * self.ring._stride] == sequence
+
+    def release(self):
+        """
+        Done with the packet from the last read(); let the writer reuse its slot without counting an overflow
+        """
+        if self._held is not None:
+            sequence, view = self._held
+            view.release()
+            self.ring.header[self._read_index] = sequence + self.ring.consumers
+            self._held = None
+
+    def __iter__(self):
+        """
+        Each packet's view is released once the loop moves on to the next
+        """
+        try:
+            while True:
+                view = self.read()
+                if view is None:
+                    return
+                yield view
+        finally:
+            self.release()
@@ -0,0 +1,301 @@
+"""
+v2x_shards.py
+
+A worker pool for stateful V2X processing. Every packet carries a key (an intersection or vehicle id), and each
+key is owned by exactly one worker process, chosen by consistent hashing. Each worker has its own FIFO queue, so
+packets for a key are handled in the order they arrived, and keeps the state for its keys in its own memory, so
+handlers can remember the last phase seen at an intersection without locks or shared state.
+
+Packets are gathered per worker and sent in batches, bounded by size and by age like BatchDispatcher's, so each
+queue.put carries many packets. A worker's state for a key is dropped once the key has gone max_idle_s without a
+packet, or when the worker holds more than max_keys, least recently used first, so ids that come and go (vehicles
+rotate their BSM ids) don't accumulate.
+
+Adding a worker moves only the keys the new worker takes over. Each old worker works out which of its keys those
+are from the ring, once it has handled everything queued before the move, and exports their state to the new one,
+which holds back its packets until every old worker's export has arrived.
+"""
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+_PACKETS, _EXPECT, _EXPORT, _IMPORT, _STOP = range(5)
+
+
+def _hash(value):
+    # hash() of a str differs between processes, so use something stable
+    return int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes, with replicas points per node to even out the load
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash((node, replica))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def node_for(self, key):
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[index]
+
+
+def _handle(handler, states, state_factory, key, type, data, now):
+    # states maps key -> (last packet time, state), least recently used first
+    entry = states.get(key)
+    state = state_factory() if entry is None else entry[1]
+    states[key] = (now, state)
+    states.move_to_end(key)
+    try:
+        handler(type, data, state)
+    except Exception as err:
+        print(f"Shard handler failed for {key!r}: {err!r}")
+
+
+def _evict(states, now, max_keys, max_idle_s):
+    """
+    Drop the state of keys idle longer than max_idle_s, and of the least recently used past max_keys
+    :return: How many were dropped
+    """
+    evicted = 0
+    while states:
+        last_seen = next(iter(states.values()))[0]
+        if (max_keys is None or len(states) <= max_keys) and (max_idle_s is None or now - last_seen <= max_idle_s):
+            break
+        states.popitem(last=False)
+        evicted += 1
+    return evicted
+
+
+def _shard_worker(worker, queue, exports, handler, state_factory, replicas, max_keys, max_idle_s):
+    states = OrderedDict()
+    evicted = 0
+    # While keys are moving to this worker, all its packets are held until every old worker's export arrives
+    awaiting_imports = 0
+    held = []
+    while True:
+        message = queue.get()
+        kind = message[0]
+        now = time.monotonic()
+        if kind == _PACKETS:
+            if awaiting_imports:
+                held.extend(message[1])
+                continue
+            # Before handling, so a key idle too long starts over rather than carrying on with stale state
+            evicted += _evict(states, now, max_keys, max_idle_s)
+            for key, type, data in message[1]:
+                _handle(handler, states, state_factory, key, type, data, now)
+        elif kind == _EXPECT:
+            awaiting_imports = message[1]
+        elif kind == _EXPORT:
+            workers, destination = message[1], message[2]
+            ring = HashRing(range(workers), replicas)
+            moving = [key for key in states if ring.node_for(key) == destination]
+            exports.put((destination, {key: states.pop(key) for key in moving}))
+        elif kind == _IMPORT:
+            states.update(message[1])
+            awaiting_imports -= 1
+            if not awaiting_imports:
+                evicted += _evict(states, now, max_keys, max_idle_s)
+                for key, type, data in held:
+                    _handle(handler, states, state_factory, key, type, data, now)
+                held = []
+        elif kind == _STOP:
+            print(f"Shard worker {worker}: {len(states)} keys held, {evicted} dropped as idle or over max_keys")
+            return
+
+
+class ShardedPool:
+    """
+    Worker processes that each own a shard of keys. handler(type, data, state) is called in the owning worker
+    for every packet, with state the object state_factory() made for that packet's key, so both must be module
+    level so they can be sent to the workers.
+
+    :param max_batch_size: Most packets sent to a worker at once
+    :param max_batch_latency_s: Longest a packet waits for its worker's batch to fill before being sent anyway
+    :param max_keys: Most keys each worker keeps state for; past that the least recently used are dropped
+    :param max_idle_s: Drop a key's state once it's gone this long without a packet
+    """
+    def __init__(self, handler, workers=4, state_factory=dict, replicas=64, max_batch_size=64,
+                 max_batch_latency_s=0.05, max_keys=100000, max_idle_s=600.0):
+        self.handler = handler
+        self.state_factory = state_factory
+        self.replicas = replicas
+        self.max_batch_size = max_batch_size
+        self.max_batch_latency_s = max_batch_latency_s
+        self.max_keys = max_keys
+        self.max_idle_s = max_idle_s
+        # Every key belongs to the worker the ring assigns it, so there's no per-key table to keep
+        self.ring = HashRing(replicas=replicas)
+        self._queues = []
+        self._processes = []
+        self._exports = Queue()
+        # Packets waiting to be sent to each worker, and when the oldest of them was submitted
+        self._batches = []
+        self._batch_started = []
+        self._lock = threading.Condition()
+        self._closed = False
+        self._moves_pending = 0
+
+        # Metrics
+        self.submitted = []
+        self.batches = 0
+        self.rebalances = 0
+
+        self._forwarder = threading.Thread(target=self._forward_exports, name="shard-forwarder", daemon=True)
+        self._forwarder.start()
+        for _ in range(workers):
+            self._start_worker()
+        self._flusher = threading.Thread(target=self._flush_when_due, name="shard-flusher", daemon=True)
+        self._flusher.start()
+
+    def _start_worker(self):
+        worker = len(self._queues)
+        queue = Queue()
+        process = Process(target=_shard_worker,
+                          args=(worker, queue, self._exports, self.handler, self.state_factory, self.replicas,
+                                self.max_keys, self.max_idle_s),
+                          daemon=True)
+        process.start()
+        self._queues.append(queue)
+        self._processes.append(process)
+        self._batches.append([])
+        self._batch_started.append(None)
+        self.submitted.append(0)
+        self.ring.add(worker)
+        return worker
+
+    @property
+    def workers(self):
+        return len(self._queues)
+
+    def submit(self, key, type, data):
+        """
+        Queue a packet for the worker that owns key. Packets with the same key are handled in submission order.
+        """
+        with self._lock:
+            worker = self.ring.node_for(key)
+            batch = self._batches[worker]
+            if not batch:
+                self._batch_started[worker] = time.monotonic()
+                self._lock.notify_all()
+            batch.append((key, type, data))
+            self.submitted[worker] += 1
+            if len(batch) >= self.max_batch_size:
+                self._flush(worker)
+
+    def _flush(self, worker):
+        # Called with the lock held
+        batch = self._batches[worker]
+        if batch:
+            self._batches[worker] = []
+            self._batch_started[worker] = None
+            self._queues[worker].put((_PACKETS, batch))
+            self.batches += 1
+
+    def _flush_when_due(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                timeout = None
+                for worker, started in enumerate(self._batch_started):
+                    if started is None:
+                        continue
+                    if now - started >= self.max_batch_latency_s:
+                        self._flush(worker)
+                    else:
+                        due = started + self.max_batch_latency_s - now
+                        timeout = due if timeout is None else min(timeout, due)
+                self._lock.wait(timeout)
+
+    def add_worker(self):
+        """
+        Start another worker and move the keys it now owns, along with their state, to it
+        """
+        with self._lock:
+            # One move at a time, so a key is never exported by a worker still waiting for it
+            while self._moves_pending:
+                self._lock.wait()
+
+            # Everything already submitted goes out first, so old owners handle it before exporting
+            for old in range(self.workers):
+                self._flush(old)
+            worker = self._start_worker()
+            self._queues[worker].put((_EXPECT, worker))
+            for old in range(worker):
+                self._moves_pending += 1
+                self._queues[old].put((_EXPORT, self.workers, worker))
+            self.rebalances += 1
+            return worker
+
+    def _forward_exports(self):
+        while True:
+            message = self._exports.get()
+            if message is None:
+                return
+            destination, states = message
+            self._queues[destination].put((_IMPORT, states))
+            with self._lock:
+                self._moves_pending -= 1
+                self._lock.notify_all()
+
+    def queue_depths(self):
+        """
+        Batches waiting for each worker, or None where the platform can't say (macOS)
+        """
+        depths = []
+        for queue in self._queues:
+            try:
+                depths.append(queue.qsize())
+            except NotImplementedError:
+                depths.append(None)
+        return depths
+
+    def metrics(self):
+        return {
+            "workers": self.workers,
+            "submitted": list(self.submitted),
+            "batches": self.batches,
+            "pending": [len(batch) for batch in self._batches],
+            "queue_depths": self.queue_depths(),
+            "rebalances": self.rebalances,
+        }
+
+    def report(self):
+        m = self.metrics()
+        return ("Shards: {workers} workers, packets {submitted} in {batches} batches, pending {pending}, "
+                "queued {queue_depths}, {rebalances} rebalances".format(**m))
+
+    def close(self):
+        """
+        Send what's left, let every worker finish its queue, then stop them
+        """
+        with self._lock:
+            while self._moves_pending:
+                self._lock.wait()
+            for worker in range(self.workers):
+                self._flush(worker)
+            self._closed = True
+            self._lock.notify_all()
+            for queue in self._queues:
+                queue.put((_STOP,))
+        self._flusher.join()
+        for process in self._processes:
+            process.join()
+        self._exports.put(None)
+        self._forwarder.join()
@@ -0,0 +1,247 @@
+"""
+v2x_spat.py
+
+Compact SPaT signal state. OCTANE sends each SPaT's red, yellow and green phase states as strings of '0' and '1'
+characters; here each becomes an integer bitmask, so looking up a phase's color or finding which phases changed
+between two SPaTs is a few bit operations rather than string slicing.
+
+Character i of a string is bit i of its mask. As in listen-intersections.py, phases 1-8 are characters 8-15, so
+phase p is bit 7 + p.
+
+SpatState holds one SPaT. decode_batch() turns a list of SPaT messages into a NumPy structured array in one go,
+for working on many intersections or a long stretch of history at once.
+"""
+import numpy as np
+
+from v2x_latency import parse_updated
+
+COLOR_FIELDS = ("red", "yellow", "green")
+PHASES = range(1, 9)
+MASK_BITS = 32
+
+SPAT_DTYPE = np.dtype([
+    ("id", "S16"),
+    ("updated", "f8"),
+    ("red", "u4"),
+    ("yellow", "u4"),
+    ("green", "u4"),
+])
+
+
+def phase_bit(phase):
+    return 1 << (7 + phase)
+
+
+def to_mask(states):
+    """
+    :param states: A phase state string like '0000000011110000'
+    """
+    return int(states[::-1], 2) if states else 0
+
+
+def to_states(mask, width=16):
+    """
+    The inverse of to_mask
+    """
+    return format(mask, f"0{width}b")[::-1]
+
+
+class SpatState:
+    """
+    One intersection's signal state from a SPaT message
+    """
+    __slots__ = ("id", "updated", "red", "yellow", "green")
+
+    def __init__(self, id, updated, red, yellow, green):
+        self.id = id
+        self.updated = updated
+        self.red = red
+        self.yellow = yellow
+        self.green = green
+
+    @classmethod
+    def from_message(cls, data):
+        return cls(data["id"], data["updated"], to_mask(data["red"]), to_mask(data["yellow"]),
+                   to_mask(data["green"]))
+
+    def color(self, phase):
+        """
+        :return: 'G', 'Y' or 'R' for the phase's current color, or None if it shows none of them
+        """
+        bit = phase_bit(phase)
+        if self.green & bit:
+            return "G"
+        if self.yellow & bit:
+            return "Y"
+        if self.red & bit:
+            return "R"
+        return None
+
+    def changed(self, previous):
+        """
+        :return: A mask with the bit set for every phase whose state differs from previous
+        """
+        if previous is None:
+            return 0
+        return (self.red ^ previous.red) | (self.yellow ^ previous.yellow) | (self.green ^ previous.green)
+
+    def changed_phases(self, previous):
+        changed = self.changed(previous)
+        return [phase for phase in PHASES if changed & phase_bit(phase)]
+
+    def __eq__(self, other):
+        return (isinstance(other, SpatState) and self.red == other.red and self.yellow == other.yellow and
+                self.green == other.green)
+
+    def __repr__(self):
+        colors = "".join(self.color(phase) or "-" for phase in PHASES)
+        return f"SpatState(id={self.id!r}, updated={self.updated!r}, phases={colors})"
+
+
+def _masks(strings):
+    """
+    Decode equal length phase state strings to masks with one NumPy operation
+    """
+    width = len(strings[0])
+    if width > MASK_BITS or any(len(states) != width for states in strings):
+        return np.fromiter((to_mask(states) for states in strings), dtype=np.uint32, count=len(strings))
+    digits = np.frombuffer("".join(strings).encode("ascii"), dtype=np.uint8).reshape(len(strings), width)
+    weights = np.left_shift(np.uint32(1), np.arange(width, dtype=np.uint32))
+    return (digits == ord("1")) @ weights
+
+
+def decode_batch(messages):
+    """
+    :param messages: Parsed SPaT messages (dicts with id, updated, red, yellow and green)
+    :return: A SPAT_DTYPE structured array, one row per message, with updated in seconds since the epoch
+    """
+    spats = np.empty(len(messages), dtype=SPAT_DTYPE)
+    if not len(messages):
+        return spats
+    spats["id"] = np.array([data["id"] for data in messages], dtype="S16")
+    updated = [data["updated"] for data in messages]
+    if all(stamp.endswith("Z") for stamp in updated):
+        # All UTC, so NumPy can parse them in one go
+        stamps = np.array([stamp[:-1] for stamp in updated], dtype="datetime64[us]")
+        spats["updated"] = stamps.astype(np.int64) / 1e6
+    else:
+        spats["updated"] = np.fromiter((parse_updated(stamp) for stamp in updated), dtype=np.float64,
+                                       count=len(updated))
+    for field in COLOR_FIELDS:
+        spats[field] = _masks([data[field] for data in messages])
+    return spats
+
+
+def colors(spats, phase):
+    """
+    :return: An array of 'G', 'Y', 'R' or '-' for the phase in every row of a decode_batch() array
+    """
+    bit = phase_bit(phase)
+    return np.select([(spats["green"] & bit) != 0, (spats["yellow"] & bit) != 0, (spats["red"] & bit) != 0],
+                     ["G", "Y", "R"], "-")
+
+
+def changes(spats):
+    """
+    :param spats: A decode_batch() array of one intersection's SPaTs in time order
+    :return: For each row, a mask of the phases whose state differs from the row before (0 for the first row)
+    """
+    changed = np.zeros(len(spats), dtype=np.uint32)
+    for field in COLOR_FIELDS:
+        changed[1:] |= spats[field][1:] ^ spats[field][:-1]
+    return changed
+
+
+COLOR_NAMES = {"R": "red", "Y": "yellow", "G": "green", None: "dark"}
+
+
+class SpatDeltaEncoder:
+    """
+    Turns a stream of SPaTs into a stream of changes. For each intersection it remembers the last signal state and
+    emits an event only for phases whose color changed:
+
+        {"id": "0a0c", "updated": "2023-04-05T16:20:31.1Z", "phase": 2, "from": "red", "to": "green"}
+
+    plus a keyframe with every phase's color for the first SPaT from an intersection and then at least every
+    keyframe_interval_s (by the SPaTs' own timestamps), so a consumer joining late can pick up the full state:
+
+        {"id": "0a0c", "updated": "2023-04-05T16:20:31.1Z", "keyframe": "RGRRRGRR"}
+
+    SPaTs older than the last one seen from the same intersection are ignored.
+    """
+    def __init__(self, keyframe_interval_s=10.0):
+        self.keyframe_interval_s = keyframe_interval_s
+        # id -> (SpatState, its updated time in seconds, when the last keyframe was sent in seconds)
+        self._last = {}
+
+        # Metrics
+        self.received = 0
+        self.stale = 0
+        self.changes = 0
+        self.keyframes = 0
+
+    def encode(self, spat):
+        """
+        :param spat: A SpatState, or a parsed SPaT message
+        :return: A list of events, empty if nothing changed
+        """
+        if not isinstance(spat, SpatState):
+            spat = SpatState.from_message(spat)
+        self.received += 1
+        updated_s = parse_updated(spat.updated)
+        last = self._last.get(spat.id)
+        if last is None:
+            self._last[spat.id] = (spat, updated_s, updated_s)
+            return [self._keyframe(spat)]
+
+        previous, previous_s, keyframe_s = last
+        if updated_s < previous_s:
+            self.stale += 1
+            return []
+
+        events = []
+        changed = spat.changed(previous)
+        if changed:
+            for phase in PHASES:
+                if changed & phase_bit(phase):
+                    before, after = previous.color(phase), spat.color(phase)
+                    if before != after:
+                        events.append({"id": spat.id, "updated": spat.updated, "phase": phase,
+                                       "from": COLOR_NAMES[before], "to": COLOR_NAMES[after]})
+            self.changes += len(events)
+        if updated_s - keyframe_s >= self.keyframe_interval_s:
+            events.append(self._keyframe(spat))
+            keyframe_s = updated_s
+        self._last[spat.id] = (spat, updated_s, keyframe_s)
+        return events
+
+    def _keyframe(self, spat):
+        self.keyframes += 1
+        return {"id": spat.id, "updated": spat.updated,
+                "keyframe": "".join(spat.color(phase) or "-" for phase in PHASES)}
+
+    def metrics(self):
+        emitted = self.changes + self.keyframes
+        return {
+            "received": self.received,
+            "stale": self.stale,
+            "changes": self.changes,
+            "keyframes": self.keyframes,
+            "reduction": self.received / emitted if emitted else None,
+        }
+
+    def report(self):
+        m = self.metrics()
+        reduction = f"{m['reduction']:.1f}x fewer events" if m["reduction"] else "nothing emitted"
+        return (f"Delta: {m['received']} SPaTs in, {m['changes']} changes and {m['keyframes']} keyframes out "
+                f"({reduction}), {m['stale']} out of order SPaTs ignored")
+
+
+def format_event(event):
+    """
+    A line of text for a SpatDeltaEncoder event
+    """
+    if "keyframe" in event:
+        return f"SPAT {event['id']}: phases 1-8 {event['keyframe']} at {event['updated']}"
+    return (f"SPAT {event['id']}: phase {event['phase']} changed from {event['from']} to {event['to']} "
+            f"at {event['updated']}")